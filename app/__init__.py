@@ -8,16 +8,18 @@ from flask_migrate import Migrate
 # from app.utils import hf_limiter 
 import os
 from dotenv import load_dotenv  # Add this import
+from app.sharding import ShardedSession, configure_shards, init_sharding
+from app.sqlite_mode import configure_sqlite, init_sqlite, DEFAULT_POOL_SIZE, DEFAULT_WRITE_TIMEOUT
 
 # Load environment variables from .env file
 load_dotenv()  # Add this line
 
 # Initialize extensions
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': ShardedSession})  # routes per-user tables to the user's shard
 login_manager = LoginManager()
 bcrypt = Bcrypt()
 # limiter = Limiter(key_func=get_remote_address)  # NEW
-migrate = Migrate()
+migrate = Migrate(render_as_batch=True)  # batch ALTERs so migrations also run on SQLite
 
 def create_app():
     # Create the Flask application instance
@@ -28,6 +30,16 @@ def create_app():
     # Configure the database
     app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL')
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # Optional: spread journal data across several databases by user (comma-separated URLs)
+    configure_shards(app, app.config['SQLALCHEMY_DATABASE_URI'], os.getenv('SHARD_DATABASE_URLS'))
+    # SQLite databases get WAL, tuned pragmas, a thread-shared pool and a write queue (see app/sqlite_mode.py)
+    app.config['SQLITE_POOL_SIZE'] = int(os.getenv('SQLITE_POOL_SIZE', DEFAULT_POOL_SIZE))
+    app.config['SQLITE_WRITE_TIMEOUT'] = float(os.getenv('SQLITE_WRITE_TIMEOUT', DEFAULT_WRITE_TIMEOUT))
+    configure_sqlite(app)
+    # Entries older than this many days are moved to cold storage by `flask archive-entries`
+    app.config['ARCHIVE_AFTER_DAYS'] = int(os.getenv('ARCHIVE_AFTER_DAYS', 365))
+    # Keep the scores of each sentence chunk of long entries (set to 0 to store only the entry score)
+    app.config['STORE_CHUNK_SCORES'] = os.getenv('STORE_CHUNK_SCORES', '1') != '0'
     # app.config['SQLALCHEMY_ECHO'] = True <- return logs of what is sent to mysql
 
     # NEW: Configure rate limiting storage
@@ -43,6 +55,7 @@ def create_app():
     login_manager.init_app(app)
     bcrypt.init_app(app)
     migrate.init_app(app, db)
+    init_sqlite(app, db)
     # limiter.init_app(app)  # NEW
     # hf_limiter.init_app(app)  # NEW: Initialize the Hugging Face limiter
 
@@ -65,4 +78,23 @@ def create_app():
     # Import models here to ensure they are registered with SQLAlchemy
     from app import models  # <-- Add this line
 
+    # Select the current user's shard on each request (no-op without shards)
+    init_sharding(app, db)
+
+    # Keep the community mood index in step with entry scores
+    from app.community import init_mood_index
+    init_mood_index()
+
+    # New tags go straight into this process's autocomplete index
+    from app.tag_index import init_tag_index
+    init_tag_index()
+
+    # Compress responses (works with streamed pages too)
+    from app.compression import init_compression
+    init_compression(app)
+
+    # Register custom `flask` CLI commands
+    from app.commands import register_commands
+    register_commands(app)
+
     return app
\ No newline at end of file
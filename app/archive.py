@@ -0,0 +1,180 @@
+"""
+Cold storage for old entries.
+
+Archiving moves an entry's text into the archived_content table, zlib-compressed,
+and blanks the hot `entry.content` column. The entry row keeps its date, user,
+tags and emotion score, so every chart, filter and analytics query works as
+before - only reading the text goes through Entry.full_content.
+Editing an archived entry brings it back to the hot table.
+
+Searching archived text means decompressing it, so the matches for a search
+are kept for a few minutes per (user, text) and shared by every page of its
+results. The key also holds the size of the user's archive, so archiving or
+restoring entries starts a new search.
+"""
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from sqlalchemy import select, insert, update, false, func
+from app import db
+from app.models import Entry, ArchivedContent
+
+# Entries older than this are archived by `flask archive-entries` by default
+ARCHIVE_AFTER_DAYS = 365
+# Archived text is written once and read rarely, so spend the CPU on a better ratio
+ARCHIVE_COMPRESSION_LEVEL = 9
+ARCHIVE_CHUNK_SIZE = 500
+# Archived search keeps the newest matches up to this many, and stops reading there
+MAX_ARCHIVED_MATCHES = 1000
+# Memory bounds for cached archived searches
+MAX_CACHED_SEARCHES = 256
+ARCHIVED_SEARCH_TTL_SECONDS = 300
+
+
+def compress_content(content):
+    return zlib.compress(content.encode('utf-8'), ARCHIVE_COMPRESSION_LEVEL)
+
+
+def archive_candidates(before, user_id=None, after_id=0, limit=ARCHIVE_CHUNK_SIZE):
+    query = select(Entry.id, Entry.content)\
+        .where(Entry.archived == false(), Entry.date_created < before, Entry.id > after_id)
+    if user_id is not None:
+        query = query.where(Entry.user_id == user_id)
+    return query.order_by(Entry.id.asc()).limit(limit)
+
+
+def archive_entries(older_than_days=ARCHIVE_AFTER_DAYS, user_id=None, chunk_size=ARCHIVE_CHUNK_SIZE, echo=None):
+    """
+    Move the text of entries older than `older_than_days` into cold storage.
+    Works on the current shard; commits after every chunk so it can be stopped
+    and re-run at any time. Returns (entries archived, bytes before, bytes after).
+    """
+    before = datetime.utcnow() - timedelta(days=older_than_days)
+    archived = raw_size = stored_size = 0
+
+    while True:
+        # Lock the chunk so an edit can't change the text between copying and blanking it
+        rows = db.session.execute(
+            archive_candidates(before, user_id, limit=chunk_size).with_for_update()
+        ).all()
+        if not rows:
+            break
+
+        archive_rows = []
+        for row in rows:
+            data = compress_content(row.content)
+            size = len(row.content.encode('utf-8'))
+            archive_rows.append({
+                'entry_id': row.id,
+                'data': data,
+                'original_size': size,
+                'archived_at': datetime.utcnow(),
+            })
+            raw_size += size
+            stored_size += len(data)
+
+        ids = [row.id for row in rows]
+        db.session.execute(insert(ArchivedContent), archive_rows)
+        db.session.execute(
+            # Archiving isn't a change to the entry, so keep updated_at (and sync quiet)
+            update(Entry).where(Entry.id.in_(ids))
+            .values(content='', archived=True, updated_at=Entry.updated_at)
+        )
+        db.session.commit()
+
+        archived += len(rows)
+        if echo:
+            echo(f'Archived {archived} entries (last id {ids[-1]})')
+
+    return archived, raw_size, stored_size
+
+
+def restore_entry(entry):
+    """Bring an archived entry's text back into the hot table (caller commits)"""
+    if not entry.archived:
+        return
+    if entry.archive is not None:
+        entry.content = entry.archive.content
+        entry.archive = None  # delete-orphan removes the cold copy
+    entry.archived = False
+
+
+def archived_texts(entry_ids):
+    """Decompressed text for the given archived entries, keyed by entry id"""
+    if not entry_ids:
+        return {}
+    rows = db.session.execute(
+        select(ArchivedContent.entry_id, ArchivedContent.data)
+        .where(ArchivedContent.entry_id.in_(entry_ids))
+    ).all()
+    return {entry_id: zlib.decompress(data).decode('utf-8') for entry_id, data in rows}
+
+
+class ArchivedSearchCache:
+    """Recent archived searches' matching entry ids, expiring after a short TTL"""
+
+    def __init__(self, max_searches=MAX_CACHED_SEARCHES, ttl=ARCHIVED_SEARCH_TTL_SECONDS):
+        self.max_searches = max_searches
+        self.ttl = ttl
+        self.searches = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, search):
+        with self.lock:
+            cached = self.searches.get(key)
+            if cached is not None and time.monotonic() - cached[0] < self.ttl:
+                self.searches.move_to_end(key)
+                return cached[1]
+        matches = search()
+        with self.lock:
+            self.searches[key] = (time.monotonic(), matches)
+            self.searches.move_to_end(key)
+            while len(self.searches) > self.max_searches:
+                self.searches.popitem(last=False)
+        return matches
+
+
+archived_searches = ArchivedSearchCache()
+
+
+def archive_size(user_id):
+    """(entries, highest entry id) in the user's archive - changes whenever it does"""
+    return tuple(db.session.execute(
+        select(func.count(), func.max(ArchivedContent.entry_id))
+        .join(Entry, Entry.id == ArchivedContent.entry_id)
+        .where(Entry.user_id == user_id)
+    ).one())
+
+
+def search_archived(user_id, text, chunk_size=ARCHIVE_CHUNK_SIZE, limit=MAX_ARCHIVED_MATCHES):
+    """
+    Ids of the user's archived entries whose text contains `text` (case-insensitive),
+    newest first and at most `limit` of them.
+    Compressed text can't be searched in SQL, so this decompresses in chunks.
+    """
+    needle = text.casefold()
+    key = (user_id, needle, limit, archive_size(user_id))
+    return archived_searches.get(key, lambda: _scan_archive(user_id, needle, chunk_size, limit))
+
+
+def _scan_archive(user_id, needle, chunk_size, limit):
+    matches = []
+    before_id = None
+    while len(matches) < limit:
+        query = select(ArchivedContent.entry_id, ArchivedContent.data)\
+            .join(Entry, Entry.id == ArchivedContent.entry_id)\
+            .where(Entry.user_id == user_id)
+        if before_id is not None:
+            query = query.where(ArchivedContent.entry_id < before_id)
+        rows = db.session.execute(query.order_by(ArchivedContent.entry_id.desc()).limit(chunk_size)).all()
+        if not rows:
+            break
+        for entry_id, data in rows:
+            if needle in zlib.decompress(data).decode('utf-8').casefold():
+                matches.append(entry_id)
+                if len(matches) == limit:
+                    break
+        before_id = rows[-1].entry_id
+    return tuple(matches)
@@ -0,0 +1,141 @@
+from datetime import datetime
+from sqlalchemy import select, delete, insert, update, exists, true
+from app import db
+from app.models import User, UserShard, Entry, EntryChunk, EntryFeatures, EntryTombstone, ArchivedContent, Tag, entry_tag
+from app.snapshots import invalidate_snapshot
+from app.community import remove_scores, SCORE_COLUMNS
+from app.sync import record_deletions
+
+# How many entries each statement touches before we commit.
+# Keeps transactions (and lock times) short on large cleanups.
+BULK_CHUNK_SIZE = 500
+
+
+def _owned_ids(user_id, entry_ids=None, start=None, end=None, limit=BULK_CHUNK_SIZE, after_id=0):
+    """Select the next chunk of entry ids that belong to the user and match the filters"""
+    query = select(Entry.id).where(Entry.user_id == user_id, Entry.id > after_id)
+    if entry_ids is not None:
+        query = query.where(Entry.id.in_(entry_ids))
+    if start is not None:
+        query = query.where(Entry.date_created >= start)
+    if end is not None:
+        query = query.where(Entry.date_created <= end)
+    return db.session.execute(query.order_by(Entry.id.asc()).limit(limit)).scalars().all()
+
+
+def delete_entries(user_id, entry_ids=None, start=None, end=None, chunk_size=BULK_CHUNK_SIZE):
+    """
+    Delete the user's entries (optionally only the given ids and/or a date range)
+    along with their tag links, chunk scores, text features and archived text. Returns the number deleted.
+    """
+    deleted = 0
+    while True:
+        chunk = _owned_ids(user_id, entry_ids, start, end, chunk_size)
+        if not chunk:
+            break
+
+        # Core deletes skip the ORM events, so take the scores out of the mood index here
+        remove_scores(db.session, db.session.execute(
+            select(Entry.date_created, *SCORE_COLUMNS)
+            .where(Entry.id.in_(chunk), Entry.dominant_emotion.isnot(None))
+        ).all())
+
+        # Children first so foreign keys are never left dangling
+        db.session.execute(delete(entry_tag).where(entry_tag.c.entry_id.in_(chunk)))
+        db.session.execute(delete(EntryChunk).where(EntryChunk.entry_id.in_(chunk)))
+        db.session.execute(delete(EntryFeatures).where(EntryFeatures.entry_id.in_(chunk)))
+        db.session.execute(delete(ArchivedContent).where(ArchivedContent.entry_id.in_(chunk)))
+        result = db.session.execute(
+            delete(Entry).where(Entry.id.in_(chunk), Entry.user_id == user_id)
+        )
+        record_deletions(user_id, chunk)
+        db.session.commit()
+        deleted += result.rowcount
+
+    if deleted:
+        # Snapshot totals would still count the deleted entries
+        invalidate_snapshot(user_id)
+        db.session.commit()
+    return deleted
+
+
+def get_or_create_tags(tag_names):
+    """Return Tag objects for the given names, creating any that don't exist yet"""
+    names = sorted({name.strip().lower() for name in tag_names if name and name.strip()})
+    if not names:
+        return []
+
+    tags = Tag.query.filter(Tag.name.in_(names)).all()
+    existing = {tag.name for tag in tags}
+    for name in names:
+        if name not in existing:
+            tag = Tag(name=name)
+            db.session.add(tag)
+            tags.append(tag)
+    db.session.flush()
+    return tags
+
+
+def retag_entries(user_id, entry_ids, add_tags=(), remove_tags=(), replace=False, chunk_size=BULK_CHUNK_SIZE):
+    """
+    Add and/or remove tags on many of the user's entries at once.
+    With replace=True every existing tag is removed before adding.
+    Returns the number of entries touched.
+    """
+    add_ids = [tag.id for tag in get_or_create_tags(add_tags)]
+    remove_ids = [] if replace else [
+        tag.id for tag in Tag.query.filter(Tag.name.in_([name.strip().lower() for name in remove_tags])).all()
+    ]
+    db.session.commit()
+
+    touched = 0
+    after_id = 0
+    while True:
+        chunk = _owned_ids(user_id, entry_ids, limit=chunk_size, after_id=after_id)
+        if not chunk:
+            break
+        after_id = chunk[-1]
+
+        if replace:
+            db.session.execute(delete(entry_tag).where(entry_tag.c.entry_id.in_(chunk)))
+        elif remove_ids:
+            db.session.execute(
+                delete(entry_tag).where(entry_tag.c.entry_id.in_(chunk), entry_tag.c.tag_id.in_(remove_ids))
+            )
+
+        if add_ids:
+            # INSERT ... SELECT every (entry, tag) pair that isn't linked yet.
+            # Ownership is checked again in SQL via Entry.user_id.
+            already_linked = exists().where(
+                entry_tag.c.entry_id == Entry.id,
+                entry_tag.c.tag_id == Tag.id,
+            )
+            pairs = select(Entry.id, Tag.id)\
+                .select_from(Entry)\
+                .join(Tag, true())\
+                .where(Entry.id.in_(chunk),
+                       Entry.user_id == user_id,
+                       Tag.id.in_(add_ids),
+                       ~already_linked)
+            db.session.execute(insert(entry_tag).from_select(['entry_id', 'tag_id'], pairs))
+
+        # Tag links live in entry_tag, so mark the entries changed for sync
+        db.session.execute(update(Entry).where(Entry.id.in_(chunk), Entry.user_id == user_id)
+                           .values(updated_at=datetime.utcnow()))
+        db.session.commit()
+        touched += len(chunk)
+
+    return touched
+
+
+def delete_account(user_id, chunk_size=BULK_CHUNK_SIZE):
+    """Delete every entry the user owns, then the user. Tags are shared so they stay."""
+    deleted = delete_entries(user_id, chunk_size=chunk_size)
+    # Nobody is left to sync the deletions to
+    db.session.execute(delete(EntryTombstone).where(EntryTombstone.user_id == user_id))
+    invalidate_snapshot(user_id)
+    # The shard map row references the user, so it has to go in the same transaction
+    db.session.execute(delete(UserShard).where(UserShard.user_id == user_id))
+    db.session.execute(delete(User).where(User.id == user_id))
+    db.session.commit()
+    return deleted
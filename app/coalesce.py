@@ -0,0 +1,81 @@
+"""
+Request coalescing ("single flight").
+
+When several threads ask for the same work at once (a double-submitted form,
+the dashboard open in a few tabs, everyone reconnecting after an outage) only
+the first one runs it. The others wait for that call and get its result, or
+its exception. Nothing is kept afterwards: once the call finishes, the next
+caller starts a new one. That way results are never staler than the work
+itself, and no cache has to be invalidated.
+
+Work is keyed by (operation, user, hash of the input). Callers put whatever
+the result depends on into the input, e.g. the journal's last change time.
+"""
+import hashlib
+import threading
+
+# Seconds a caller waits for someone else's call before giving up
+DEFAULT_WAIT_SECONDS = 30
+
+
+class CoalesceTimeout(TimeoutError):
+    pass
+
+
+def input_hash(*parts):
+    """Stable digest of the input a result depends on"""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """At most one running call per key; concurrent callers with the key share it"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn, timeout=DEFAULT_WAIT_SECONDS):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+
+        if leader:
+            try:
+                call.result = fn()
+                return call.result
+            except BaseException as e:
+                call.error = e
+                raise
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call.done.set()
+
+        if not call.done.wait(timeout):
+            raise CoalesceTimeout(f'Gave up after {timeout}s waiting for {key[0]}')
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+
+flights = SingleFlight()
+
+
+def coalesce(operation, user_id, fn, *inputs, timeout=DEFAULT_WAIT_SECONDS):
+    """fn(), shared with any concurrent call for the same operation, user and inputs"""
+    return flights.do((operation, user_id, input_hash(*inputs)), fn, timeout)
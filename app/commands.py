@@ -0,0 +1,423 @@
+import json
+import os
+import time
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from werkzeug.serving import run_simple
+from sqlalchemy import select, or_, func, inspect
+from alembic import command as alembic_command
+from app import db
+from app.models import User, Entry, UserShard
+from app.utils import analyze_sentiment, analyze_entry, RateLimiter, score_fields, analysis_version, content_fingerprint
+from app.sharding import each_shard, shard_names, init_shard_tables, move_user, sharding_enabled, MOVE_SETTLE_SECONDS
+from app.inference_server import create_inference_app, StandInConfig, LATENCY_DISTRIBUTIONS
+from app.snapshots import invalidate_snapshot, snapshot_partitions, run_snapshots, start_of_today, SNAPSHOT_PARTITION_SIZE, SNAPSHOT_CHUNK_SIZE
+from app.similarity import build_text_features
+from app.sync import prune_tombstones, TOMBSTONE_RETENTION_DAYS
+from app.community import rebuild_mood_index, REBUILD_CHUNK_SIZE
+from app.archive import archive_entries, archive_candidates, archived_texts, ARCHIVE_AFTER_DAYS, ARCHIVE_CHUNK_SIZE
+
+
+def register_commands(app):
+    """Attach our custom `flask` CLI commands to the app"""
+    app.cli.add_command(backfill_scores)
+    app.cli.add_command(shards)
+    app.cli.add_command(archive_entries_command)
+    app.cli.add_command(inference_server)
+    app.cli.add_command(snapshot_insights)
+    app.cli.add_command(mood_index)
+    app.cli.add_command(prune_tombstones_command)
+    app.cli.add_command(text_features_command)
+
+
+def _new_checkpoint(version):
+    return {'last_entry_id': 0, 'updated': 0, 'failed': 0, 'analysis_version': version}
+
+
+def _load_checkpoint(path, version):
+    if os.path.exists(path):
+        with open(path) as f:
+            checkpoint = json.load(f)
+        # Progress made against another model says nothing about which entries are stale now
+        if checkpoint.get('analysis_version') == version:
+            return checkpoint
+    return _new_checkpoint(version)
+
+
+def _save_checkpoint(path, checkpoint):
+    # Write to a temp file first so a crash never leaves a half-written checkpoint
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+
+def missing_scores_query(after_id, limit, stale_model=False):
+    """
+    Entries that have not been analyzed yet.
+    With stale_model, also entries scored by any other model/version - including
+    old scores that never recorded one.
+    """
+    conditions = [Entry.dominant_emotion.is_(None)]
+    if stale_model:
+        conditions.append(Entry.model_version.is_(None))
+        conditions.append(Entry.model_version != analysis_version())
+
+    return select(Entry.id, Entry.content, Entry.archived)\
+        .where(or_(*conditions), Entry.id > after_id)\
+        .order_by(Entry.id.asc())\
+        .limit(limit)
+
+
+@click.command('backfill-scores')
+@click.option('--chunk-size', default=100, show_default=True, help='Entries processed and committed per batch.')
+@click.option('--workers', default=4, show_default=True, help='Concurrent analysis calls.')
+@click.option('--rate', default=5.0, show_default=True, help='Maximum analysis calls per second (0 for no limit).')
+@click.option('--checkpoint', 'checkpoint_path', default=None, help='Checkpoint file (defaults to the instance folder).')
+@click.option('--reset', is_flag=True, help='Ignore any saved checkpoint and start from the first entry.')
+@click.option('--stale-model', is_flag=True, help='Also re-analyze entries scored by an older model or analysis version.')
+@click.option('--dry-run', is_flag=True, help='Only count the entries that need analysis.')
+@with_appcontext
+def backfill_scores(chunk_size, workers, rate, checkpoint_path, reset, stale_model, dry_run):
+    """Analyze entries whose emotion scores are missing."""
+    if checkpoint_path is None:
+        os.makedirs(current_app.instance_path, exist_ok=True)
+        checkpoint_path = os.path.join(current_app.instance_path, 'backfill_checkpoint.json')
+
+    app = current_app._get_current_object()
+    limiter = RateLimiter(rate)
+
+    def limited_analysis(text):
+        limiter.wait()
+        return analyze_sentiment(text)
+
+    def analyze(content):
+        # Worker threads need their own app context for logging and config.
+        # Every API call is rate limited, including each chunk of a long entry.
+        with app.app_context():
+            return analyze_entry(content, limited_analysis)
+
+    # With sharding on, each shard is processed in turn with its own checkpoint
+    for shard in each_shard():
+        if shard is not None:
+            click.echo(f'Shard {shard}:')
+        shard_checkpoint_path = checkpoint_path if shard is None else f'{checkpoint_path}.{shard}'
+        if stale_model:
+            # Runs that skip different entries can't share a position
+            shard_checkpoint_path += '.stale-model'
+
+        if dry_run:
+            pending = db.session.execute(
+                select(func.count()).select_from(missing_scores_query(0, None, stale_model).subquery())
+            ).scalar()
+            click.echo(f'{pending} entries need analysis.')
+            continue
+
+        _backfill_shard(analyze, shard_checkpoint_path, chunk_size, workers, reset, stale_model)
+
+
+def _backfill_shard(analyze, checkpoint_path, chunk_size, workers, reset, stale_model):
+    # Stale runs depend on the current version; plain runs only on whether scores exist
+    version = analysis_version() if stale_model else None
+    checkpoint = _new_checkpoint(version) if reset else _load_checkpoint(checkpoint_path, version)
+    if checkpoint['last_entry_id']:
+        click.echo(f"Resuming after entry {checkpoint['last_entry_id']}")
+
+    started = time.monotonic()
+    processed = 0
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            rows = db.session.execute(missing_scores_query(checkpoint['last_entry_id'], chunk_size, stale_model)).all()
+            if not rows:
+                break
+
+            entry_ids = [row.id for row in rows]
+            # Archived entries keep their text in cold storage
+            cold = archived_texts([row.id for row in rows if row.archived])
+            texts = [cold.get(row.id, row.content) for row in rows]
+            results = list(executor.map(analyze, texts))
+
+            # Write the scores onto the entries, locked so an edit can't slip in before the commit
+            entries = {entry.id: entry for entry in Entry.query.filter(Entry.id.in_(entry_ids)).with_for_update()}
+            # Earliest rescored entry per user - their nightly snapshot may count the old scores
+            earliest = {}
+            for row, text, (emotion_scores, chunk_scores) in zip(rows, texts, results):
+                if not emotion_scores:
+                    checkpoint['failed'] += 1
+                    continue
+
+                entry = entries.get(row.id)
+                # Deleted, or edited (and re-analyzed by the edit) while we were analyzing the old text
+                if entry is None or content_fingerprint(entry.full_content) != content_fingerprint(text):
+                    continue
+                for field, value in score_fields(emotion_scores, text).items():
+                    setattr(entry, field, value)
+                entry.set_chunk_scores(chunk_scores)
+                earliest[entry.user_id] = min(entry.date_created, earliest.get(entry.user_id, entry.date_created))
+                checkpoint['updated'] += 1
+
+            for user_id, entry_date in earliest.items():
+                invalidate_snapshot(user_id, entry_date)
+            db.session.commit()
+
+            # Only move the checkpoint once the batch is safely committed
+            checkpoint['last_entry_id'] = entry_ids[-1]
+            _save_checkpoint(checkpoint_path, checkpoint)
+
+            processed += len(rows)
+            elapsed = time.monotonic() - started
+            click.echo(f"Processed {processed} entries (last id {entry_ids[-1]}, "
+                       f"{checkpoint['updated']} updated, {checkpoint['failed']} failed, "
+                       f"{processed / elapsed:.1f}/s)")
+
+    # The run reached the end - the next one starts from the first entry again,
+    # picking up failed entries and any whose scores were cleared since
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    click.echo(f"Backfill complete: {checkpoint['updated']} updated, {checkpoint['failed']} failed.")
+    if checkpoint['failed']:
+        click.echo('Run again to retry failed entries.')
+
+
+@click.command('archive-entries')
+@click.option('--older-than', 'older_than_days', type=int, default=None,
+              help=f'Archive entries older than this many days (default: ARCHIVE_AFTER_DAYS or {ARCHIVE_AFTER_DAYS}).')
+@click.option('--user', 'username', default=None, help='Only archive this user\'s entries.')
+@click.option('--chunk-size', default=ARCHIVE_CHUNK_SIZE, show_default=True, help='Entries archived and committed per batch.')
+@click.option('--dry-run', is_flag=True, help='Only count the entries that would be archived.')
+@with_appcontext
+def archive_entries_command(older_than_days, username, chunk_size, dry_run):
+    """Move the text of old entries into compressed cold storage."""
+    if older_than_days is None:
+        older_than_days = current_app.config.get('ARCHIVE_AFTER_DAYS', ARCHIVE_AFTER_DAYS)
+
+    user_id = None
+    if username is not None:
+        user = User.query.filter_by(username=username).first()
+        if user is None:
+            raise click.ClickException(f'No user named {username!r}.')
+        user_id = user.id
+
+    total = raw_total = stored_total = 0
+    for shard in each_shard():
+        if shard is not None:
+            click.echo(f'Shard {shard}:')
+
+        if dry_run:
+            before = datetime.utcnow() - timedelta(days=older_than_days)
+            pending = db.session.execute(
+                select(func.count()).select_from(archive_candidates(before, user_id, limit=None).subquery())
+            ).scalar()
+            click.echo(f'{pending} entries would be archived.')
+            continue
+
+        archived, raw_size, stored_size = archive_entries(older_than_days, user_id, chunk_size, echo=click.echo)
+        total += archived
+        raw_total += raw_size
+        stored_total += stored_size
+
+    if not dry_run:
+        ratio = f' ({raw_total} bytes of text stored in {stored_total})' if total else ''
+        click.echo(f'Archived {total} entries older than {older_than_days} days{ratio}.')
+
+
+@click.command('snapshot-insights')
+@click.option('--workers', default=os.cpu_count() or 1, show_default=True, help='Worker processes (1 runs in this process).')
+@click.option('--partition-size', default=SNAPSHOT_PARTITION_SIZE, show_default=True, help='Users per worker task.')
+@click.option('--chunk-size', default=SNAPSHOT_CHUNK_SIZE, show_default=True, help='Entries fetched per query.')
+@click.option('--user', 'username', default=None, help='Only snapshot this user.')
+@with_appcontext
+def snapshot_insights(workers, partition_size, chunk_size, username):
+    """Precompute every user's dashboard statistics (run nightly, e.g. from cron)."""
+    user_ids = None
+    if username is not None:
+        user = User.query.filter_by(username=username).first()
+        if user is None:
+            raise click.ClickException(f'No user named {username!r}.')
+        user_ids = [user.id]
+
+    # Snapshots cover everything before midnight UTC; the dashboard adds today's entries live
+    through = start_of_today()
+    partitions = snapshot_partitions(partition_size, user_ids)
+    click.echo(f'Snapshotting {sum(len(ids) for _, ids in partitions)} users through {through:%Y-%m-%d %H:%M} UTC '
+               f'in {len(partitions)} partitions with {workers} workers')
+
+    started = time.monotonic()
+    users, entries = run_snapshots(partitions, through, max(workers, 1), chunk_size, echo=click.echo)
+    click.echo(f'Done: {users} users, {entries} entries in {time.monotonic() - started:.1f}s.')
+
+
+@click.command('text-features')
+@click.option('--user', 'username', default=None, help='Only this user\'s entries.')
+@click.option('--chunk-size', default=1000, show_default=True, help='Entries processed and committed per batch.')
+@with_appcontext
+def text_features_command(username, chunk_size):
+    """Compute similar-entry features for entries written before they existed."""
+    user_id = None
+    if username is not None:
+        user = User.query.filter_by(username=username).first()
+        if user is None:
+            raise click.ClickException(f'No user named {username!r}.')
+        user_id = user.id
+    total = 0
+    for shard in each_shard():
+        total += build_text_features(user_id, chunk_size, echo=click.echo)
+    click.echo(f'Built features for {total} entries.')
+
+
+@click.command('prune-tombstones')
+@click.option('--older-than', 'older_than_days', default=TOMBSTONE_RETENTION_DAYS, show_default=True,
+              help='Remove deletion records older than this many days.')
+@with_appcontext
+def prune_tombstones_command(older_than_days):
+    """Forget old deletions. Sync clients that last synced before then start over."""
+    if older_than_days < TOMBSTONE_RETENTION_DAYS:
+        # Clients with a cursor younger than the retention period expect every deletion since
+        raise click.ClickException(f'--older-than must be at least {TOMBSTONE_RETENTION_DAYS} days.')
+    total = 0
+    for shard in each_shard():
+        total += prune_tombstones(older_than_days)
+    click.echo(f'Removed {total} tombstones older than {older_than_days} days.')
+
+
+@click.group('mood-index')
+def mood_index():
+    """Manage the community mood index."""
+
+
+@mood_index.command('rebuild')
+@click.option('--workers', default=os.cpu_count() or 1, show_default=True, help='Worker processes (1 runs in this process).')
+@click.option('--partitions', 'partitions_per_shard', default=None, type=int,
+              help='Id ranges per shard (defaults to --workers).')
+@click.option('--chunk-size', default=REBUILD_CHUNK_SIZE, show_default=True, help='Entries fetched per query.')
+@with_appcontext
+def rebuild_mood_index_command(workers, partitions_per_shard, chunk_size):
+    """Recompute every daily sketch from the stored scores (after a restore or migration)."""
+    started = time.monotonic()
+    days, entries = rebuild_mood_index(max(workers, 1), partitions_per_shard, chunk_size, echo=click.echo)
+    click.echo(f'Rebuilt {days} daily sketches from {entries} entries in {time.monotonic() - started:.1f}s.')
+
+
+@click.command('inference-server')
+@click.option('--host', default='127.0.0.1', show_default=True)
+@click.option('--port', default=5001, show_default=True)
+@click.option('--latency', 'latency_ms', default=80.0, show_default=True, help='Typical response time in ms.')
+@click.option('--jitter', 'jitter_ms', default=20.0, show_default=True, help='Latency spread in ms.')
+@click.option('--distribution', type=click.Choice(LATENCY_DISTRIBUTIONS), default='normal', show_default=True)
+@click.option('--rate-limit-rate', default=0.0, show_default=True, help='Fraction of requests answered with 429.')
+@click.option('--loading-rate', default=0.0, show_default=True, help='Fraction of requests answered with 503 "loading".')
+@click.option('--timeout-rate', default=0.0, show_default=True, help='Fraction of requests that hang for --hang seconds.')
+@click.option('--hang', 'hang_seconds', default=60.0, show_default=True, help='How long a hung request waits.')
+@click.option('--warmup', 'warmup_seconds', default=0.0, show_default=True, help='Answer 503 "loading" for this long after start.')
+@click.option('--seed', default=0, show_default=True, help='Seed for latency and fault injection.')
+def inference_server(host, port, **options):
+    """Run a local stand-in for the Hugging Face inference API."""
+    config = StandInConfig(**options)
+    click.echo(f'Serving fake inference API on http://{host}:{port}/models/<model>')
+    click.echo(f'Point the app at it with SENTIMENT_API_URL=http://{host}:{port}/models')
+    # app.run() refuses to start inside a `flask` command, so use Werkzeug directly
+    run_simple(host, port, create_inference_app(config), threaded=True)
+
+
+@click.group('shards')
+def shards():
+    """Manage user-keyed database shards."""
+
+
+def _require_sharding():
+    if not sharding_enabled():
+        raise click.ClickException('Sharding is not configured. Set SHARD_DATABASE_URLS first.')
+
+
+def _shard_migration_config(name):
+    """Alembic config that points migrations/env.py at one shard"""
+    return current_app.extensions['migrate'].migrate.get_config(x_arg=[f'shard={name}'])
+
+
+def _shard_databases():
+    """{shard name: engine} for the shards that are not the global database"""
+    return {name: db.engines[bind_key] for name, bind_key in current_app.config['SHARDS'].items()
+            if bind_key is not None}
+
+
+@shards.command('init')
+@with_appcontext
+def init_shards():
+    """Create the journal tables on every shard and sync the tag catalog."""
+    _require_sharding()
+    new = [name for name, engine in _shard_databases().items() if not inspect(engine).get_table_names()]
+    init_shard_tables(db)
+    # Tables created from the current models are at the latest revision
+    for name in new:
+        alembic_command.stamp(_shard_migration_config(name), 'heads')
+    click.echo(f"Initialized shards: {', '.join(shard_names())}")
+
+
+@shards.command('upgrade')
+@click.option('--revision', default='head', show_default=True, help='Revision to upgrade to.')
+@with_appcontext
+def upgrade_shards(revision):
+    """Run the database migrations on every shard database (after `flask db upgrade`)."""
+    _require_sharding()
+    for name, engine in _shard_databases().items():
+        if not inspect(engine).has_table('alembic_version'):
+            raise click.ClickException(
+                f'{name} has no migration history. Run `flask shards stamp {name} REVISION` with the '
+                'revision the database was at when the shard was initialized, then upgrade again.')
+        click.echo(f'Upgrading {name}...')
+        alembic_command.upgrade(_shard_migration_config(name), revision)
+
+
+@shards.command('stamp')
+@click.argument('shard')
+@click.argument('revision')
+@with_appcontext
+def stamp_shard(shard, revision):
+    """Record that SHARD's schema is at REVISION without running migrations."""
+    _require_sharding()
+    if shard not in _shard_databases():
+        raise click.ClickException(f'{shard!r} is not a separate shard database.')
+    alembic_command.stamp(_shard_migration_config(shard), revision)
+
+
+@shards.command('list')
+@with_appcontext
+def list_shards():
+    """Show how many users and entries each shard holds."""
+    _require_sharding()
+    mapped = dict(db.session.execute(
+        select(UserShard.shard, func.count()).group_by(UserShard.shard)
+    ).all())
+    unmapped = db.session.execute(
+        select(func.count(User.id)).outerjoin(UserShard, UserShard.user_id == User.id)
+        .where(UserShard.user_id.is_(None))
+    ).scalar()
+
+    for shard in each_shard():
+        users = mapped.get(shard, 0) + (unmapped if shard == shard_names()[0] else 0)
+        entries = db.session.execute(select(func.count(Entry.id))).scalar()
+        click.echo(f'{shard}: {users} users, {entries} entries')
+
+
+@shards.command('move-user')
+@click.argument('username')
+@click.argument('target')
+@click.option('--chunk-size', default=500, show_default=True, help='Entries copied per batch.')
+@click.option('--settle-seconds', default=MOVE_SETTLE_SECONDS, show_default=True,
+              help='How long to wait for writes in progress once new writes are blocked.')
+@with_appcontext
+def move_user_command(username, target, chunk_size, settle_seconds):
+    """Move USERNAME's journal to the TARGET shard while they stay online."""
+    _require_sharding()
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.ClickException(f'No user named {username!r}.')
+    try:
+        move_user(db, user.id, target, chunk_size=chunk_size, settle_seconds=settle_seconds, echo=click.echo)
+    except ValueError as e:
+        raise click.ClickException(str(e))
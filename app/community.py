@@ -0,0 +1,313 @@
+"""
+Community mood index: anonymous, platform-wide emotion statistics.
+
+Every day gets one sketch: a fixed-bin histogram of each emotion's scores plus
+exact sums for the mean. Scores are in [0, 1], so SKETCH_BINS bins give
+percentiles to within half a bin. Sketches merge by adding them, so a week is
+the sum of its days, and they can be updated incrementally: whenever an
+entry's scores are written, changed or deleted, the old vector is subtracted
+from its day's sketch and the new one added. Memory is fixed per day no matter
+how many entries there are. Until the first rebuild, days that predate the
+index only reflect what was written since; removals are clamped so they
+never push a day below zero.
+
+`flask mood-index rebuild` recomputes every sketch from scratch in parallel
+partitions (per shard and id range), each streaming its entries in chunks.
+"""
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
+import numpy as np
+from sqlalchemy import select, insert, delete, func, event, inspect
+from sqlalchemy.exc import IntegrityError
+from app import db
+from app.models import Entry, MoodSketch
+from app.utils import EMOTION_LABELS, decode_scores
+from app.sharding import ShardedSession, each_shard, use_shard
+
+SKETCH_BINS = 100
+# Periods with fewer analyzed entries than this are not shown, to keep the index anonymous
+COMMUNITY_MIN_ENTRIES = 5
+DEFAULT_PERCENTILES = [10, 25, 50, 75, 90]
+MAX_DAYS = 366
+REBUILD_CHUNK_SIZE = 5000
+
+# Score columns in sketch order
+SCORE_COLUMNS = [getattr(Entry, label) for label in EMOTION_LABELS]
+
+
+class Sketch:
+    """Histogram of every emotion's scores for a set of entries, plus sums for exact means"""
+
+    def __init__(self, entries=0, sums=None, counts=None):
+        self.entries = entries
+        self.sums = np.zeros(len(EMOTION_LABELS)) if sums is None else sums
+        self.counts = np.zeros((len(EMOTION_LABELS), SKETCH_BINS), dtype=np.int64) if counts is None else counts
+
+    def add(self, scores, sign=1):
+        """Add (or with sign=-1, remove) an (n, n_labels) score matrix. NaN (missing) values are skipped."""
+        scores = np.atleast_2d(np.asarray(scores, dtype=np.float64))
+        if not len(scores):
+            return self
+        present = ~np.isnan(scores)
+        bins = np.clip((np.nan_to_num(scores) * SKETCH_BINS).astype(np.int64), 0, SKETCH_BINS - 1)
+        label_index = np.broadcast_to(np.arange(len(EMOTION_LABELS)), scores.shape)
+        np.add.at(self.counts, (label_index[present], bins[present]), sign)
+        self.sums += sign * np.nan_to_num(scores).sum(axis=0)
+        self.entries += sign * len(scores)
+        return self
+
+    def merge(self, other):
+        self.entries += other.entries
+        self.sums = self.sums + other.sums
+        self.counts = self.counts + other.counts
+        return self
+
+    def clamped(self):
+        """
+        Counts and sums never below zero. Removing an entry the index never counted
+        (one written before the first rebuild) would otherwise underflow the stored bins.
+        """
+        return Sketch(max(self.entries, 0), np.maximum(self.sums, 0.0), np.maximum(self.counts, 0))
+
+    def means(self):
+        totals = self.counts.sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(totals > 0, self.sums / totals, np.nan)
+
+    def percentiles(self, qs):
+        """(len(qs), n_labels) array of percentiles, interpolating linearly inside each bin"""
+        totals = self.counts.sum(axis=1)
+        cumulative = np.cumsum(self.counts, axis=1)
+        result = np.full((len(qs), len(EMOTION_LABELS)), np.nan)
+        for i, q in enumerate(qs):
+            target = totals * q / 100.0
+            for label in np.flatnonzero(totals):
+                bin_index = min(int(np.searchsorted(cumulative[label], target[label], side='left')), SKETCH_BINS - 1)
+                below = cumulative[label, bin_index - 1] if bin_index else 0
+                in_bin = self.counts[label, bin_index]
+                fraction = (target[label] - below) / in_bin if in_bin else 0.0
+                result[i, label] = (bin_index + min(max(fraction, 0.0), 1.0)) / SKETCH_BINS
+        return result
+
+    # Stored as little-endian bytes so the rows are compact and portable
+    def to_fields(self):
+        return {
+            'entries': int(self.entries),
+            'sums': self.sums.astype('<f8').tobytes(),
+            'histogram': self.counts.astype('<u4').tobytes(),
+        }
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(row.entries,
+                   np.frombuffer(row.sums, dtype='<f8').astype(np.float64),
+                   np.frombuffer(row.histogram, dtype='<u4').astype(np.int64)
+                   .reshape(len(EMOTION_LABELS), SKETCH_BINS))
+
+
+def _as_date(value):
+    return value.date() if hasattr(value, 'date') else value
+
+
+def _locked_sketch_row(session, day):
+    """The day's sketch row, locked until the transaction ends. An empty one is created if missing."""
+    with session.no_autoflush:
+        # A plain read first: on MySQL, locking a row that doesn't exist takes a gap lock,
+        # and two sessions holding one while both insert the day deadlock
+        exists = session.execute(select(MoodSketch.day).where(MoodSketch.day == day)).first()
+        if exists is None:
+            # A savepoint on the connection: rolling back a session savepoint would
+            # also drop the entries this flush is about to write
+            connection = session.connection(bind_arguments={'mapper': inspect(MoodSketch)})
+            try:
+                with connection.begin_nested():
+                    connection.execute(insert(MoodSketch).values(day=day, **Sketch().to_fields()))
+            except IntegrityError:
+                pass  # another session created the day first
+        return session.execute(
+            select(MoodSketch).where(MoodSketch.day == day).with_for_update()
+        ).scalar_one()
+
+
+def apply_sketch_deltas(session, deltas):
+    """Merge {day: Sketch} deltas into the stored daily sketches"""
+    for day in sorted(deltas):
+        row = _locked_sketch_row(session, day)
+        sketch = Sketch.from_row(row).merge(deltas[day]).clamped()
+        for field, value in sketch.to_fields().items():
+            setattr(row, field, value)
+
+
+def remove_scores(session, rows):
+    """Take deleted entries out of the index. rows: (date_created, *EMOTION_LABELS) of analyzed entries."""
+    deltas = {}
+    for row in rows:
+        deltas.setdefault(_as_date(row[0]), Sketch()).add(decode_scores([row[1:]], dtype=np.float64), -1)
+    if deltas:
+        apply_sketch_deltas(session, deltas)
+
+
+def _score_vector(entry, old=False):
+    """The entry's scores as a list (None for missing), optionally as they were before this flush"""
+    state = inspect(entry)
+    values = []
+    for label in EMOTION_LABELS + ['dominant_emotion']:
+        if old:
+            history = state.attrs[label].history
+            value = history.deleted[0] if history.deleted else (history.unchanged[0] if history.unchanged else None)
+        else:
+            value = getattr(entry, label)
+        values.append(value)
+    *scores, dominant = values
+    return scores if dominant is not None else None
+
+
+def _track_score_changes(session, flush_context, instances):
+    """Keep the daily sketches in step with entry scores written through the ORM"""
+    deltas = {}
+
+    def change(entry, scores, sign):
+        if scores is not None:
+            # New entries get their date_created default only at INSERT, after this hook
+            day = _as_date(entry.date_created or datetime.utcnow())
+            deltas.setdefault(day, Sketch()).add(decode_scores([scores], dtype=np.float64), sign)
+
+    for obj in session.new:
+        if isinstance(obj, Entry):
+            change(obj, _score_vector(obj), 1)
+    for obj in session.dirty:
+        if isinstance(obj, Entry) and session.is_modified(obj):
+            state = inspect(obj)
+            if any(state.attrs[label].history.has_changes() for label in EMOTION_LABELS + ['dominant_emotion']):
+                change(obj, _score_vector(obj, old=True), -1)
+                change(obj, _score_vector(obj), 1)
+    for obj in session.deleted:
+        if isinstance(obj, Entry):
+            change(obj, _score_vector(obj, old=True), -1)
+
+    if deltas:
+        apply_sketch_deltas(session, deltas)
+
+
+def init_mood_index():
+    if not event.contains(ShardedSession, 'before_flush', _track_score_changes):
+        event.listen(ShardedSession, 'before_flush', _track_score_changes)
+
+
+def community_mood(period='day', days=30, percentiles=DEFAULT_PERCENTILES, today=None):
+    """Daily or weekly (Monday start) means and percentiles across every user"""
+    # Entries are stamped in UTC
+    today = today or datetime.utcnow().date()
+    start = today - timedelta(days=days - 1)
+    rows = db.session.execute(
+        select(MoodSketch).where(MoodSketch.day >= start, MoodSketch.day <= today).order_by(MoodSketch.day)
+    ).scalars().all()
+
+    periods = {}
+    for row in rows:
+        key = row.day - timedelta(days=row.day.weekday()) if period == 'week' else row.day
+        periods.setdefault(key, Sketch()).merge(Sketch.from_row(row))
+
+    results = []
+    for key in sorted(periods):
+        sketch = periods[key]
+        if sketch.entries < COMMUNITY_MIN_ENTRIES:
+            continue
+        means = sketch.means()
+        values = sketch.percentiles(percentiles)
+        results.append({
+            'start': key.isoformat(),
+            'entries': int(sketch.entries),
+            'emotions': {
+                label: {
+                    'mean': round(float(means[i]) * 100, 1) if np.isfinite(means[i]) else None,
+                    'percentiles': {str(q): round(float(values[j, i]) * 100, 1) if np.isfinite(values[j, i]) else None
+                                    for j, q in enumerate(percentiles)},
+                }
+                for i, label in enumerate(EMOTION_LABELS)
+            },
+        })
+    return {'period': period, 'days': days, 'min_entries': COMMUNITY_MIN_ENTRIES, 'periods': results}
+
+
+# --- Rebuilding every sketch from the entries ---
+
+def sketch_range(low_id, high_id, chunk_size=REBUILD_CHUNK_SIZE):
+    """{day: Sketch} for analyzed entries with low_id <= id < high_id on the current shard"""
+    sketches = {}
+    after_id = low_id - 1
+    while True:
+        rows = db.session.execute(
+            select(Entry.id, Entry.date_created, *SCORE_COLUMNS)
+            .where(Entry.id > after_id, Entry.id < high_id, Entry.dominant_emotion.isnot(None))
+            .order_by(Entry.id).limit(chunk_size)
+        ).all()
+        if not rows:
+            return sketches
+        after_id = rows[-1][0]
+        days = np.array([row[1] for row in rows], dtype='datetime64[D]')
+        scores = decode_scores([row[2:] for row in rows], dtype=np.float64)
+        for day in np.unique(days):
+            sketches.setdefault(day.item(), Sketch()).add(scores[days == day])
+
+
+def rebuild_partitions(partitions_per_shard):
+    """(shard, low id, high id) ranges covering every shard's entries"""
+    partitions = []
+    for shard in each_shard():
+        low, high = db.session.execute(select(func.min(Entry.id), func.max(Entry.id))).one()
+        if low is None:
+            continue
+        step = max((high - low + 1) // partitions_per_shard + 1, 1)
+        for start in range(low, high + 1, step):
+            partitions.append((shard, start, min(start + step, high + 1)))
+    return partitions
+
+
+_worker_app = None
+
+
+def _init_worker():
+    global _worker_app
+    from app import create_app
+    _worker_app = create_app()
+
+
+def _sketch_partition(shard, low_id, high_id, chunk_size):
+    with _worker_app.app_context():
+        with use_shard(shard):
+            sketches = sketch_range(low_id, high_id, chunk_size)
+    # Plain values cross the process boundary cheaply
+    return {day: (s.entries, s.sums, s.counts) for day, s in sketches.items()}
+
+
+def rebuild_mood_index(workers, partitions_per_shard=None, chunk_size=REBUILD_CHUNK_SIZE, echo=print):
+    """Recompute every daily sketch from the entries. Returns (days, entries)."""
+    partitions = rebuild_partitions(partitions_per_shard or max(workers, 1))
+    merged = {}
+    started = time.monotonic()
+
+    def collect(result, done):
+        for day, (entries, sums, counts) in result.items():
+            merged.setdefault(day, Sketch()).merge(Sketch(entries, sums, counts))
+        echo(f'{done}/{len(partitions)} partitions ({time.monotonic() - started:.1f}s)')
+
+    if workers == 1:
+        for done, (shard, low_id, high_id) in enumerate(partitions, 1):
+            with use_shard(shard):
+                sketches = sketch_range(low_id, high_id, chunk_size)
+            collect({day: (s.entries, s.sums, s.counts) for day, s in sketches.items()}, done)
+    else:
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker) as executor:
+            futures = [executor.submit(_sketch_partition, *partition, chunk_size) for partition in partitions]
+            for done, future in enumerate(as_completed(futures), 1):
+                collect(future.result(), done)
+
+    db.session.execute(delete(MoodSketch))
+    for day, sketch in merged.items():
+        db.session.add(MoodSketch(day=day, **sketch.to_fields()))
+    db.session.commit()
+    return len(merged), sum(int(s.entries) for s in merged.values())
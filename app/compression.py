@@ -0,0 +1,84 @@
+import zlib
+from flask import request
+
+# Brotli is in requirements.txt; an install without it falls back to gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = {
+    'text/html',
+    'text/css',
+    'text/csv',
+    'text/plain',
+    'text/javascript',
+    'application/javascript',
+    'application/json',
+    'image/svg+xml',
+}
+
+
+def init_compression(app):
+    """Compress responses for clients that accept gzip or brotli"""
+    app.config.setdefault('COMPRESS_MIN_SIZE', 500)  # bytes; smaller bodies aren't worth it
+    app.config.setdefault('COMPRESS_LEVEL', 6)
+    app.config.setdefault('COMPRESS_BROTLI_QUALITY', 5)
+
+    @app.after_request
+    def compress_response(response):
+        return compress(response, app.config)
+
+
+def _choose_encoding():
+    offers = ['br', 'gzip'] if brotli is not None else ['gzip']
+    return request.accept_encodings.best_match(offers)
+
+
+def _compressor(encoding, config):
+    """Return (compress_chunk, finish) functions for the chosen encoding"""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=config['COMPRESS_BROTLI_QUALITY'])
+        return (lambda data: compressor.process(data) + compressor.flush()), compressor.finish
+
+    # wbits=31 writes a gzip header and trailer
+    compressor = zlib.compressobj(config['COMPRESS_LEVEL'], zlib.DEFLATED, 31)
+    return (lambda data: compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)), compressor.flush
+
+
+def compress(response, config):
+    response.vary.add('Accept-Encoding')
+
+    if (response.status_code < 200
+            or response.status_code in (204, 304)
+            or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+
+    encoding = _choose_encoding()
+    if encoding is None:
+        return response
+
+    compress_chunk, finish = _compressor(encoding, config)
+
+    if response.is_streamed:
+        # Flush after every chunk so streamed pages still arrive progressively
+        body = response.iter_encoded()
+
+        def generate():
+            for chunk in body:
+                if chunk:
+                    yield compress_chunk(chunk)
+            yield finish()
+
+        response.response = generate()
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < config['COMPRESS_MIN_SIZE']:
+            return response
+        response.set_data(compress_chunk(data) + finish())
+
+    response.headers['Content-Encoding'] = encoding
+    return response
@@ -0,0 +1,130 @@
+"""
+Local stand-in for the Hugging Face inference API.
+
+Serves POST /models/<model> with the same request and response shape as the
+hosted API, so anything that calls analyze_sentiment can be load-tested and
+benchmarked offline. Scores are a deterministic function of the model name and
+input text. Latency, 429 rate limits, 503 "model loading" responses and hung
+requests can be injected at configurable rates.
+
+Start it with `flask inference-server` and set
+SENTIMENT_API_URL=http://127.0.0.1:5001/models for the app.
+"""
+import hashlib
+import math
+import random
+import threading
+import time
+from dataclasses import dataclass
+from flask import Flask, request, jsonify
+from app.utils import EMOTION_LABELS
+
+LATENCY_DISTRIBUTIONS = ['fixed', 'uniform', 'normal', 'lognormal']
+
+
+@dataclass
+class StandInConfig:
+    # Mean response time in milliseconds and how much it varies (meaning depends on the distribution)
+    latency_ms: float = 80.0
+    jitter_ms: float = 20.0
+    distribution: str = 'normal'
+    # Fraction of requests answered with 429 / 503, or held until the client times out
+    rate_limit_rate: float = 0.0
+    loading_rate: float = 0.0
+    timeout_rate: float = 0.0
+    # How long a "timed out" request hangs before answering
+    hang_seconds: float = 60.0
+    # Every request gets a 503 "loading" response for this many seconds after start-up
+    warmup_seconds: float = 0.0
+    # Seed for latency and fault injection (scores are always deterministic)
+    seed: int = 0
+
+
+def deterministic_scores(model, text):
+    """The same model and text always give the same scores, sorted like the real API"""
+    digest = hashlib.sha256(f'{model}\0{text}'.encode('utf-8')).digest()
+    logits = [digest[i] / 255.0 * 4.0 for i in range(len(EMOTION_LABELS))]
+    total = sum(math.exp(logit) for logit in logits)
+    scores = [
+        {'label': label, 'score': math.exp(logit) / total}
+        for label, logit in zip(EMOTION_LABELS, logits)
+    ]
+    return sorted(scores, key=lambda s: s['score'], reverse=True)
+
+
+class FaultInjector:
+    """Draws latencies and failures from one seeded generator, safely across threads"""
+
+    def __init__(self, config):
+        self.config = config
+        self.random = random.Random(config.seed)
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+
+    def latency(self):
+        config = self.config
+        with self.lock:
+            if config.distribution == 'fixed':
+                value = config.latency_ms
+            elif config.distribution == 'uniform':
+                value = self.random.uniform(config.latency_ms - config.jitter_ms,
+                                            config.latency_ms + config.jitter_ms)
+            elif config.distribution == 'lognormal':
+                # latency_ms is the median, jitter_ms / latency_ms the spread (sigma)
+                sigma = config.jitter_ms / config.latency_ms if config.latency_ms else 0.0
+                value = config.latency_ms * self.random.lognormvariate(0.0, sigma)
+            else:
+                value = self.random.gauss(config.latency_ms, config.jitter_ms)
+        return max(value, 0.0) / 1000.0
+
+    def fault(self):
+        """None, or one of 'warmup', 'rate_limit', 'loading', 'timeout'"""
+        config = self.config
+        if time.monotonic() - self.started < config.warmup_seconds:
+            return 'warmup'
+        with self.lock:
+            roll = self.random.random()
+        for fault, rate in (('rate_limit', config.rate_limit_rate),
+                            ('loading', config.loading_rate),
+                            ('timeout', config.timeout_rate)):
+            if roll < rate:
+                return fault
+            roll -= rate
+        return None
+
+
+def create_inference_app(config=None):
+    config = config or StandInConfig()
+    injector = FaultInjector(config)
+    app = Flask(__name__)
+    app.config['STAND_IN'] = config
+
+    @app.route('/models/<path:model>', methods=['POST'])
+    def infer(model):
+        payload = request.get_json(silent=True) or {}
+        inputs = payload.get('inputs')
+        if not isinstance(inputs, (str, list)) or not inputs:
+            return jsonify({'error': 'Missing or invalid "inputs"'}), 400
+
+        fault = injector.fault()
+        if fault in ('warmup', 'loading'):
+            remaining = config.warmup_seconds - (time.monotonic() - injector.started)
+            return jsonify({
+                'error': f'Model {model} is currently loading',
+                'estimated_time': round(max(remaining, 1.0), 1),
+            }), 503
+        if fault == 'rate_limit':
+            response = jsonify({'error': 'Rate limit reached. Please slow down.'})
+            response.headers['Retry-After'] = '1'
+            return response, 429
+        if fault == 'timeout':
+            time.sleep(config.hang_seconds)
+            return jsonify({'error': 'Request timed out'}), 504
+
+        time.sleep(injector.latency())
+
+        # A single string gets a one-element batch back, just like the hosted API
+        texts = [inputs] if isinstance(inputs, str) else inputs
+        return jsonify([deterministic_scores(model, str(text)) for text in texts])
+
+    return app
@@ -0,0 +1,235 @@
+import math
+from collections import namedtuple
+from datetime import datetime, timezone
+import numpy as np
+from sqlalchemy import select
+from app import db
+from app.models import Entry, Tag, entry_tag
+from app.utils import EMOTIONS, decode_scores
+
+WEEKDAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+# Window (in journaling days) for rolling statistics
+ROLLING_WINDOW = 7
+# How many days of rolling statistics to return
+ROLLING_HISTORY = 90
+# Tags need this many entries before we report them as significant
+MIN_TAG_ENTRIES = 5
+SIGNIFICANCE_LEVEL = 0.05
+
+# Everything the insights need, loaded once per request
+# days:   int64 days since the epoch for each entry (sorted ascending)
+# scores: (n_entries, n_emotions) float64 emotion scores
+# pair_rows / pair_tags: entry row index and tag column index for each entry_tag link
+# tag_ids: tag id for each tag column
+EmotionMatrix = namedtuple('EmotionMatrix', ['days', 'scores', 'pair_rows', 'pair_tags', 'tag_ids'])
+
+
+def load_emotion_matrix(user_id):
+    """Load a user's (date, tag ids, emotion vector) data into NumPy arrays"""
+    # Plain column selects from the entry table alone - no ORM objects, no join
+    rows = db.session.execute(
+        select(Entry.id, Entry.date_created, *[getattr(Entry, e) for e in EMOTIONS])
+        .where(Entry.user_id == user_id, Entry.dominant_emotion.isnot(None))
+        .order_by(Entry.date_created.asc())
+    ).all()
+
+    if not rows:
+        empty = np.empty(0, dtype=np.int64)
+        return EmotionMatrix(empty, np.empty((0, len(EMOTIONS))), empty, empty, empty)
+
+    columns = list(zip(*rows))
+    entry_ids = np.array(columns[0], dtype=np.int64)
+    days = np.array(columns[1], dtype='datetime64[D]').astype(np.int64)
+    scores = decode_scores([row[2:] for row in rows], len(EMOTIONS), np.float64)
+    np.nan_to_num(scores, copy=False)
+
+    pairs = db.session.execute(
+        select(entry_tag.c.entry_id, entry_tag.c.tag_id)
+        .join(Entry, Entry.id == entry_tag.c.entry_id)
+        .where(Entry.user_id == user_id)
+    ).all()
+
+    if pairs:
+        pair_entries, pair_tag_ids = (np.array(c, dtype=np.int64) for c in zip(*pairs))
+
+        # Map entry ids to row numbers, dropping links to entries without scores
+        order = np.argsort(entry_ids)
+        position = np.searchsorted(entry_ids, pair_entries, sorter=order)
+        position = np.minimum(position, len(entry_ids) - 1)
+        found = entry_ids[order[position]] == pair_entries
+        pair_rows = order[position[found]]
+
+        tag_ids, pair_tags = np.unique(pair_tag_ids[found], return_inverse=True)
+    else:
+        pair_rows = pair_tags = tag_ids = np.empty(0, dtype=np.int64)
+
+    return EmotionMatrix(days, scores, pair_rows, pair_tags, tag_ids)
+
+
+def daily_means(matrix):
+    """Collapse entries into one mean emotion vector per journaling day"""
+    unique_days, inverse, counts = np.unique(matrix.days, return_inverse=True, return_counts=True)
+    sums = np.zeros((len(unique_days), len(EMOTIONS)))
+    np.add.at(sums, inverse, matrix.scores)
+    return unique_days, sums / counts[:, None]
+
+
+def _runs(days, labels=None):
+    """Split days into runs of consecutive days (and equal labels, if given)"""
+    breaks = np.diff(days) != 1
+    if labels is not None:
+        breaks |= labels[1:] != labels[:-1]
+    starts = np.flatnonzero(np.r_[True, breaks])
+    lengths = np.diff(np.r_[starts, len(days)])
+    return starts, lengths
+
+
+def calculate_streaks(days, means, today):
+    """Journaling streaks plus the longest run of days dominated by each emotion"""
+    streaks = {'current': 0, 'longest': 0, 'mood': {}, 'current_mood': None}
+    if len(days) == 0:
+        return streaks
+
+    starts, lengths = _runs(days)
+    streaks['longest'] = int(lengths.max())
+    # The current streak is still alive if the user wrote today or yesterday
+    if days[-1] >= today - 1:
+        streaks['current'] = int(lengths[-1])
+
+    dominant = means.argmax(axis=1)
+    mood_starts, mood_lengths = _runs(days, dominant)
+    longest = np.zeros(len(EMOTIONS), dtype=np.int64)
+    np.maximum.at(longest, dominant[mood_starts], mood_lengths)
+    streaks['mood'] = {emotion: int(longest[i]) for i, emotion in enumerate(EMOTIONS)}
+
+    if days[-1] >= today - 1:
+        streaks['current_mood'] = {
+            'emotion': EMOTIONS[dominant[-1]],
+            'days': int(mood_lengths[-1]),
+        }
+    return streaks
+
+
+def rolling_stats(days, means, window=ROLLING_WINDOW, history=ROLLING_HISTORY):
+    """Trailing rolling mean and variance of daily emotion means"""
+    if len(days) == 0:
+        return {'dates': [], 'mean': {}, 'variance': {}}
+
+    total = np.cumsum(means, axis=0)
+    total_sq = np.cumsum(means ** 2, axis=0)
+    count = np.arange(1, len(days) + 1, dtype=np.float64)
+
+    total[window:] = total[window:] - total[:-window]
+    total_sq[window:] = total_sq[window:] - total_sq[:-window]
+    count[window:] = window
+
+    mean = total / count[:, None]
+    variance = np.maximum(total_sq / count[:, None] - mean ** 2, 0.0)
+
+    # Only the most recent days are interesting for display
+    recent = slice(max(0, len(days) - history), len(days))
+    return {
+        'window': window,
+        'dates': days[recent].astype('datetime64[D]').astype(str).tolist(),
+        'mean': {e: np.round(mean[recent, i] * 100, 1).tolist() for i, e in enumerate(EMOTIONS)},
+        # Variance in percentage points squared
+        'variance': {e: np.round(variance[recent, i] * 10000, 1).tolist() for i, e in enumerate(EMOTIONS)},
+    }
+
+
+def weekday_patterns(matrix):
+    """Average emotion scores for each day of the week"""
+    # 1970-01-01 was a Thursday, so (days + 3) % 7 gives Monday == 0
+    weekdays = (matrix.days + 3) % 7
+    counts = np.bincount(weekdays, minlength=7)
+    sums = np.zeros((7, len(EMOTIONS)))
+    np.add.at(sums, weekdays, matrix.scores)
+
+    patterns = []
+    for day in range(7):
+        row = {'day': WEEKDAYS[day], 'entries': int(counts[day])}
+        for i, emotion in enumerate(EMOTIONS):
+            row[emotion] = round(float(sums[day, i] / counts[day]) * 100, 1) if counts[day] else None
+        patterns.append(row)
+    return patterns
+
+
+def tag_emotion_deltas(matrix):
+    """
+    For each tag, compare average emotions of tagged vs untagged entries.
+    Uses Welch's t statistic with a normal approximation for the p-value,
+    which is reasonable at the entry counts where significance matters.
+    """
+    n_tags = len(matrix.tag_ids)
+    if n_tags == 0:
+        return []
+
+    scores = matrix.scores
+    n_total = len(scores)
+    total = scores.sum(axis=0)
+    total_sq = (scores ** 2).sum(axis=0)
+
+    # Per-tag sums straight from the link arrays - no dense entry x tag matrix
+    tag_count = np.bincount(matrix.pair_tags, minlength=n_tags).astype(np.float64)
+    tag_sum = np.zeros((n_tags, len(EMOTIONS)))
+    tag_sum_sq = np.zeros((n_tags, len(EMOTIONS)))
+    np.add.at(tag_sum, matrix.pair_tags, scores[matrix.pair_rows])
+    np.add.at(tag_sum_sq, matrix.pair_tags, scores[matrix.pair_rows] ** 2)
+
+    other_count = n_total - tag_count
+    other_sum = total - tag_sum
+    other_sum_sq = total_sq - tag_sum_sq
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tag_mean = tag_sum / tag_count[:, None]
+        other_mean = other_sum / other_count[:, None]
+        tag_var = (tag_sum_sq - tag_count[:, None] * tag_mean ** 2) / (tag_count[:, None] - 1)
+        other_var = (other_sum_sq - other_count[:, None] * other_mean ** 2) / (other_count[:, None] - 1)
+        std_error = np.sqrt(np.maximum(tag_var, 0) / tag_count[:, None]
+                            + np.maximum(other_var, 0) / other_count[:, None])
+        delta = tag_mean - other_mean
+        t_stat = delta / std_error
+
+    names = dict(db.session.execute(
+        select(Tag.id, Tag.name).where(Tag.id.in_(matrix.tag_ids.tolist()))
+    ).all())
+
+    results = []
+    for t in range(n_tags):
+        emotions = {}
+        for i, emotion in enumerate(EMOTIONS):
+            value = t_stat[t, i]
+            p_value = math.erfc(abs(value) / math.sqrt(2)) if np.isfinite(value) else None
+            emotions[emotion] = {
+                'delta': round(float(delta[t, i]) * 100, 1) if np.isfinite(delta[t, i]) else None,
+                'p_value': round(p_value, 4) if p_value is not None else None,
+                'significant': bool(p_value is not None
+                                    and p_value < SIGNIFICANCE_LEVEL
+                                    and tag_count[t] >= MIN_TAG_ENTRIES
+                                    and other_count[t] >= MIN_TAG_ENTRIES),
+            }
+        results.append({
+            'tag': names.get(int(matrix.tag_ids[t]), ''),
+            'entries': int(tag_count[t]),
+            'emotions': emotions,
+        })
+
+    # Most used tags first
+    results.sort(key=lambda r: r['entries'], reverse=True)
+    return results
+
+
+def build_insights(user_id):
+    """Compute every insight for a user from a single load of their data"""
+    matrix = load_emotion_matrix(user_id)
+    days, means = daily_means(matrix)
+    today = int(np.datetime64(datetime.now(timezone.utc).date(), 'D').astype(np.int64))
+
+    return {
+        'entry_count': int(len(matrix.days)),
+        'streaks': calculate_streaks(days, means, today),
+        'rolling': rolling_stats(days, means),
+        'weekdays': weekday_patterns(matrix),
+        'tags': tag_emotion_deltas(matrix),
+    }
@@ -1,6 +1,10 @@
 from app import db, login_manager, bcrypt
+from flask import current_app
 from flask_login import UserMixin
 from datetime import datetime
+import zlib
+import numpy as np
+from app.utils import EMOTION_LABELS, dominant_emotion, text_features
 
 # This callback is required by Flask-Login to reload the user object from the user ID stored in the session.
 @login_manager.user_loader
@@ -52,27 +56,130 @@ class Entry(db.Model):
     # This sets up the many-to-many relationship with the Tag model via the association table.
     tags = db.relationship('Tag', secondary=entry_tag, backref=db.backref('entries', lazy='dynamic'))
     
-    # Add one-to-one relationship with EmotionScore
-    emotion_score = db.relationship('EmotionScore', backref='entry', uselist=False, cascade='all, delete-orphan')
+    # Emotion scores, one column per model label - NULL until the entry has been analyzed.
+    # Kept on the entry row so analytics read a single table.
+    joy = db.Column(db.Float)
+    sadness = db.Column(db.Float)
+    anger = db.Column(db.Float)
+    fear = db.Column(db.Float)
+    surprise = db.Column(db.Float)
+    disgust = db.Column(db.Float)
+    neutral = db.Column(db.Float)
+    # Highest-scoring label, precomputed when the scores are written
+    dominant_emotion = db.Column(db.String(20))
+
+    # What produced the scores: a hash of the normalized text and the model/version identifier.
+    # Both are NULL for scores created before we started recording them.
+    content_hash = db.Column(db.String(64))
+    model_version = db.Column(db.String(100))
+
+    # Scores for each sentence chunk of a long entry, in reading order
+    chunks = db.relationship('EntryChunk', order_by='EntryChunk.position', cascade='all, delete-orphan')
+
+    # Indexes for the emotion filters on the entries page: dominant mood
+    # (newest first) and a range/sort on any one emotion, always within a user
+    __table_args__ = (
+        db.Index('ix_entry_user_dominant_date', 'user_id', 'dominant_emotion', 'date_created'),
+        *[db.Index(f'ix_entry_user_{label}', 'user_id', label) for label in EMOTION_LABELS],
+        # Delta sync walks a user's changes in (updated_at, id) order
+        db.Index('ix_entry_user_updated', 'user_id', 'updated_at', 'id'),
+    )
+
+    # Old entries have their text moved to cold storage (see app/archive.py).
+    # The row itself stays, with an empty content, so dates, scores and tags still work.
+    archived = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false())
+    archive = db.relationship('ArchivedContent', uselist=False, cascade='all, delete-orphan')
+
+    # Hashed word features for similar-entry search (see app/similarity.py)
+    features = db.relationship('EntryFeatures', uselist=False, cascade='all, delete-orphan')
+
+    # Last change to the entry, its tags or its scores (see app/sync.py)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    @property
+    def has_scores(self):
+        return self.dominant_emotion is not None
+
+    # Scores as a float32 array in EMOTION_LABELS order (None if not analyzed)
+    @property
+    def emotion_vector(self):
+        if not self.has_scores:
+            return None
+        return np.array([getattr(self, label) or 0.0 for label in EMOTION_LABELS], dtype=np.float32)
+
+    # Replace the per-chunk scores after an analysis (see analyze_entry).
+    # Only entries that were split into several chunks keep them.
+    def set_chunk_scores(self, chunk_scores):
+        if len(chunk_scores) < 2 or not current_app.config.get('STORE_CHUNK_SCORES', True):
+            self.chunks = []
+            return
+        self.chunks = [
+            EntryChunk(position=position, start=chunk.start, end=chunk.end,
+                       dominant_emotion=dominant_emotion(chunk.scores),
+                       **{label: chunk.scores.get(label, 0.0) for label in EMOTION_LABELS})
+            for position, chunk in enumerate(chunk_scores)
+        ]
+
+    # Drop scores that no longer describe the text, so `flask backfill-scores` analyzes it again
+    def clear_scores(self):
+        for field in EMOTION_LABELS + ['dominant_emotion', 'content_hash', 'model_version']:
+            setattr(self, field, None)
+        self.chunks = []
+
+    # Recompute the text features after the content changes
+    def set_text_features(self, content):
+        vector = text_features(content).astype('<f2').tobytes()
+        if self.features is None:
+            self.features = EntryFeatures(text_vector=vector)
+        else:
+            self.features.text_vector = vector
+
+    # The entry text, read from cold storage if it has been archived
+    @property
+    def full_content(self):
+        if self.archived and self.archive is not None:
+            return self.archive.content
+        return self.content
 
     # How the object is printed for debugging
     def __repr__(self):
         return f'<Entry {self.id}>'
 
-class EmotionScore(db.Model):
+# Emotion scores for one sentence chunk of a long entry (Many-to-One with Entry)
+class EntryChunk(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    joy = db.Column(db.Float, default=0.0)
-    sadness = db.Column(db.Float, default=0.0)
-    anger = db.Column(db.Float, default=0.0)
-    fear = db.Column(db.Float, default=0.0)
-    surprise = db.Column(db.Float, default=0.0)
-    
-    # Foreign key to link the scores to a specific entry (One-to-One relationship)
-    entry_id = db.Column(db.Integer, db.ForeignKey('entry.id'), nullable=False, unique=True)
-    
-    # How the object is printed for debugging
+    entry_id = db.Column(db.Integer, db.ForeignKey('entry.id'), nullable=False, index=True)
+    position = db.Column(db.Integer, nullable=False)
+    # Character offsets of the chunk in the entry text
+    start = db.Column(db.Integer, nullable=False)
+    end = db.Column(db.Integer, nullable=False)
+
+    joy = db.Column(db.Float)
+    sadness = db.Column(db.Float)
+    anger = db.Column(db.Float)
+    fear = db.Column(db.Float)
+    surprise = db.Column(db.Float)
+    disgust = db.Column(db.Float)
+    neutral = db.Column(db.Float)
+    dominant_emotion = db.Column(db.String(20))
+
+    def __repr__(self):
+        return f'<EntryChunk {self.position} of Entry {self.entry_id}>'
+
+# Compressed text of an archived entry (One-to-One with Entry)
+class ArchivedContent(db.Model):
+    entry_id = db.Column(db.Integer, db.ForeignKey('entry.id'), primary_key=True)
+    # zlib-compressed UTF-8 text
+    data = db.Column(db.LargeBinary, nullable=False)
+    original_size = db.Column(db.Integer, nullable=False)
+    archived_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    @property
+    def content(self):
+        return zlib.decompress(self.data).decode('utf-8')
+
     def __repr__(self):
-        return f'<EmotionScore for Entry {self.entry_id}>'
+        return f'<ArchivedContent for Entry {self.entry_id}>'
 
 class Tag(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -80,4 +187,79 @@ class Tag(db.Model):
     
     # How the object is printed for debugging
     def __repr__(self):
-        return f'<Tag {self.name}>'
\ No newline at end of file
+        return f'<Tag {self.name}>'
+
+# Which shard database holds a user's journal data (see app/sharding.py).
+# Lives in the global database alongside User.
+class UserShard(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    shard = db.Column(db.String(50), nullable=False)
+    # 'active', or 'moving' while the user's data is copied to another shard
+    status = db.Column(db.String(20), nullable=False, default='active')
+
+    def __repr__(self):
+        return f'<UserShard user={self.user_id} shard={self.shard}>'
+
+# Global id allocator so entry ids stay unique across every shard
+class IdBlock(db.Model):
+    name = db.Column(db.String(50), primary_key=True)
+    next_value = db.Column(db.BigInteger, nullable=False)
+
+    def __repr__(self):
+        return f'<IdBlock {self.name}={self.next_value}>'
+
+# Precomputed dashboard statistics for a user, written by `flask snapshot-insights`.
+# Covers every entry created before `computed_through`; the dashboard adds newer entries on top.
+# Lives in the global database alongside User.
+class UserSnapshot(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    computed_through = db.Column(db.DateTime, nullable=False)
+    computed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # All-time entry count, analyzed entry count and per-label score sums (EMOTION_LABELS order)
+    entries = db.Column(db.Integer, nullable=False, default=0)
+    scored = db.Column(db.Integer, nullable=False, default=0)
+    sums = db.Column(db.JSON, nullable=False)
+    # The same numbers per week: {week start (days since epoch): [entries, scored, sums]}
+    weeks = db.Column(db.JSON, nullable=False)
+
+    def __repr__(self):
+        return f'<UserSnapshot user={self.user_id} through={self.computed_through}>'
+
+
+class EntryFeatures(db.Model):
+    """Text features of an entry, kept apart so the hot entry rows stay narrow"""
+    entry_id = db.Column(db.Integer, db.ForeignKey('entry.id'), primary_key=True)
+    # Little-endian float16, TEXT_FEATURE_DIM values (see utils.text_features)
+    text_vector = db.Column(db.LargeBinary, nullable=False)
+
+    def __repr__(self):
+        return f'<EntryFeatures entry={self.entry_id}>'
+
+
+class EntryTombstone(db.Model):
+    """Left behind by a deleted entry so sync clients learn to delete their copy"""
+    # Entry ids come from the global allocator, so they stay unique after the entry is gone
+    entry_id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    deleted_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_entry_tombstone_user_deleted', 'user_id', 'deleted_at', 'entry_id'),
+    )
+
+    def __repr__(self):
+        return f'<EntryTombstone entry={self.entry_id}>'
+
+
+class MoodSketch(db.Model):
+    """One day's community-wide emotion histogram (see app/community.py). Not per user, so never sharded."""
+    day = db.Column(db.Date, primary_key=True)
+    # Analyzed entries counted in this sketch
+    entries = db.Column(db.Integer, nullable=False, default=0)
+    # Per-label score sums, little-endian float64 in EMOTION_LABELS order
+    sums = db.Column(db.LargeBinary, nullable=False)
+    # Per-label histogram counts, little-endian uint32, EMOTION_LABELS x SKETCH_BINS
+    histogram = db.Column(db.LargeBinary, nullable=False)
+
+    def __repr__(self):
+        return f'<MoodSketch {self.day} entries={self.entries}>'
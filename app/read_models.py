@@ -0,0 +1,87 @@
+"""
+Read-only entry rows for list pages and exports.
+
+These pages only display entries, so instead of ORM objects (identity map,
+change tracking, lazy relationships) they select just the needed columns with
+Core into slotted EntryRow objects. Tags for a whole page come from one query,
+and archived text is decompressed only for the rows that need it.
+"""
+from flask_sqlalchemy.pagination import Pagination
+from sqlalchemy import select, func
+from app import db
+from app.models import Entry, Tag, entry_tag
+from app.utils import EMOTION_LABELS
+from app.archive import archived_texts
+
+ENTRY_ROW_COLUMNS = [Entry.id, Entry.content, Entry.archived, Entry.date_created, Entry.dominant_emotion] \
+    + [getattr(Entry, label) for label in EMOTION_LABELS]
+SCORE_ROW_COLUMNS = [Entry.id, Entry.date_created, Entry.dominant_emotion] \
+    + [getattr(Entry, label) for label in EMOTION_LABELS]
+
+
+class EntryRow:
+    """What the templates read from an entry: text, date, tag names and scores"""
+    __slots__ = ('id', 'full_content', 'date_created', 'dominant_emotion', 'tags', *EMOTION_LABELS)
+
+    def __init__(self, row, full_content=None, tags=()):
+        self.id = row.id
+        self.date_created = row.date_created
+        self.dominant_emotion = row.dominant_emotion
+        for label in EMOTION_LABELS:
+            setattr(self, label, getattr(row, label))
+        self.full_content = full_content
+        self.tags = tags
+
+    @property
+    def has_scores(self):
+        return self.dominant_emotion is not None
+
+
+def entry_rows_query(user_id, columns=ENTRY_ROW_COLUMNS):
+    """Select of the user's entries; add filters and ordering as with any Core select"""
+    return select(*columns).where(Entry.user_id == user_id)
+
+
+def tag_names(entry_ids):
+    """{entry id: sorted tag names} for a page of entries, in one query"""
+    if not entry_ids:
+        return {}
+    names = {}
+    for entry_id, name in db.session.execute(
+        select(entry_tag.c.entry_id, Tag.name)
+        .join(Tag, Tag.id == entry_tag.c.tag_id)
+        .where(entry_tag.c.entry_id.in_(entry_ids))
+        .order_by(Tag.name)
+    ):
+        names.setdefault(entry_id, []).append(name)
+    return names
+
+
+def load_entry_rows(query, with_tags=True):
+    """Run a select of ENTRY_ROW_COLUMNS and build EntryRows, with text and tags filled in"""
+    rows = db.session.execute(query).all()
+    ids = [row.id for row in rows]
+    tags = tag_names(ids) if with_tags else {}
+    cold = archived_texts([row.id for row in rows if row.archived])
+    return [EntryRow(row, cold.get(row.id, row.content), tags.get(row.id, ())) for row in rows]
+
+
+def load_score_rows(query):
+    """Run a select of SCORE_ROW_COLUMNS (no text, no tags) into EntryRows"""
+    return [EntryRow(row) for row in db.session.execute(query)]
+
+
+class EntryRowPagination(Pagination):
+    """Flask-SQLAlchemy's pagination over EntryRows, so templates use it unchanged"""
+
+    def _query_items(self):
+        query = self._query_args['select'].limit(self.per_page).offset(self._query_offset)
+        return load_entry_rows(query)
+
+    def _query_count(self):
+        query = self._query_args['select'].with_only_columns(Entry.id).order_by(None)
+        return db.session.execute(select(func.count()).select_from(query.subquery())).scalar()
+
+
+def paginate_entry_rows(query, page, per_page):
+    return EntryRowPagination(page=page, per_page=per_page, error_out=False, select=query)
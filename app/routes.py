@@ -1,12 +1,26 @@
 from flask import Blueprint, render_template, redirect, url_for, flash, request, current_app
 from flask_login import login_user, logout_user, login_required, current_user 
 from app import db, bcrypt #, limiter 
-from app.models import User, Entry, EmotionScore, Tag
-from app.utils import analyze_sentiment  # Import the utility function
+from app.models import User, Entry, Tag
+from app.utils import analyze_entry, score_fields, content_fingerprint, analysis_version, EMOTIONS, EMOTION_LABELS  # Import the utility functions
+from app.timeseries import build_timeseries, default_range, DEFAULT_POINTS
+from app.insights import build_insights
+from app.bulk import delete_entries, retag_entries, delete_account
+from app.archive import restore_entry, search_archived
+from app.snapshots import dashboard_aggregates, invalidate_snapshot, week_averages, day_number
+from app.snapshots import emotion_distribution as emotion_distribution_from
+from app.tag_index import suggest_tags, forget_user_tags, AUTOCOMPLETE_LIMIT
+from app.similarity import similar_entries, SIMILAR_ENTRIES
+from app.sync import sync_changes, record_deletions, last_change, InvalidCursor, SYNC_PAGE_SIZE
+from app.community import community_mood, DEFAULT_PERCENTILES, MAX_DAYS
+from app.streaming import stream_page
+from app.coalesce import coalesce, CoalesceTimeout
+from app.read_models import entry_rows_query, load_entry_rows, load_score_rows, paginate_entry_rows, SCORE_ROW_COLUMNS
+from app.sharding import sharding_enabled, assign_shard
 # from flask_limiter import Limiter  # Add if not already imported
 # from flask_limiter.util import get_remote_address
 # from flask_limiter.errors import RateLimitExceeded 
-from flask import make_response
+from flask import make_response, jsonify
 # import pandas as pd
 # from io import StringIO
 import json
@@ -79,6 +93,9 @@ def register():
             new_user = User(username=username)
             new_user.password = password  # This will hash the password
             db.session.add(new_user)
+            if sharding_enabled():
+                db.session.flush()  # Get the user ID so we can pick a shard
+                assign_shard(new_user.id)
             db.session.commit()
             flash('Registration successful! Please log in.', 'success')
             return redirect(url_for('auth.login'))
@@ -118,11 +135,22 @@ def dashboard():
         
         if not content:
             flash('Journal content cannot be empty.', 'error')
-            return render_template('dashboard.html')
+            return redirect(url_for('main.dashboard'))
         
         # Create new journal entry
         try:
+            # Analyze sentiment using Hugging Face API (long entries are scored in chunks).
+            # This runs before anything is written, so no transaction is held open during the call.
+            try:
+                emotion_scores, chunk_scores = analyze_entry(content)
+            except Exception as e:
+                # This will catch rate limit exceptions
+                current_app.logger.warning(f"Rate limit exceeded or API error: {e}")
+                emotion_scores = None
+                flash('AI analysis temporarily unavailable. Entry saved without analysis.', 'warning')
+
             new_entry = Entry(content=content, author=current_user)
+            new_entry.set_text_features(content)
             
             # Process tags
             if tags_input:
@@ -139,34 +167,19 @@ def dashboard():
             db.session.add(new_entry)
             db.session.flush()  # Flush to get the entry ID without committing
             
-            # Analyze sentiment using Hugging Face API
-            try:
-                emotion_scores = analyze_sentiment(content)
-            except Exception as e:
-                # This will catch rate limit exceptions
-                current_app.logger.warning(f"Rate limit exceeded or API error: {e}")
-                emotion_scores = None
-                flash('AI analysis temporarily unavailable. Entry saved without analysis.', 'warning')
-            
             if emotion_scores:
-                # Create emotion score record
-                emotion_score = EmotionScore(
-                    joy=emotion_scores.get('joy', 0.0),
-                    sadness=emotion_scores.get('sadness', 0.0),
-                    anger=emotion_scores.get('anger', 0.0),
-                    fear=emotion_scores.get('fear', 0.0),
-                    surprise=emotion_scores.get('surprise', 0.0),
-                    entry_id=new_entry.id
-                )
-                db.session.add(emotion_score)
+                # Store the scores on the entry itself
+                for field, value in score_fields(emotion_scores, content).items():
+                    setattr(new_entry, field, value)
+                new_entry.set_chunk_scores(chunk_scores)
                 flash('Journal entry saved and analyzed successfully!', 'success')
             else:
-                # Create default emotion scores if analysis fails
-                emotion_score = EmotionScore(entry_id=new_entry.id)
-                db.session.add(emotion_score)
+                # Leave the entry without scores so `flask backfill-scores` can retry it later
+                # (all-zero placeholder scores would drag down every average)
                 flash('Journal entry saved, but sentiment analysis failed.', 'warning')
             
             db.session.commit()
+            forget_user_tags(current_user.id)
             return redirect(url_for('main.dashboard'))
             
         except Exception as e:
@@ -174,220 +187,10 @@ def dashboard():
             current_app.logger.error(f"Error saving journal entry: {e}")
             flash('An error occurred while saving your entry. Please try again.', 'error')
     
-    # For GET requests, show the dashboard with recent entries
-    recent_entries = Entry.query.filter_by(user_id=current_user.id)\
-                              .order_by(Entry.date_created.desc())\
-                              .limit(5).all()
-
-    # Get data for the line chart - last 7 days of emotion scores
-    import datetime
-    from collections import defaultdict
-    from sqlalchemy import func
-
-    seven_days_ago = datetime.datetime.utcnow() - datetime.timedelta(days=7)
-
-    # Query to get average scores per day
-    chart_data = db.session.query(
-        func.date(Entry.date_created).label('date'),
-        func.avg(EmotionScore.joy).label('avg_joy'),
-        func.avg(EmotionScore.sadness).label('avg_sadness'),
-        func.avg(EmotionScore.anger).label('avg_anger'),
-        func.avg(EmotionScore.fear).label('avg_fear'),
-        func.avg(EmotionScore.surprise).label('avg_surprise')
-    ).join(EmotionScore)\
-    .filter(Entry.user_id == current_user.id,
-            Entry.date_created >= seven_days_ago)\
-    .group_by(func.date(Entry.date_created))\
-    .order_by(func.date(Entry.date_created).asc())\
-    .all()
-
-    # Prepare data for Chart.js
-    dates = []
-    joy_scores = []
-    sadness_scores = []
-    anger_scores = []
-    fear_scores = []
-    surprise_scores = []
-
-    for data in chart_data:
-        dates.append(data.date.strftime('%Y-%m-%d'))
-        joy_scores.append(round(data.avg_joy * 100, 1))
-        sadness_scores.append(round(data.avg_sadness * 100, 1))
-        anger_scores.append(round(data.avg_anger * 100, 1))
-        fear_scores.append(round(data.avg_fear * 100, 1))
-        surprise_scores.append(round(data.avg_surprise * 100, 1))
-    
-    # NEW: Get data for sparklines and summary (last 14 days)
-    from datetime import datetime, timezone
-    fourteen_days_ago = datetime.now(timezone.utc) - timedelta(days=14)
-    
-    chart_entries = Entry.query\
-        .options(db.joinedload(Entry.emotion_score))\
-        .filter(Entry.user_id == current_user.id,
-               Entry.date_created >= fourteen_days_ago)\
-        .order_by(Entry.date_created.asc())\
-        .all()
-    
-    # Prepare data for sparklines and summary
-    sparkline_data = {
-        'dates': [],
-        'joy': [], 'sadness': [], 'anger': [], 'fear': [], 'surprise': [],
-        'dominant_emotions': []
-    }
-    
-    # Group entries by date and calculate daily averages
-    daily_data = {}
-    for entry in chart_entries:
-        if entry.emotion_score:
-            date_str = entry.date_created.strftime('%Y-%m-%d')
-            if date_str not in daily_data:
-                daily_data[date_str] = {
-                    'joy': [], 'sadness': [], 'anger': [], 'fear': [], 'surprise': [],
-                    'count': 0
-                }
-            
-            daily_data[date_str]['joy'].append(entry.emotion_score.joy)
-            daily_data[date_str]['sadness'].append(entry.emotion_score.sadness)
-            daily_data[date_str]['anger'].append(entry.emotion_score.anger)
-            daily_data[date_str]['fear'].append(entry.emotion_score.fear)
-            daily_data[date_str]['surprise'].append(entry.emotion_score.surprise)
-            daily_data[date_str]['count'] += 1
-    
-    # Calculate daily averages and dominant emotions
-    for date_str, emotions in sorted(daily_data.items()):
-        sparkline_data['dates'].append(date_str)
-        
-        for emotion in ['joy', 'sadness', 'anger', 'fear', 'surprise']:
-            avg = sum(emotions[emotion]) / len(emotions[emotion]) * 100 if emotions[emotion] else 0
-            sparkline_data[emotion].append(round(avg, 1))
-        
-        # Find dominant emotion for the day
-        emotion_avgs = {e: sparkline_data[e][-1] for e in ['joy', 'sadness', 'anger', 'fear', 'surprise']}
-        dominant_emotion = max(emotion_avgs.items(), key=lambda x: x[1])
-        sparkline_data['dominant_emotions'].append(dominant_emotion[0])
-    
-    # Calculate summary statistics (current week vs previous week)
-    summary_stats = calculate_weekly_summary(current_user.id)
-    
-    # NEW: Calculate emotion distribution for pie chart
-    all_entries = Entry.query\
-        .options(db.joinedload(Entry.emotion_score))\
-        .filter(Entry.user_id == current_user.id)\
-        .all()
-    
-    emotion_totals = {
-        'joy': 0,
-        'sadness': 0,
-        'anger': 0,
-        'fear': 0,
-        'surprise': 0
-    }
-    
-    entry_count = 0
-    for entry in all_entries:
-        if entry.emotion_score:
-            entry_count += 1
-            emotion_totals['joy'] += entry.emotion_score.joy
-            emotion_totals['sadness'] += entry.emotion_score.sadness
-            emotion_totals['anger'] += entry.emotion_score.anger
-            emotion_totals['fear'] += entry.emotion_score.fear
-            emotion_totals['surprise'] += entry.emotion_score.surprise
-    
-    # Calculate average percentages
-    emotion_distribution = {}
-    if entry_count > 0:
-        for emotion, total in emotion_totals.items():
-            emotion_distribution[emotion] = round((total / entry_count) * 100, 1)
-    
-    # NEW: Weekly trend analysis (current week vs previous week)
-    from datetime import datetime, timezone
-    today = datetime.now(timezone.utc).date()
-    current_week_start = today - timedelta(days=today.weekday())
-    current_week_end = current_week_start + timedelta(days=6)
-
-    # Initialize trend_analysis as empty dict
-    trend_analysis = {}
-
-    # Only calculate trends if we have enough data
-    if entry_count >= 2:
-        # Convert to datetime for database comparison
-        current_week_start_dt = datetime.combine(current_week_start, datetime.min.time())
-        current_week_end_dt = datetime.combine(current_week_end, datetime.max.time())
-        previous_week_start = current_week_start - timedelta(days=7)
-        previous_week_end = current_week_start - timedelta(days=1)
-        previous_week_start_dt = datetime.combine(previous_week_start, datetime.min.time())
-        previous_week_end_dt = datetime.combine(previous_week_end, datetime.max.time())
-        
-        # Current week entries
-        current_week_entries = Entry.query\
-            .options(db.joinedload(Entry.emotion_score))\
-            .filter(Entry.user_id == current_user.id,
-                Entry.date_created >= current_week_start_dt,
-                Entry.date_created <= current_week_end_dt)\
-            .all()
-        
-        # Previous week entries
-        previous_week_entries = Entry.query\
-            .options(db.joinedload(Entry.emotion_score))\
-            .filter(Entry.user_id == current_user.id,
-                Entry.date_created >= previous_week_start_dt,
-                Entry.date_created <= previous_week_end_dt)\
-            .all()
-        
-        # Calculate averages for both weeks
-        def calculate_week_average(entries):
-            totals = {emotion: 0 for emotion in emotion_totals.keys()}
-            count = 0
-            for entry in entries:
-                if entry.emotion_score:
-                    count += 1
-                    totals['joy'] += entry.emotion_score.joy
-                    totals['sadness'] += entry.emotion_score.sadness
-                    totals['anger'] += entry.emotion_score.anger
-                    totals['fear'] += entry.emotion_score.fear
-                    totals['surprise'] += entry.emotion_score.surprise
-            
-            averages = {}
-            if count > 0:
-                for emotion, total in totals.items():
-                    averages[emotion] = (total / count) * 100
-            return averages, count
-        
-        current_avg, current_count = calculate_week_average(current_week_entries)
-        previous_avg, previous_count = calculate_week_average(previous_week_entries)
-        
-        # Calculate trends (absolute difference)
-        for emotion in emotion_totals.keys():
-            current_val = current_avg.get(emotion, 0)
-            previous_val = previous_avg.get(emotion, 0)
-            
-            if previous_val > 0 or current_val > 0:  # If we have any data
-                change = current_val - previous_val  # Simple difference in percentage points
-                
-                trend_analysis[emotion] = {
-                    'change': round(change, 1),
-                    'current': round(current_val, 1),
-                    'previous': round(previous_val, 1),
-                    'direction': 'up' if change > 2 else 'down' if change < -2 else 'stable',
-                    'current_count': current_count,
-                    'previous_count': previous_count
-                }
-
-    return render_template('dashboard.html', 
-                         entries=recent_entries,
-                         dates=dates,
-                         joy_scores=joy_scores,
-                         sadness_scores=sadness_scores,
-                         anger_scores=anger_scores,
-                         fear_scores=fear_scores,
-                         surprise_scores=surprise_scores,
-                         emotion_distribution=emotion_distribution,  # NEW
-                         entry_count=entry_count,  # NEW
-                         trend_analysis=trend_analysis,
-                         current_week_start=current_week_start,  # NEW
-                         current_week_end=current_week_end,      # NEW
-                         sparkline_data=sparkline_data,
-                         summary_stats=summary_stats)
+    # For GET requests, stream the dashboard. The page head and layout go out first;
+    # the charts and trends are computed when the template reaches them.
+    user_id = current_user.id
+    return stream_page('dashboard.html', load_dashboard=lambda: build_dashboard_context(user_id))
 
 # Route to view a single entry
 @main_routes.route('/entry/<int:entry_id>')
@@ -423,9 +226,41 @@ def edit_entry(entry_id):
             return render_template('edit_entry.html', entry=entry)
         
         try:
+            # Decide whether the scores are stale BEFORE overwriting the content.
+            # Re-analyze only if the normalized text or the model/version changed.
+            new_fingerprint = content_fingerprint(content)
+            if entry.content_hash is None:
+                # Scores from before we recorded fingerprints: compare against the old text
+                text_changed = new_fingerprint != content_fingerprint(entry.full_content)
+                needs_analysis = not entry.has_scores or text_changed
+            else:
+                text_changed = new_fingerprint != entry.content_hash
+                needs_analysis = (not entry.has_scores or text_changed
+                                  or entry.model_version != analysis_version())
+
+            # Re-analyze sentiment if content changed meaningfully (tag-only edits skip this).
+            # This runs before the entry is modified, so no transaction is held open during the call.
+            emotion_scores = None
+            if needs_analysis:
+                try:
+                    emotion_scores, chunk_scores = analyze_entry(content)
+                except Exception as e:
+                    # This will catch rate limit exceptions
+                    current_app.logger.warning(f"Rate limit exceeded or API error: {e}")
+                    flash('AI analysis temporarily unavailable. Entry saved without analysis.', 'warning')
+
+            old_content = entry.full_content
+
+            # Edited entries are active again, so move them back out of cold storage
+            restore_entry(entry)
+
             # Update entry content
             entry.content = content
+            entry.set_text_features(content)
             
+            # Tag changes don't touch the entry row, so mark it changed for sync
+            entry.updated_at = datetime.utcnow()
+
             # Clear existing tags and add new ones
             entry.tags = []
             if tags_input:
@@ -438,24 +273,25 @@ def edit_entry(entry_id):
                             db.session.add(tag)
                         entry.tags.append(tag)
             
-            # Re-analyze sentiment if content changed significantly
-            if content != entry.content:
-                try:
-                    emotion_scores = analyze_sentiment(content)
-                except Exception as e:
-                    # This will catch rate limit exceptions
-                    current_app.logger.warning(f"Rate limit exceeded or API error: {e}")
-                    emotion_scores = None
-                    flash('AI analysis temporarily unavailable. Entry saved without analysis.', 'warning')
+            if emotion_scores:
+                for field, value in score_fields(emotion_scores, content).items():
+                    setattr(entry, field, value)
+                entry.set_chunk_scores(chunk_scores)
+                # The nightly snapshot may include the old scores
+                invalidate_snapshot(current_user.id, entry.date_created)
+            elif needs_analysis and text_changed and entry.has_scores:
+                # The old scores describe the old text. Clear them so
+                # `flask backfill-scores` retries the entry later.
+                entry.clear_scores()
+                invalidate_snapshot(current_user.id, entry.date_created)
 
-                if emotion_scores and entry.emotion_score:
-                    entry.emotion_score.joy = emotion_scores.get('joy', 0.0)
-                    entry.emotion_score.sadness = emotion_scores.get('sadness', 0.0)
-                    entry.emotion_score.anger = emotion_scores.get('anger', 0.0)
-                    entry.emotion_score.fear = emotion_scores.get('fear', 0.0)
-                    entry.emotion_score.surprise = emotion_scores.get('surprise', 0.0)
+            if not emotion_scores and content != old_content:
+                # Chunk scores are character offsets into the old text (a whitespace-only
+                # edit keeps the entry's scores but would shift every chunk)
+                entry.chunks = []
             
             db.session.commit()
+            forget_user_tags(current_user.id)
             flash('Entry updated successfully!', 'success')
             return redirect(url_for('main.view_entry', entry_id=entry.id))
             
@@ -480,8 +316,10 @@ def delete_entry(entry_id):
         return redirect(url_for('main.dashboard'))
     
     try:
-        # Delete the entry (cascade will handle emotion_score and tags due to relationship)
+        # Delete the entry (cascade will handle archived text and tags due to relationship)
         db.session.delete(entry)
+        record_deletions(current_user.id, [entry.id])
+        invalidate_snapshot(current_user.id, entry.date_created)
         db.session.commit()
         flash('Entry deleted successfully!', 'success')
     except Exception as e:
@@ -491,6 +329,93 @@ def delete_entry(entry_id):
     
     return redirect(url_for('main.dashboard'))
 
+# Bulk actions on the entries selected in the entries list
+@main_routes.route('/entries/bulk', methods=['POST'])
+@login_required
+def bulk_entries():
+    action = request.form.get('bulk_action')
+    entry_ids = request.form.getlist('entry_ids', type=int)
+    tag_names = [tag for tag in request.form.get('tags', '').split(',') if tag.strip()]
+
+    if not entry_ids:
+        flash('Select at least one entry first.', 'warning')
+        return redirect(url_for('main.view_all_entries'))
+
+    try:
+        if action == 'delete':
+            count = delete_entries(current_user.id, entry_ids)
+            flash(f'Deleted {count} entries.', 'success')
+        elif action in ('add_tags', 'remove_tags', 'replace_tags'):
+            if not tag_names and action != 'replace_tags':
+                flash('Enter at least one tag.', 'warning')
+                return redirect(url_for('main.view_all_entries'))
+            count = retag_entries(
+                current_user.id, entry_ids,
+                add_tags=tag_names if action != 'remove_tags' else (),
+                remove_tags=tag_names if action == 'remove_tags' else (),
+                replace=action == 'replace_tags'
+            )
+            forget_user_tags(current_user.id)
+            flash(f'Updated tags on {count} entries.', 'success')
+        else:
+            flash('Unknown bulk action.', 'error')
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Bulk action error: {e}")
+        flash('An error occurred while updating your entries. Please try again.', 'error')
+
+    return redirect(url_for('main.view_all_entries'))
+
+# Delete every entry in a date range
+@main_routes.route('/entries/delete-range', methods=['POST'])
+@login_required
+def delete_entries_in_range():
+    from datetime import datetime
+    try:
+        start_date = datetime.strptime(request.form.get('start_date', ''), '%Y-%m-%d')
+        end_date = datetime.strptime(request.form.get('end_date', ''), '%Y-%m-%d')
+    except ValueError:
+        flash('Please choose a valid start and end date.', 'error')
+        return redirect(url_for('main.view_all_entries'))
+
+    if end_date < start_date:
+        flash('The end date must be after the start date.', 'error')
+        return redirect(url_for('main.view_all_entries'))
+
+    try:
+        # Include the whole end day
+        count = delete_entries(current_user.id,
+                               start=datetime.combine(start_date, datetime.min.time()),
+                               end=datetime.combine(end_date, datetime.max.time()))
+        flash(f'Deleted {count} entries.', 'success')
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Range delete error: {e}")
+        flash('An error occurred while deleting your entries. Please try again.', 'error')
+
+    return redirect(url_for('main.view_all_entries'))
+
+# Delete the account and all of its entries
+@main_routes.route('/account/delete', methods=['POST'])
+@login_required
+def delete_user_account():
+    password = request.form.get('password', '')
+    if not current_user.check_password(password):
+        flash('Incorrect password. Your account was not deleted.', 'error')
+        return redirect(url_for('main.dashboard'))
+
+    user_id = current_user.id
+    try:
+        logout_user()
+        delete_account(user_id)
+        flash('Your account and all of your entries have been deleted.', 'success')
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Account deletion error: {e}")
+        flash('An error occurred while deleting your account. Please try again.', 'error')
+
+    return redirect(url_for('main.index'))
+
 # Export route
 @main_routes.route('/export/entries')
 @login_required
@@ -503,11 +428,8 @@ def export_entries():
     
     try:
         # Get all user's entries with emotion scores and tags
-        entries = Entry.query\
-            .options(db.joinedload(Entry.emotion_score), db.joinedload(Entry.tags))\
-            .filter(Entry.user_id == current_user.id)\
-            .order_by(Entry.date_created.desc())\
-            .all()
+        entries = load_entry_rows(
+            entry_rows_query(current_user.id).order_by(Entry.date_created.desc(), Entry.id.desc()))
         
         if not entries:
             flash('No entries to export.', 'warning')
@@ -517,27 +439,25 @@ def export_entries():
         data = []
         for entry in entries:
             # Get tags as comma-separated string
-            tags = ', '.join([tag.name for tag in entry.tags]) if entry.tags else ''
+            tags = ', '.join(entry.tags)
             
             # Get emotion scores
-            emotions = entry.emotion_score
             emotion_data = {
-                'joy': emotions.joy * 100 if emotions else 0,
-                'sadness': emotions.sadness * 100 if emotions else 0,
-                'anger': emotions.anger * 100 if emotions else 0,
-                'fear': emotions.fear * 100 if emotions else 0,
-                'surprise': emotions.surprise * 100 if emotions else 0,
-            } if emotions else {}
+                label: (getattr(entry, label) or 0) * 100 for label in EMOTION_LABELS
+            } if entry.has_scores else {}
             
             data.append({
                 'Date': entry.date_created.strftime('%Y-%m-%d %H:%M:%S'),
-                'Content': entry.content,
+                'Content': entry.full_content,
                 'Tags': tags,
                 'Joy (%)': emotion_data.get('joy', 0),
                 'Sadness (%)': emotion_data.get('sadness', 0),
                 'Anger (%)': emotion_data.get('anger', 0),
                 'Fear (%)': emotion_data.get('fear', 0),
                 'Surprise (%)': emotion_data.get('surprise', 0),
+                'Disgust (%)': emotion_data.get('disgust', 0),
+                'Neutral (%)': emotion_data.get('neutral', 0),
+                'Dominant Emotion': entry.dominant_emotion or '',
             })
         
         # Create DataFrame and convert to CSV
@@ -565,13 +485,13 @@ def view_all_entries():
     # Get filter parameters from query string
     date_filter = request.args.get('date_filter', 'all')
     tag_filter = request.args.getlist('tag')  # Get multiple tags
+    search = request.args.get('q', '').strip()
+    emotion_ranges, dominant_filter, sort = parse_emotion_filters(request.args)
     page = request.args.get('page', 1, type=int)
     per_page = 10
     
-    # Start with base query
-    query = Entry.query\
-        .options(db.joinedload(Entry.emotion_score), db.joinedload(Entry.tags))\
-        .filter(Entry.user_id == current_user.id)
+    # Start with base query: plain rows, archived text only for the entries on the page
+    query = entry_rows_query(current_user.id)
     
     # Apply date filters
     from datetime import datetime, timezone
@@ -592,28 +512,343 @@ def view_all_entries():
     # Apply tag filters
     if tag_filter:
         # Filter entries that have any of the selected tags
-        query = query.join(Entry.tags).filter(Tag.name.in_(tag_filter))
-    
-    # Get paginated results
-    entries_pagination = query\
-        .order_by(Entry.date_created.desc())\
-        .paginate(page=page, per_page=per_page, error_out=False)
-    
-    # Get all unique tags for the filter dropdown
-    all_tags = Tag.query\
-        .join(Entry.tags)\
-        .filter(Entry.user_id == current_user.id)\
-        .distinct()\
-        .all()
-    
-    return render_template('all_entries.html', 
-                         entries=entries_pagination.items,
-                         pagination=entries_pagination,
-                         all_tags=all_tags,
-                         current_date_filter=date_filter,
-                         current_tag_filter=tag_filter)
-
-def calculate_weekly_summary(user_id):
+        # (EXISTS rather than a join, so an entry with several of them is listed once)
+        query = query.filter(Entry.tags.any(Tag.name.in_(tag_filter)))
+    
+    # Apply text search to hot entries in SQL and to archived ones in cold storage
+    # (the archived matches are cached, so paging through the results reads the archive once)
+    if search:
+        archived_matches = search_archived(current_user.id, search)
+        query = query.filter(db.or_(Entry.content.icontains(search, autoescape=True),
+                                    Entry.id.in_(archived_matches)))
+    
+    # Apply emotion filters - scores are stored 0-1, the form uses percentages.
+    # Each predicate is served by an (user_id, emotion) index; see Entry.__table_args__.
+    if dominant_filter:
+        query = query.filter(Entry.dominant_emotion == dominant_filter)
+    for label, (low, high) in emotion_ranges.items():
+        column = getattr(Entry, label)
+        if low is not None:
+            query = query.filter(column >= low / 100)
+        if high is not None:
+            query = query.filter(column <= high / 100)
+    
+    if sort == 'oldest':
+        order = [Entry.date_created.asc()]
+    elif sort in EMOTION_LABELS:
+        # Most intense first. MySQL and SQLite both sort NULL (unscored) last in DESC,
+        # and the (user_id, emotion) index also holds the id, so it serves the whole ORDER BY
+        column = getattr(Entry, sort)
+        order = [column.desc(), Entry.id.desc()]
+    else:
+        order = [Entry.date_created.desc()]
+    
+    # Everything needed to rebuild this view's URL (pagination links)
+    current_filters = {'date_filter': date_filter, 'tag': tag_filter, 'q': search or None,
+                       'dominant': dominant_filter, 'sort': sort if sort != 'newest' else None}
+    for label, (low, high) in emotion_ranges.items():
+        current_filters[f'min_{label}'] = low
+        current_filters[f'max_{label}'] = high
+    
+    user_id = current_user.id
+
+    # The queries run when the streamed template reaches the entries,
+    # after the page head and navigation have already been sent
+    def load_entries():
+        # Get paginated results
+        entries_pagination = paginate_entry_rows(query.order_by(*order), page, per_page)
+        
+        # Get all unique tags for the filter dropdown
+        all_tags = db.session.execute(
+            db.select(Tag.name)
+            .where(Tag.entries.any(Entry.user_id == user_id))
+            .order_by(Tag.name)
+        ).scalars().all()
+
+        return {
+            'entries': entries_pagination.items,
+            'pagination': entries_pagination,
+            'all_tags': all_tags,
+        }
+    
+    return stream_page('all_entries.html',
+                       load_entries=load_entries,
+                       current_date_filter=date_filter,
+                       current_tag_filter=tag_filter,
+                       current_search=search,
+                       current_emotion_ranges=emotion_ranges,
+                       current_dominant=dominant_filter,
+                       current_sort=sort,
+                       current_filters=current_filters,
+                       emotion_labels=EMOTION_LABELS,
+                       filters_active=bool(date_filter != 'all' or tag_filter or search
+                                           or emotion_ranges or dominant_filter))
+
+def parse_emotion_filters(args):
+    """
+    Read the emotion filters from the query string:
+    min_<emotion> / max_<emotion> percentages, dominant=<emotion> and sort=newest|oldest|<emotion>.
+    Unknown or invalid values are ignored.
+    """
+    ranges = {}
+    for label in EMOTION_LABELS:
+        low = args.get(f'min_{label}', type=float)
+        high = args.get(f'max_{label}', type=float)
+        low = min(max(low, 0), 100) if low is not None else None
+        high = min(max(high, 0), 100) if high is not None else None
+        if low is not None or high is not None:
+            ranges[label] = (low, high)
+
+    dominant = args.get('dominant')
+    if dominant not in EMOTION_LABELS:
+        dominant = None
+
+    sort = args.get('sort', 'newest')
+    if sort not in EMOTION_LABELS and sort != 'oldest':
+        sort = 'newest'
+    return ranges, dominant, sort
+
+# Long-range emotion time series for the dashboard chart
+@main_routes.route('/api/timeseries')
+@login_required
+def emotion_timeseries():
+    """Return bucketed, downsampled emotion scores as JSON"""
+    range_key = request.args.get('range', '90d')
+    points = request.args.get('points', DEFAULT_POINTS, type=int)
+
+    return jsonify(build_timeseries(current_user.id, range_key, points))
+
+# Insights page - streaks, rolling stats, weekday patterns and tag correlations
+@main_routes.route('/insights')
+@login_required
+def insights():
+    return render_template('insights.html', insights=build_insights(current_user.id))
+
+# Same insights as JSON
+@main_routes.route('/api/insights')
+@login_required
+def insights_api():
+    return jsonify(build_insights(current_user.id))
+
+# Tag suggestions while typing - the user's own tags first, then popular shared ones
+@main_routes.route('/api/tags/autocomplete')
+@login_required
+def tag_autocomplete():
+    prefix = request.args.get('q', '')
+    limit = request.args.get('limit', AUTOCOMPLETE_LIMIT, type=int)
+    return jsonify({'query': prefix, 'tags': suggest_tags(current_user.id, prefix, limit)})
+
+# Entries that felt like this one - emotion and wording combined
+@main_routes.route('/api/entries/<int:entry_id>/similar')
+@login_required
+def similar_entries_api(entry_id):
+    entry = db.session.get(Entry, entry_id)
+    if entry is None or entry.user_id != current_user.id:
+        return jsonify({'error': 'Entry not found'}), 404
+    k = request.args.get('k', SIMILAR_ENTRIES, type=int)
+    return jsonify({'entry_id': entry_id, 'similar': similar_entries(current_user.id, entry_id, k)})
+
+# Changes since the client's last sync - entries (with tags and scores) and deletions
+@main_routes.route('/api/sync')
+@login_required
+def sync_api():
+    try:
+        return jsonify(sync_changes(current_user.id, request.args.get('cursor'),
+                                    request.args.get('limit', SYNC_PAGE_SIZE, type=int)))
+    except InvalidCursor as e:
+        return jsonify({'error': str(e)}), 400
+
+# Anonymous platform-wide mood index - daily or weekly means and percentiles
+@main_routes.route('/api/community-mood')
+@login_required
+def community_mood_api():
+    period = request.args.get('period', 'day')
+    if period not in ('day', 'week'):
+        period = 'day'
+    days = max(1, min(MAX_DAYS, request.args.get('days', 30, type=int)))
+    percentiles = []
+    for value in request.args.get('percentiles', '').split(','):
+        try:
+            q = float(value)
+        except ValueError:
+            continue
+        if 0 <= q <= 100:
+            percentiles.append(int(q) if q.is_integer() else q)
+
+    return jsonify(community_mood(period, days, percentiles or DEFAULT_PERCENTILES))
+
+def build_dashboard_context(user_id):
+    """
+    The dashboard context, computed once for concurrent requests (several tabs, reloads)
+    of the same user while the journal hasn't changed.
+    """
+    try:
+        return coalesce('dashboard', user_id, lambda: compute_dashboard_context(user_id), *last_change(user_id))
+    except CoalesceTimeout as e:
+        current_app.logger.warning(f"{e}; building the dashboard separately")
+        return compute_dashboard_context(user_id)
+
+def shared_dashboard_aggregates(user_id):
+    """dashboard_aggregates(), computed once for concurrent requests of the same user"""
+    return coalesce('dashboard_aggregates', user_id, lambda: dashboard_aggregates(user_id), *last_change(user_id))
+
+def compute_dashboard_context(user_id):
+    """Everything the dashboard template shows for a user - recent entries, charts and trends"""
+    # Recent entries for the list at the bottom of the page
+    recent_entries = load_entry_rows(entry_rows_query(user_id)
+                                     .order_by(Entry.date_created.desc())
+                                     .limit(5))
+
+    # Get data for the line chart - last 7 days of emotion scores
+    import datetime
+    from collections import defaultdict
+    from sqlalchemy import func
+
+    seven_days_ago = datetime.datetime.utcnow() - datetime.timedelta(days=7)
+
+    # Query to get average scores per day
+    chart_data = db.session.query(
+        func.date(Entry.date_created).label('date'),
+        func.avg(Entry.joy).label('avg_joy'),
+        func.avg(Entry.sadness).label('avg_sadness'),
+        func.avg(Entry.anger).label('avg_anger'),
+        func.avg(Entry.fear).label('avg_fear'),
+        func.avg(Entry.surprise).label('avg_surprise')
+    ).filter(Entry.user_id == user_id,
+            Entry.date_created >= seven_days_ago,
+            Entry.dominant_emotion.isnot(None))\
+    .group_by(func.date(Entry.date_created))\
+    .order_by(func.date(Entry.date_created).asc())\
+    .all()
+
+    # Prepare data for Chart.js
+    dates = []
+    joy_scores = []
+    sadness_scores = []
+    anger_scores = []
+    fear_scores = []
+    surprise_scores = []
+
+    for data in chart_data:
+        # MySQL returns date objects and SQLite returns strings, so go through str()
+        dates.append(str(data.date)[:10])
+        joy_scores.append(round(data.avg_joy * 100, 1))
+        sadness_scores.append(round(data.avg_sadness * 100, 1))
+        anger_scores.append(round(data.avg_anger * 100, 1))
+        fear_scores.append(round(data.avg_fear * 100, 1))
+        surprise_scores.append(round(data.avg_surprise * 100, 1))
+    
+    # NEW: Get data for sparklines and summary (last 14 days)
+    from datetime import datetime, timezone
+    fourteen_days_ago = datetime.now(timezone.utc) - timedelta(days=14)
+    
+    chart_entries = load_score_rows(entry_rows_query(user_id, SCORE_ROW_COLUMNS)
+                                    .where(Entry.date_created >= fourteen_days_ago)
+                                    .order_by(Entry.date_created.asc()))
+    
+    # Prepare data for sparklines and summary
+    sparkline_data = {
+        'dates': [],
+        'joy': [], 'sadness': [], 'anger': [], 'fear': [], 'surprise': [],
+        'dominant_emotions': []
+    }
+    
+    # Group entries by date and calculate daily averages
+    daily_data = {}
+    for entry in chart_entries:
+        if entry.has_scores:
+            date_str = entry.date_created.strftime('%Y-%m-%d')
+            if date_str not in daily_data:
+                daily_data[date_str] = {
+                    'joy': [], 'sadness': [], 'anger': [], 'fear': [], 'surprise': [],
+                    'count': 0
+                }
+            
+            daily_data[date_str]['joy'].append(entry.joy)
+            daily_data[date_str]['sadness'].append(entry.sadness)
+            daily_data[date_str]['anger'].append(entry.anger)
+            daily_data[date_str]['fear'].append(entry.fear)
+            daily_data[date_str]['surprise'].append(entry.surprise)
+            daily_data[date_str]['count'] += 1
+    
+    # Calculate daily averages and dominant emotions
+    for date_str, emotions in sorted(daily_data.items()):
+        sparkline_data['dates'].append(date_str)
+        
+        for emotion in ['joy', 'sadness', 'anger', 'fear', 'surprise']:
+            avg = sum(emotions[emotion]) / len(emotions[emotion]) * 100 if emotions[emotion] else 0
+            sparkline_data[emotion].append(round(avg, 1))
+        
+        # Find dominant emotion for the day
+        emotion_avgs = {e: sparkline_data[e][-1] for e in ['joy', 'sadness', 'anger', 'fear', 'surprise']}
+        dominant_emotion = max(emotion_avgs.items(), key=lambda x: x[1])
+        sparkline_data['dominant_emotions'].append(dominant_emotion[0])
+    
+    # All-time and weekly statistics come from the nightly snapshot plus today's entries
+    # Shared with concurrent dashboards that gave up waiting for the whole context
+    aggregates = shared_dashboard_aggregates(user_id)
+    
+    # Calculate summary statistics (current week vs previous week)
+    summary_stats = calculate_weekly_summary(user_id, aggregates)
+    
+    # NEW: Calculate emotion distribution for pie chart
+    emotion_distribution = emotion_distribution_from(aggregates)
+    entry_count = aggregates.scored
+    
+    # Open the mood chart on a range with data - the last 7 days may have none
+    chart_range = '7d' if dates else default_range(user_id) if entry_count else None
+
+    # NEW: Weekly trend analysis (current week vs previous week)
+    from datetime import datetime, timezone
+    today = datetime.now(timezone.utc).date()
+    current_week_start = today - timedelta(days=today.weekday())
+    current_week_end = current_week_start + timedelta(days=6)
+
+    # Initialize trend_analysis as empty dict
+    trend_analysis = {}
+
+    # Only calculate trends if we have enough data
+    if entry_count >= 2:
+        current_day = day_number(current_week_start)
+        current_avg, current_count = week_averages(aggregates, current_day)
+        previous_avg, previous_count = week_averages(aggregates, current_day - 7)
+        
+        # Calculate trends (absolute difference)
+        for emotion in EMOTIONS:
+            current_val = current_avg.get(emotion, 0)
+            previous_val = previous_avg.get(emotion, 0)
+            
+            if previous_val > 0 or current_val > 0:  # If we have any data
+                change = current_val - previous_val  # Simple difference in percentage points
+                
+                trend_analysis[emotion] = {
+                    'change': round(change, 1),
+                    'current': round(current_val, 1),
+                    'previous': round(previous_val, 1),
+                    'direction': 'up' if change > 2 else 'down' if change < -2 else 'stable',
+                    'current_count': current_count,
+                    'previous_count': previous_count
+                }
+
+    return {
+        'entries': recent_entries,
+        'dates': dates,
+        'chart_range': chart_range,
+        'joy_scores': joy_scores,
+        'sadness_scores': sadness_scores,
+        'anger_scores': anger_scores,
+        'fear_scores': fear_scores,
+        'surprise_scores': surprise_scores,
+        'emotion_distribution': emotion_distribution,  # NEW
+        'entry_count': entry_count,  # NEW
+        'trend_analysis': trend_analysis,
+        'current_week_start': current_week_start,  # NEW
+        'current_week_end': current_week_end,      # NEW
+        'sparkline_data': sparkline_data,
+        'summary_stats': summary_stats,
+    }
+
+def calculate_weekly_summary(user_id, aggregates):
     """Calculate weekly summary statistics"""
     from datetime import datetime, timedelta, timezone
     
@@ -628,36 +863,18 @@ def calculate_weekly_summary(user_id):
     }
     
     # Helper function to calculate week stats
-    def get_week_stats(start_date, end_date):
-        entries = Entry.query\
-            .options(db.joinedload(Entry.emotion_score))\
-            .filter(Entry.user_id == user_id,
-                   Entry.date_created >= start_date,
-                   Entry.date_created <= end_date)\
-            .all()
-        
-        stats = {'entries': len(entries), 'joy': [], 'sadness': []}
-        
-        for entry in entries:
-            if entry.emotion_score:
-                stats['joy'].append(entry.emotion_score.joy)
-                stats['sadness'].append(entry.emotion_score.sadness)
-        
-        stats['avg_joy'] = (sum(stats['joy']) / len(stats['joy']) * 100) if stats['joy'] else 0
-        stats['avg_sadness'] = (sum(stats['sadness']) / len(stats['sadness']) * 100) if stats['sadness'] else 0
-        
-        return stats
+    def get_week_stats(start_date):
+        entries, _, _ = aggregates.week(day_number(start_date))
+        averages, _ = week_averages(aggregates, day_number(start_date))
+        return {
+            'entries': entries,
+            'avg_joy': averages.get('joy', 0),
+            'avg_sadness': averages.get('sadness', 0),
+        }
     
     # Get stats for both weeks
-    current_stats = get_week_stats(
-        datetime.combine(current_week_start, datetime.min.time()),
-        datetime.combine(current_week_start + timedelta(days=6), datetime.max.time())
-    )
-    
-    previous_stats = get_week_stats(
-        datetime.combine(previous_week_start, datetime.min.time()),
-        datetime.combine(previous_week_start + timedelta(days=6), datetime.max.time())
-    )
+    current_stats = get_week_stats(current_week_start)
+    previous_stats = get_week_stats(previous_week_start)
     
     summary['current_week'] = current_stats
     summary['previous_week'] = previous_stats
@@ -0,0 +1,558 @@
+"""
+User-keyed horizontal sharding.
+
+Each user's journal data (entries with their emotion scores, chunk scores,
+entry_tag links, archived text, text features and deletion tombstones) lives on
+one shard database. The global database keeps the catalog: users, the shard map,
+tags and the entry id allocator. Tags are copied into every shard as well so
+queries that join tags with entries never leave the shard.
+
+Sharding is off unless SHARD_DATABASE_URLS is set (comma-separated URLs).
+A shard whose URL equals DATABASE_URL simply uses the global database.
+Shard databases are migrated with `flask shards upgrade` after `flask db upgrade`.
+"""
+import hashlib
+import threading
+import time
+from contextlib import contextmanager
+from flask import current_app, g, has_app_context, request, flash, redirect, url_for, jsonify
+from flask_sqlalchemy.session import Session
+from sqlalchemy import MetaData, select, delete, insert, func, event, inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql.util import find_tables
+
+# Tables that hold per-user data and live on the user's shard
+SHARDED_TABLES = {'entry', 'entry_chunk', 'entry_tag', 'archived_content', 'entry_features', 'entry_tombstone'}
+# Global tables that are also copied to every shard so joins stay local.
+# While a shard is selected these are read and written on the shard.
+REPLICATED_TABLES = {'tag'}
+
+# How many entry ids a process reserves from the global allocator at once
+ID_BLOCK_SIZE = 100
+
+# Request methods that change data - blocked while the user's data is being moved
+WRITE_METHODS = {'POST', 'PUT', 'PATCH', 'DELETE'}
+# A write request locks the user's shard map row before it writes, and refuses to write
+# if a move has started, so a move never depends on how long requests take. It still
+# waits this long after blocking writes: a request's shard and catalog transactions
+# commit one after the other, and users without a shard map row have nothing to lock.
+MOVE_SETTLE_SECONDS = 5
+
+
+class JournalMoving(RuntimeError):
+    """A write reached the database after the user's journal started moving"""
+
+
+def configure_shards(app, database_url, shard_urls):
+    """Turn the configured shard URLs into Flask-SQLAlchemy binds (call before db.init_app)"""
+    urls = [url.strip() for url in (shard_urls or '').split(',') if url.strip()]
+    shards = {}
+    binds = app.config.setdefault('SQLALCHEMY_BINDS', {})
+    for index, url in enumerate(urls):
+        name = f'shard{index}'
+        if url == database_url:
+            # Same database as the catalog - use the default engine
+            shards[name] = None
+        else:
+            binds[name] = url
+            shards[name] = name
+    app.config['SHARDS'] = shards
+
+
+def sharding_enabled():
+    return has_app_context() and bool(current_app.config.get('SHARDS'))
+
+
+def shard_names():
+    return list(current_app.config.get('SHARDS', {}))
+
+
+def current_shard():
+    return g.get('shard')
+
+
+def shard_engine(db, name):
+    return db.engines[current_app.config['SHARDS'][name]]
+
+
+class ShardedSession(Session):
+    """Send statements that touch per-user tables to the current user's shard"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and sharding_enabled():
+            tables = _tables_in(mapper, clause)
+            shard = current_shard()
+            if shard is not None and tables & (SHARDED_TABLES | REPLICATED_TABLES):
+                # The shard's copy of `tag` is used too: the ORM writes entry_tag rows
+                # through the Tag mapper's connection, so both must share an engine
+                return shard_engine(self._db, shard)
+            if tables & SHARDED_TABLES:
+                raise RuntimeError('Query touches sharded tables but no shard is selected; '
+                                   'wrap it in use_shard() or run it inside a user request.')
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def _tables_in(mapper, clause):
+    tables = set()
+    if mapper is not None:
+        tables.update(table.name for table in getattr(mapper, 'tables', ()))
+        local_table = getattr(mapper, 'local_table', None)
+        if local_table is not None:
+            tables.add(local_table.name)
+    if clause is not None:
+        tables.update(
+            getattr(table, 'name', None)
+            for table in find_tables(clause, include_joins=True, include_selects=True, include_crud=True)
+        )
+    return tables
+
+
+@contextmanager
+def use_shard(name):
+    """Run the enclosed queries against a specific shard"""
+    previous = g.get('shard')
+    g.shard = name
+    try:
+        yield name
+    finally:
+        g.shard = previous
+
+
+def each_shard():
+    """Iterate over every shard with it selected (just once, unselected, when sharding is off)"""
+    if not sharding_enabled():
+        yield None
+        return
+    for name in shard_names():
+        with use_shard(name):
+            yield name
+
+
+def get_user_shard(user_id):
+    """The shard map row for a user, or None for users created before sharding"""
+    from app import db
+    from app.models import UserShard
+    return db.session.get(UserShard, user_id)
+
+
+def shard_for_user(user_id):
+    mapping = get_user_shard(user_id)
+    if mapping is not None:
+        return mapping.shard
+    # Users from before sharding keep their data on the first shard
+    return shard_names()[0]
+
+
+def assign_shard(user_id):
+    """Place a new user on a shard and record it in the shard map"""
+    from app import db
+    from app.models import UserShard
+    names = shard_names()
+    mapping = UserShard(user_id=user_id, shard=names[user_id % len(names)])
+    db.session.add(mapping)
+    return mapping
+
+
+def init_sharding(app, db):
+    """Per-request shard selection, write blocking during moves and model events"""
+    if not app.config.get('SHARDS'):
+        return
+
+    from flask_login import current_user
+
+    @app.before_request
+    def select_user_shard():
+        if not current_user.is_authenticated:
+            return None
+
+        mapping = get_user_shard(current_user.id)
+        g.shard = mapping.shard if mapping is not None else shard_names()[0]
+        # Whose shard map row this request's writes are checked against
+        g.shard_user_id = current_user.id
+
+        if request.method not in WRITE_METHODS:
+            return None
+
+        # Reads keep working while a user's data is moved; writes wait until it's done
+        if mapping is not None and mapping.status == 'moving':
+            return journal_moving_response()
+
+        # Top up reserved entry ids now, before this request's session holds any locks
+        reserve_entry_ids(db)
+        return None
+
+    @app.errorhandler(JournalMoving)
+    def refuse_write_during_move(error):
+        # The session has been rolled back - nothing was written
+        db.session.rollback()
+        return journal_moving_response()
+
+    _register_model_events(db)
+    _register_session_events()
+
+
+def journal_moving_response():
+    if request.path.startswith('/api/'):
+        return jsonify({'error': 'Your journal is being moved. Please try again shortly.'}), 503
+    flash('Your journal is being moved to a new server. Please try again in a minute.', 'warning')
+    return redirect(url_for('main.dashboard'))
+
+
+# Reserved entry ids for this process: [next, end)
+_id_block = {'next': 0, 'end': 0}
+_id_lock = threading.Lock()
+
+
+def reserve_entry_ids(db, minimum=ID_BLOCK_SIZE // 5):
+    """Make sure this process has at least `minimum` entry ids reserved"""
+    with _id_lock:
+        _top_up_ids(db, minimum)
+
+
+def allocate_entry_id(db):
+    """Globally unique entry ids, so a user's entries can move between shards unchanged"""
+    with _id_lock:
+        _top_up_ids(db, 1)
+        value = _id_block['next']
+        _id_block['next'] += 1
+        return value
+
+
+def _top_up_ids(db, minimum):
+    # Caller holds _id_lock. Unused ids from an old block are simply skipped.
+    if _id_block['end'] - _id_block['next'] < minimum:
+        start = _reserve_id_block(db, 'entry', ID_BLOCK_SIZE)
+        _id_block['next'], _id_block['end'] = start, start + ID_BLOCK_SIZE
+
+
+def _reserve_id_block(db, name, size):
+    from app.models import IdBlock, Entry
+    # A separate, immediately committed transaction on the global database
+    with db.engines[None].begin() as connection:
+        current = connection.execute(
+            select(IdBlock.next_value).where(IdBlock.name == name).with_for_update()
+        ).scalar()
+        if current is None:
+            # First use: start above every id that already exists on any shard
+            current = 1 + max(
+                (engine_max_id(shard_engine(db, shard), Entry.__table__) for shard in shard_names()),
+                default=0
+            )
+            connection.execute(insert(IdBlock.__table__).values(name=name, next_value=current + size))
+        else:
+            connection.execute(
+                IdBlock.__table__.update().where(IdBlock.name == name).values(next_value=current + size)
+            )
+    return current
+
+
+def engine_max_id(engine, table):
+    with engine.connect() as connection:
+        return connection.execute(select(func.max(table.c.id))).scalar() or 0
+
+
+def _register_model_events(db):
+    from app.models import Entry, Tag
+    # create_app() can run more than once in a process (tests, CLI) - only listen once
+    if not event.contains(Entry, 'before_insert', _assign_entry_id):
+        event.listen(Entry, 'before_insert', _assign_entry_id)
+    if not event.contains(Tag, 'before_insert', _assign_tag_id):
+        event.listen(Tag, 'before_insert', _assign_tag_id)
+    if not event.contains(Tag, 'after_insert', _replicate_tag):
+        event.listen(Tag, 'after_insert', _replicate_tag)
+
+
+def _register_session_events():
+    if not event.contains(ShardedSession, 'before_flush', _check_shard_before_flush):
+        event.listen(ShardedSession, 'before_flush', _check_shard_before_flush)
+    if not event.contains(ShardedSession, 'do_orm_execute', _check_shard_before_execute):
+        event.listen(ShardedSession, 'do_orm_execute', _check_shard_before_execute)
+
+
+def _check_shard_before_flush(session, flush_context, instances):
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if _tables_in(inspect(obj).mapper, None) & SHARDED_TABLES:
+            lock_user_shard(session)
+            return
+
+
+def _check_shard_before_execute(orm_execute_state):
+    # Bulk UPDATE/DELETE statements don't go through a flush
+    if orm_execute_state.is_update or orm_execute_state.is_delete or orm_execute_state.is_insert:
+        if _tables_in(None, orm_execute_state.statement) & SHARDED_TABLES:
+            lock_user_shard(orm_execute_state.session)
+
+
+def lock_user_shard(session):
+    """
+    Before a request writes to its user's shard: lock the user's shard map row until the
+    transaction ends and make sure the journal still lives on the shard the request picked.
+    A move flips the row to 'moving' before copying, so it waits for writes that hold
+    the lock, and writes that come later are refused with JournalMoving.
+    """
+    from app.models import UserShard
+    if not sharding_enabled():
+        return
+    user_id, shard = g.get('shard_user_id'), current_shard()
+    if user_id is None or shard is None:
+        return  # not a user request (CLI jobs pick their shard themselves)
+
+    mapping = session.execute(
+        select(UserShard.shard, UserShard.status).where(UserShard.user_id == user_id).with_for_update()
+    ).first()
+    if mapping is None:
+        return  # users from before sharding stay on the first shard until moved
+    if mapping.status == 'moving' or mapping.shard != shard:
+        raise JournalMoving(f'User {user_id} is moving from {shard}; refusing the write')
+
+
+def _assign_entry_id(mapper, connection, target):
+    from app import db
+    if sharding_enabled() and target.id is None:
+        target.id = allocate_entry_id(db)
+
+
+def _current_bind_key():
+    shard = current_shard()
+    return current_app.config['SHARDS'][shard] if shard is not None else None
+
+
+def _assign_tag_id(mapper, connection, target):
+    """A tag created on a shard takes its id from the global catalog"""
+    from app import db
+    if not sharding_enabled() or _current_bind_key() is None or target.id is not None:
+        return  # being inserted into the global database itself
+
+    table = mapper.local_table
+    # Its own committed transaction, so the catalog id is settled before the shard insert
+    with db.engines[None].begin() as catalog:
+        tag_id = catalog.execute(select(table.c.id).where(table.c.name == target.name)).scalar()
+        if tag_id is None:
+            try:
+                with catalog.begin_nested():
+                    tag_id = catalog.execute(insert(table).values(name=target.name)).inserted_primary_key[0]
+            except IntegrityError:
+                # Another request created the same tag first
+                tag_id = catalog.execute(select(table.c.id).where(table.c.name == target.name)).scalar()
+    target.id = tag_id
+
+
+def _replicate_tag(mapper, connection, target):
+    """Copy a new tag into the other shards (the global copy already exists)"""
+    from app import db
+    if not sharding_enabled():
+        return
+    current = _current_bind_key()
+    for bind_key in set(current_app.config['SHARDS'].values()):
+        if bind_key is None or bind_key == current:
+            continue
+        with db.engines[bind_key].begin() as shard_connection:
+            _upsert_tag(shard_connection, mapper.local_table, target.id, target.name)
+
+
+def _upsert_tag(connection, table, tag_id, name):
+    connection.execute(delete(table).where((table.c.id == tag_id) | (table.c.name == name)))
+    connection.execute(insert(table).values(id=tag_id, name=name))
+
+
+def shard_metadata(db):
+    """Copies of the sharded and replicated tables without foreign keys to global-only tables"""
+    metadata = MetaData()
+    for table in db.metadata.sorted_tables:
+        if table.name in SHARDED_TABLES | REPLICATED_TABLES:
+            copy = table.to_metadata(metadata)
+            for constraint in list(copy.foreign_key_constraints):
+                # target_fullname is 'table.column'; the target table isn't in this metadata
+                referred = constraint.elements[0].target_fullname.split('.')[0]
+                if referred not in SHARDED_TABLES | REPLICATED_TABLES:
+                    copy.constraints.discard(constraint)
+                    for foreign_key in constraint.elements:
+                        copy.foreign_keys.discard(foreign_key)
+                        foreign_key.parent.foreign_keys.discard(foreign_key)
+    return metadata
+
+
+def migrating_shard():
+    """Inside a migration: the shard it runs on (`flask shards upgrade`), or None for the global database"""
+    from alembic import context
+    return context.config.attributes.get('shard')
+
+
+def init_shard_tables(db):
+    """Create the shard tables where missing and bring every shard's tag copy up to date"""
+    from app.models import Tag
+    metadata = shard_metadata(db)
+    with db.engines[None].connect() as connection:
+        tags = connection.execute(select(Tag.id, Tag.name)).all()
+
+    for name, bind_key in current_app.config['SHARDS'].items():
+        engine = db.engines[bind_key]
+        metadata.create_all(engine)
+        if bind_key is None:
+            continue
+        with engine.begin() as connection:
+            existing = set(connection.execute(select(metadata.tables['tag'].c.id, metadata.tables['tag'].c.name)).all())
+            for tag in tags:
+                if (tag.id, tag.name) not in existing:
+                    _upsert_tag(connection, metadata.tables['tag'], tag.id, tag.name)
+
+
+def move_user(db, user_id, target, chunk_size=500, settle_seconds=MOVE_SETTLE_SECONDS, echo=print):
+    """
+    Move one user's journal to another shard.
+    The user can keep reading throughout; their writes are refused (status 'moving')
+    until the copy is verified and the shard map points at the target.
+    """
+    from app.models import UserShard, Entry, EntryChunk, ArchivedContent, EntryFeatures, EntryTombstone, entry_tag
+
+    if target not in shard_names():
+        raise ValueError(f'Unknown shard {target!r}')
+
+    source = shard_for_user(user_id)
+    if source == target:
+        echo(f'User {user_id} is already on {target}.')
+        return 0
+
+    # Shards that share an engine are the same database - only the map needs changing
+    same_database = current_app.config['SHARDS'][source] == current_app.config['SHARDS'][target]
+
+    mapping = get_user_shard(user_id)
+    if mapping is None:
+        mapping = UserShard(user_id=user_id, shard=source)
+        db.session.add(mapping)
+    mapping.status = 'moving'
+    db.session.commit()
+
+    source_engine = shard_engine(db, source)
+    target_engine = shard_engine(db, target)
+    entries = Entry.__table__
+    archives = ArchivedContent.__table__
+    chunks = EntryChunk.__table__
+    features = EntryFeatures.__table__
+    copied = 0
+
+    try:
+        if not same_database:
+            # Writes already under way either hold the shard map lock (and the flip above waited
+            # for them) or will be refused when they flush; give their last commits a moment
+            if settle_seconds:
+                echo(f'Waiting {settle_seconds}s for writes in progress...')
+                time.sleep(settle_seconds)
+
+            # Clear anything left on the target by an earlier, interrupted move
+            _delete_user_rows(target_engine, user_id, chunk_size)
+
+            chunk_columns = [c for c in chunks.c if c.name != 'id']  # ids are per shard
+            after_id = 0
+            while True:
+                with source_engine.connect() as src:
+                    rows = src.execute(
+                        select(entries).where(entries.c.user_id == user_id, entries.c.id > after_id)
+                        .order_by(entries.c.id).limit(chunk_size)
+                    ).mappings().all()
+                    if not rows:
+                        break
+                    ids = [row['id'] for row in rows]
+                    tag_rows = src.execute(select(entry_tag).where(entry_tag.c.entry_id.in_(ids))).mappings().all()
+                    archive_rows = src.execute(select(archives).where(archives.c.entry_id.in_(ids))).mappings().all()
+                    chunk_rows = src.execute(select(*chunk_columns).where(chunks.c.entry_id.in_(ids))).mappings().all()
+                    feature_rows = src.execute(select(features).where(features.c.entry_id.in_(ids))).mappings().all()
+
+                with target_engine.begin() as dst:
+                    dst.execute(insert(entries), [dict(row) for row in rows])
+                    if tag_rows:
+                        dst.execute(insert(entry_tag), [dict(row) for row in tag_rows])
+                    if archive_rows:
+                        dst.execute(insert(archives), [dict(row) for row in archive_rows])
+                    if chunk_rows:
+                        dst.execute(insert(chunks), [dict(row) for row in chunk_rows])
+                    if feature_rows:
+                        dst.execute(insert(features), [dict(row) for row in feature_rows])
+
+                copied += len(rows)
+                after_id = ids[-1]
+                echo(f'Copied {copied} entries...')
+
+            # Tombstones too, so the user's sync clients still hear about old deletions
+            tombstones = EntryTombstone.__table__
+            after_id = 0
+            while True:
+                with source_engine.connect() as src:
+                    rows = src.execute(
+                        select(tombstones).where(tombstones.c.user_id == user_id, tombstones.c.entry_id > after_id)
+                        .order_by(tombstones.c.entry_id).limit(chunk_size)
+                    ).mappings().all()
+                if not rows:
+                    break
+                with target_engine.begin() as dst:
+                    dst.execute(insert(tombstones), [dict(row) for row in rows])
+                after_id = rows[-1]['entry_id']
+
+            # Verify before switching over. Comparing update times as well as ids catches
+            # edits to rows that were already copied, not just inserts and deletes.
+            source_count, source_digest = _journal_digest(source_engine, user_id, chunk_size)
+            target_count, target_digest = _journal_digest(target_engine, user_id, chunk_size)
+            if source_digest != target_digest:
+                raise RuntimeError(f'Copy mismatch: {source_count} entries on {source}, {target_count} on {target}'
+                                   ' (or the journal changed during the copy); run the move again')
+
+        mapping.shard = target
+        mapping.status = 'active'
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        mapping = get_user_shard(user_id)
+        mapping.status = 'active'  # the user stays on the source shard
+        db.session.commit()
+        raise
+
+    if not same_database:
+        # Only now is it safe to remove the old copy
+        _delete_user_rows(source_engine, user_id, chunk_size)
+    echo(f'Moved user {user_id} from {source} to {target} ({copied} entries).')
+    return copied
+
+
+def _journal_digest(engine, user_id, chunk_size):
+    """(entries, digest of every entry's id and updated_at and every tombstone) for one user"""
+    from app.models import Entry, EntryTombstone
+    digest = hashlib.sha256()
+    count = 0
+    for table, id_column, time_column in ((Entry.__table__, 'id', 'updated_at'),
+                                          (EntryTombstone.__table__, 'entry_id', 'deleted_at')):
+        after_id = 0
+        while True:
+            with engine.connect() as connection:
+                rows = connection.execute(
+                    select(table.c[id_column], table.c[time_column])
+                    .where(table.c.user_id == user_id, table.c[id_column] > after_id)
+                    .order_by(table.c[id_column]).limit(chunk_size)
+                ).all()
+            if not rows:
+                break
+            for row_id, changed_at in rows:
+                # Whole seconds: MySQL DATETIME columns drop the microseconds
+                digest.update(f'{table.name}:{row_id}:{changed_at.replace(microsecond=0).isoformat()}\n'.encode())
+            if table is Entry.__table__:
+                count += len(rows)
+            after_id = rows[-1][0]
+    return count, digest.hexdigest()
+
+
+def _delete_user_rows(engine, user_id, chunk_size):
+    from app.models import Entry, EntryChunk, ArchivedContent, EntryFeatures, EntryTombstone, entry_tag
+    entries = Entry.__table__
+    with engine.begin() as connection:
+        connection.execute(delete(EntryTombstone.__table__).where(EntryTombstone.__table__.c.user_id == user_id))
+    while True:
+        with engine.begin() as connection:
+            ids = connection.execute(
+                select(entries.c.id).where(entries.c.user_id == user_id).limit(chunk_size)
+            ).scalars().all()
+            if not ids:
+                break
+            connection.execute(delete(entry_tag).where(entry_tag.c.entry_id.in_(ids)))
+            connection.execute(delete(ArchivedContent.__table__).where(ArchivedContent.__table__.c.entry_id.in_(ids)))
+            connection.execute(delete(EntryChunk.__table__).where(EntryChunk.__table__.c.entry_id.in_(ids)))
+            connection.execute(delete(EntryFeatures.__table__).where(EntryFeatures.__table__.c.entry_id.in_(ids)))
+            connection.execute(delete(entries).where(entries.c.id.in_(ids)))
@@ -0,0 +1,252 @@
+"""
+"Entries that felt like this one".
+
+Each entry is described by its normalized emotion vector and by hashed word
+features (entry_features, written with the entry), weighted by TF-IDF over the
+user's own journal. Similarity is a weighted mix of the two cosines.
+
+A user's features are loaded into one float32 matrix, so a lookup is a single
+matrix-vector product. Matrices of recently active users stay in a bounded LRU
+cache. Before each lookup the cache catches up on the user's changes through
+the delta-sync change stream (app/sync.py), so writes from other processes are
+picked up without re-reading the whole journal.
+"""
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import numpy as np
+from sqlalchemy import select
+from app import db
+from app.models import Entry, EntryFeatures
+from app.utils import EMOTION_LABELS, TEXT_FEATURE_DIM, text_features, decode_scores
+from app.archive import archived_texts
+from app.sync import change_stream, SYNC_SETTLE_SECONDS
+
+SIMILAR_ENTRIES = 5
+MAX_SIMILAR_ENTRIES = 50
+# How much the emotion cosine counts against the text cosine
+EMOTION_WEIGHT = 0.6
+# Memory for cached user matrices (100k entries take about 55 MB of arrays)
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+LOAD_CHUNK_SIZE = 5000
+# Changes applied incrementally use the IDF from the last full load; after this
+# share of the journal has changed, the matrix is rebuilt with fresh weights
+REBUILD_FRACTION = 0.2
+
+
+def _normalize(rows):
+    norms = np.linalg.norm(rows, axis=1, keepdims=True)
+    return np.divide(rows, norms, out=np.zeros_like(rows), where=norms > 0)
+
+
+def load_features(user_id, entry_ids=None, chunk_size=LOAD_CHUNK_SIZE):
+    """(ids, emotion vectors, term frequencies) for the user's entries, optionally only some"""
+    ids, emotions, texts = [], [], []
+    after_id = 0
+    while True:
+        query = select(Entry.id, EntryFeatures.text_vector, *[getattr(Entry, label) for label in EMOTION_LABELS])\
+            .outerjoin(EntryFeatures, EntryFeatures.entry_id == Entry.id)\
+            .where(Entry.user_id == user_id, Entry.id > after_id)
+        if entry_ids is not None:
+            query = query.where(Entry.id.in_(entry_ids))
+        rows = db.session.execute(query.order_by(Entry.id).limit(chunk_size)).all()
+        if not rows:
+            break
+        after_id = rows[-1].id
+
+        # Entries written before features existed: compute from the text (see `flask text-features`)
+        missing = _missing_features([row.id for row in rows if row.text_vector is None])
+        for row in rows:
+            ids.append(row.id)
+            vector = row.text_vector
+            texts.append(np.frombuffer(vector, dtype='<f2') if vector is not None else missing[row.id])
+        emotions.append(np.nan_to_num(decode_scores([row[2:] for row in rows])))
+
+    if not ids:
+        return (np.empty(0, dtype=np.int64), np.empty((0, len(EMOTION_LABELS)), dtype=np.float32),
+                np.empty((0, TEXT_FEATURE_DIM), dtype=np.float32))
+    return np.array(ids, dtype=np.int64), np.vstack(emotions), np.array(texts, dtype=np.float32)
+
+
+def _missing_features(entry_ids):
+    if not entry_ids:
+        return {}
+    rows = db.session.execute(select(Entry.id, Entry.content, Entry.archived).where(Entry.id.in_(entry_ids))).all()
+    cold = archived_texts([row.id for row in rows if row.archived])
+    return {row.id: text_features(cold.get(row.id, row.content)) for row in rows}
+
+
+class UserMatrix:
+    """One user's entries as normalized emotion and TF-IDF rows, kept current incrementally"""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        ids, emotions, tf = load_features(self.user_id)
+        document_frequency = (tf > 0).sum(axis=0)
+        self.idf = (np.log((1 + len(ids)) / (1 + document_frequency)) + 1).astype(np.float32)
+        self.ids = ids
+        self.emotions = _normalize(emotions)
+        self.texts = _normalize(tf * self.idf)
+        self.rows = {entry_id: row for row, entry_id in enumerate(ids.tolist())}
+        self.changed = 0
+        # Changes stamped before this are in the matrix (minus the sync settle window)
+        self.synced_at = datetime.utcnow()
+
+    @property
+    def nbytes(self):
+        return self.ids.nbytes + self.emotions.nbytes + self.texts.nbytes
+
+    def refresh(self):
+        """Apply the user's changes since the last load or refresh"""
+        now = datetime.utcnow()
+        # Re-read the settle window every time: a late commit can carry an earlier timestamp
+        position = (self.synced_at - timedelta(seconds=SYNC_SETTLE_SECONDS), 0)
+        updated, deleted = set(), set()
+        while True:
+            changes = change_stream(self.user_id, position, now, LOAD_CHUNK_SIZE)
+            for change in changes:
+                (deleted if change.deleted else updated).add(change.entry_id)
+            if len(changes) < LOAD_CHUNK_SIZE:
+                break
+            position = (changes[-1].changed_at, changes[-1].entry_id)
+
+        self.changed += len(updated) + len(deleted)
+        if self.changed > REBUILD_FRACTION * max(len(self.ids), 1):
+            self.load()
+            return
+        # An id in both was deleted and reused; only the live entry matters
+        self._remove(deleted - updated)
+        self._upsert(updated)
+        self.synced_at = now
+
+    def _remove(self, entry_ids):
+        rows = [self.rows[entry_id] for entry_id in entry_ids if entry_id in self.rows]
+        if not rows:
+            return
+        keep = np.ones(len(self.ids), dtype=bool)
+        keep[rows] = False
+        self.ids, self.emotions, self.texts = self.ids[keep], self.emotions[keep], self.texts[keep]
+        self.rows = {entry_id: row for row, entry_id in enumerate(self.ids.tolist())}
+
+    def _upsert(self, entry_ids):
+        if not entry_ids:
+            return
+        ids, emotions, tf = load_features(self.user_id, list(entry_ids))
+        emotions, texts = _normalize(emotions), _normalize(tf * self.idf)
+        new = []
+        for i, entry_id in enumerate(ids.tolist()):
+            row = self.rows.get(entry_id)
+            if row is None:
+                new.append(i)
+            else:
+                self.emotions[row], self.texts[row] = emotions[i], texts[i]
+        if new:
+            start = len(self.ids)
+            self.ids = np.concatenate([self.ids, ids[new]])
+            self.emotions = np.vstack([self.emotions, emotions[new]])
+            self.texts = np.vstack([self.texts, texts[new]])
+            for offset, entry_id in enumerate(ids[new].tolist()):
+                self.rows[entry_id] = start + offset
+
+    def similar(self, entry_id, k):
+        """[(entry id, similarity)] of the k entries closest to entry_id, best first"""
+        row = self.rows.get(entry_id)
+        if row is None or len(self.ids) < 2:
+            return []
+        scores = EMOTION_WEIGHT * (self.emotions @ self.emotions[row]) \
+            + (1 - EMOTION_WEIGHT) * (self.texts @ self.texts[row])
+        scores[row] = -np.inf
+        k = min(k, len(self.ids) - 1)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(self.ids[i]), float(scores[i])) for i in top]
+
+
+class MatrixCache:
+    """Least recently used user matrices, within a memory budget"""
+
+    def __init__(self, max_bytes=CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.matrices = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, user_id):
+        with self.lock:
+            matrix = self.matrices.get(user_id)
+            if matrix is not None:
+                self.matrices.move_to_end(user_id)
+        if matrix is None:
+            matrix = UserMatrix(user_id)
+            with self.lock:
+                # Another request may have loaded it meanwhile; either copy is current
+                self.matrices[user_id] = matrix
+                self._evict()
+            return matrix
+        with matrix.lock:
+            matrix.refresh()
+        return matrix
+
+    def _evict(self):
+        total = sum(matrix.nbytes for matrix in self.matrices.values())
+        # Always keep the most recent one, even if it alone is over budget
+        while total > self.max_bytes and len(self.matrices) > 1:
+            _, matrix = self.matrices.popitem(last=False)
+            total -= matrix.nbytes
+
+
+_cache = MatrixCache()
+
+
+def similar_entries(user_id, entry_id, k=SIMILAR_ENTRIES):
+    """The user's entries most like entry_id, with dates, moods and a snippet"""
+    matrix = _cache.get(user_id)
+    with matrix.lock:
+        matches = matrix.similar(entry_id, max(1, min(MAX_SIMILAR_ENTRIES, k)))
+    if not matches:
+        return []
+
+    rows = {row.id: row for row in db.session.execute(
+        select(Entry.id, Entry.content, Entry.archived, Entry.date_created, Entry.dominant_emotion)
+        .where(Entry.id.in_([entry_id for entry_id, _ in matches]))
+    )}
+    cold = archived_texts([row.id for row in rows.values() if row.archived])
+    results = []
+    for match_id, score in matches:
+        row = rows.get(match_id)
+        if row is None:  # deleted since the last refresh
+            continue
+        text = cold.get(row.id, row.content)
+        results.append({
+            'id': row.id,
+            'date_created': row.date_created.isoformat(),
+            'dominant_emotion': row.dominant_emotion,
+            'snippet': text[:140] + ('…' if len(text) > 140 else ''),
+            'similarity': round(score, 3),
+        })
+    return results
+
+
+def build_text_features(user_id=None, chunk_size=LOAD_CHUNK_SIZE, echo=None):
+    """Store features for entries on the current shard that have none yet. Returns how many."""
+    built = 0
+    after_id = 0
+    while True:
+        query = select(Entry.id).outerjoin(EntryFeatures, EntryFeatures.entry_id == Entry.id)\
+            .where(EntryFeatures.entry_id.is_(None), Entry.id > after_id)
+        if user_id is not None:
+            query = query.where(Entry.user_id == user_id)
+        ids = db.session.execute(query.order_by(Entry.id).limit(chunk_size)).scalars().all()
+        if not ids:
+            return built
+        after_id = ids[-1]
+        features = _missing_features(ids)
+        db.session.add_all(EntryFeatures(entry_id=entry_id, text_vector=vector.astype('<f2').tobytes())
+                           for entry_id, vector in features.items())
+        db.session.commit()
+        built += len(features)
+        if echo:
+            echo(f'Built features for {built} entries (last id {after_id})')
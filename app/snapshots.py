@@ -0,0 +1,280 @@
+"""
+Per-user insight snapshots.
+
+`flask snapshot-insights` runs nightly (e.g. from cron). It streams every user's
+entries and stores mergeable aggregates - counts and emotion score sums,
+all-time and per week - in user_snapshot. The dashboard then only aggregates
+entries created since the snapshot (usually just today's) and merges them in,
+instead of loading the user's whole history on every request.
+
+Editing or deleting entries the snapshot already covers drops the snapshot, so
+the dashboard falls back to aggregating everything until the next run. A change
+made while the job is running is caught on read instead: a snapshot is ignored
+once anything it covers was updated or deleted after the job read it.
+"""
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timezone
+import numpy as np
+from sqlalchemy import select, delete
+from app import db
+from app.models import User, Entry, EntryTombstone, UserSnapshot
+from app.utils import EMOTIONS, EMOTION_LABELS, decode_scores
+from app.sharding import sharding_enabled, shard_for_user, use_shard
+
+# Weeks of history kept in a snapshot (enough for long-term trends)
+SNAPSHOT_WEEKS = 52
+# Entries fetched per query while streaming a user's history
+SNAPSHOT_CHUNK_SIZE = 2000
+# Users handed to a worker process at a time
+SNAPSHOT_PARTITION_SIZE = 50
+
+
+def week_start(day):
+    """Monday of the week containing `day` (days since the epoch)"""
+    # 1970-01-01 was a Thursday, so (day + 3) % 7 gives Monday == 0
+    return day - (day + 3) % 7
+
+
+def day_number(date):
+    return int(np.datetime64(date, 'D').astype(np.int64))
+
+
+class EntryAggregates:
+    """Entry counts and emotion score sums, all-time and per week. Two of these merge by adding."""
+
+    def __init__(self, entries=0, scored=0, sums=None, weeks=None):
+        self.entries = entries
+        self.scored = scored
+        self.sums = np.zeros(len(EMOTION_LABELS)) if sums is None else np.asarray(sums, dtype=np.float64)
+        # week start (days since the epoch) -> [entries, scored, sums]
+        self.weeks = weeks if weeks is not None else {}
+
+    def add_rows(self, rows):
+        """Add rows of (date_created, dominant_emotion, *EMOTION_LABELS)"""
+        if not rows:
+            return
+        days = np.array([row[0] for row in rows], dtype='datetime64[D]').astype(np.int64)
+        scored = np.array([row[1] is not None for row in rows])
+        scores = np.nan_to_num(decode_scores([row[2:] for row in rows], dtype=np.float64))
+        scores[~scored] = 0.0
+
+        self.entries += len(rows)
+        self.scored += int(scored.sum())
+        self.sums += scores.sum(axis=0)
+
+        weeks, inverse = np.unique(week_start(days), return_inverse=True)
+        entry_counts = np.bincount(inverse, minlength=len(weeks))
+        scored_counts = np.bincount(inverse, weights=scored, minlength=len(weeks))
+        week_sums = np.zeros((len(weeks), len(EMOTION_LABELS)))
+        np.add.at(week_sums, inverse, scores)
+        for i, week in enumerate(weeks.tolist()):
+            self._add_week(week, int(entry_counts[i]), int(scored_counts[i]), week_sums[i])
+
+    def _add_week(self, week, entries, scored, sums):
+        current = self.weeks.get(week)
+        if current is None:
+            self.weeks[week] = [entries, scored, np.array(sums, dtype=np.float64)]
+        else:
+            current[0] += entries
+            current[1] += scored
+            current[2] = current[2] + sums
+
+    def merge(self, other):
+        self.entries += other.entries
+        self.scored += other.scored
+        self.sums = self.sums + other.sums
+        for week, (entries, scored, sums) in other.weeks.items():
+            self._add_week(week, entries, scored, sums)
+        return self
+
+    def trim(self, weeks=SNAPSHOT_WEEKS):
+        """Forget all but the most recent weeks (all-time totals are kept)"""
+        for week in sorted(self.weeks)[:-weeks]:
+            del self.weeks[week]
+
+    def week(self, start_day):
+        """(entries, scored, sums) for the week starting on start_day"""
+        entries, scored, sums = self.weeks.get(start_day, (0, 0, np.zeros(len(EMOTION_LABELS))))
+        return entries, scored, sums
+
+    def snapshot_fields(self):
+        return {
+            'entries': self.entries,
+            'scored': self.scored,
+            'sums': self.sums.tolist(),
+            # JSON object keys are strings
+            'weeks': {str(week): [entries, scored, sums.tolist()]
+                      for week, (entries, scored, sums) in self.weeks.items()},
+        }
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        weeks = {int(week): [entries, scored, np.array(sums, dtype=np.float64)]
+                 for week, (entries, scored, sums) in snapshot.weeks.items()}
+        return cls(snapshot.entries, snapshot.scored, snapshot.sums, weeks)
+
+
+def entry_rows(user_id, since=None, before=None, chunk_size=SNAPSHOT_CHUNK_SIZE):
+    """Stream a user's (date, dominant, scores...) rows in chunks, in id order"""
+    columns = [Entry.date_created, Entry.dominant_emotion] + [getattr(Entry, label) for label in EMOTION_LABELS]
+    after_id = 0
+    while True:
+        query = select(Entry.id, *columns).where(Entry.user_id == user_id, Entry.id > after_id)
+        if since is not None:
+            query = query.where(Entry.date_created >= since)
+        if before is not None:
+            query = query.where(Entry.date_created < before)
+        rows = db.session.execute(query.order_by(Entry.id.asc()).limit(chunk_size)).all()
+        if not rows:
+            return
+        after_id = rows[-1][0]
+        yield [row[1:] for row in rows]
+
+
+def compute_aggregates(user_id, since=None, before=None, chunk_size=SNAPSHOT_CHUNK_SIZE):
+    aggregates = EntryAggregates()
+    for rows in entry_rows(user_id, since, before, chunk_size):
+        aggregates.add_rows(rows)
+    return aggregates
+
+
+def changed_since_snapshot(snapshot):
+    """
+    Whether entries the snapshot covers were edited or deleted after it read them.
+    invalidate_snapshot() drops the snapshot on every such change, but a change made
+    while the nightly job is running can come before the job writes its row.
+    """
+    # Seconds are compared inclusively: MySQL DATETIME columns drop the microseconds
+    edited = db.session.execute(
+        select(Entry.id).where(Entry.user_id == snapshot.user_id,
+                               Entry.updated_at >= snapshot.computed_at.replace(microsecond=0),
+                               Entry.date_created < snapshot.computed_through).limit(1)
+    ).first()
+    if edited is not None:
+        return True
+    # Tombstones don't keep the entry's date, so any deletion since counts
+    return db.session.execute(
+        select(EntryTombstone.entry_id).where(EntryTombstone.user_id == snapshot.user_id,
+                                              EntryTombstone.deleted_at >= snapshot.computed_at.replace(microsecond=0))
+        .limit(1)
+    ).first() is not None
+
+
+def dashboard_aggregates(user_id):
+    """The user's snapshot plus everything created since it was computed"""
+    snapshot = db.session.get(UserSnapshot, user_id)
+    if snapshot is None or changed_since_snapshot(snapshot):
+        return compute_aggregates(user_id)
+    aggregates = EntryAggregates.from_snapshot(snapshot)
+    return aggregates.merge(compute_aggregates(user_id, since=snapshot.computed_through))
+
+
+def invalidate_snapshot(user_id, entry_date=None):
+    """
+    Drop the user's snapshot after entries it covers were edited or deleted.
+    With entry_date, only if the snapshot includes that entry.
+    """
+    query = delete(UserSnapshot).where(UserSnapshot.user_id == user_id)
+    if entry_date is not None:
+        query = query.where(UserSnapshot.computed_through > entry_date)
+    db.session.execute(query)
+
+
+def snapshot_users(user_ids, through, chunk_size=SNAPSHOT_CHUNK_SIZE):
+    """Compute and upsert snapshots for users on the current shard. Returns entries read."""
+    entries = 0
+    for user_id in user_ids:
+        # computed_at is when reading began, so any change made after it rejects the snapshot
+        read_at = datetime.utcnow()
+        aggregates = compute_aggregates(user_id, before=through, chunk_size=chunk_size)
+        aggregates.trim()
+        entries += aggregates.entries
+        db.session.merge(UserSnapshot(user_id=user_id, computed_through=through,
+                                      computed_at=read_at, **aggregates.snapshot_fields()))
+    db.session.commit()
+    return entries
+
+
+_worker_app = None
+
+
+def _init_worker():
+    global _worker_app
+    from app import create_app
+    _worker_app = create_app()
+
+
+def _snapshot_partition(shard, user_ids, through, chunk_size):
+    """Runs in a worker process with its own app and database connections"""
+    with _worker_app.app_context():
+        with use_shard(shard):
+            return len(user_ids), snapshot_users(user_ids, through, chunk_size)
+
+
+def snapshot_partitions(partition_size=SNAPSHOT_PARTITION_SIZE, user_ids=None):
+    """Split users into (shard, user ids) partitions so each one stays on a single shard"""
+    if user_ids is None:
+        user_ids = db.session.execute(select(User.id).order_by(User.id)).scalars().all()
+    by_shard = {}
+    for user_id in user_ids:
+        shard = shard_for_user(user_id) if sharding_enabled() else None
+        by_shard.setdefault(shard, []).append(user_id)
+
+    partitions = []
+    for shard, ids in by_shard.items():
+        for start in range(0, len(ids), partition_size):
+            partitions.append((shard, ids[start:start + partition_size]))
+    return partitions
+
+
+def run_snapshots(partitions, through, workers, chunk_size=SNAPSHOT_CHUNK_SIZE, echo=print):
+    """Snapshot every partition, in a process pool unless workers == 1. Returns (users, entries)."""
+    total_users = sum(len(ids) for _, ids in partitions)
+    done_users = done_entries = 0
+    started = time.monotonic()
+
+    def report(users, entries):
+        nonlocal done_users, done_entries
+        done_users += users
+        done_entries += entries
+        elapsed = max(time.monotonic() - started, 1e-9)
+        echo(f'{done_users}/{total_users} users, {done_entries} entries '
+             f'({done_users / elapsed:.1f} users/s, {done_entries / elapsed:.0f} entries/s)')
+
+    if workers == 1:
+        for shard, user_ids in partitions:
+            with use_shard(shard):
+                report(len(user_ids), snapshot_users(user_ids, through, chunk_size))
+        return done_users, done_entries
+
+    # Fresh interpreters rather than forks, so no database connection is shared with the parent
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker) as executor:
+        futures = [executor.submit(_snapshot_partition, shard, user_ids, through, chunk_size)
+                   for shard, user_ids in partitions]
+        for future in as_completed(futures):
+            report(*future.result())
+    return done_users, done_entries
+
+
+def start_of_today():
+    """Default snapshot cut-off: midnight UTC, so the dashboard delta is just today's entries"""
+    return datetime.combine(datetime.now(timezone.utc).date(), datetime.min.time())
+
+
+def emotion_distribution(aggregates):
+    """Average score of each charted emotion over every analyzed entry, in percent"""
+    if not aggregates.scored:
+        return {}
+    return {emotion: round(float(aggregates.sums[EMOTION_LABELS.index(emotion)]) / aggregates.scored * 100, 1)
+            for emotion in EMOTIONS}
+
+
+def week_averages(aggregates, start_day):
+    """({emotion: average percent}, analyzed entries) for one week"""
+    _, scored, sums = aggregates.week(start_day)
+    if not scored:
+        return {}, 0
+    return {emotion: float(sums[EMOTION_LABELS.index(emotion)]) / scored * 100 for emotion in EMOTIONS}, scored
@@ -0,0 +1,165 @@
+"""
+Single-node SQLite mode.
+
+Small installs can skip the database server: set DATABASE_URL to a SQLite file
+(sqlite:////var/lib/mood-journal/journal.db). Every new connection switches
+the file to WAL journaling, so readers never wait for the writer or for each
+other, and gets the pragmas in SQLITE_PRAGMAS. Connections are pooled and
+shared between threads, which keeps each connection's page cache warm.
+
+SQLite allows one writer at a time, and a writer that can't get the file lock
+fails with "database is locked" once busy_timeout runs out. So each process
+queues its writers. A session waits for its turn when it first writes (flush,
+INSERT/UPDATE/DELETE or SELECT ... FOR UPDATE) and hands the turn on when its
+transaction ends. Turns are first come, first served. Serve the app from one
+process with several threads (e.g. gunicorn --threads 8) so that every writer
+goes through the same queue; writers in other processes (CLI commands) wait
+on busy_timeout instead.
+
+This mode is meant for one unsharded database.
+"""
+import threading
+from collections import deque
+from flask import current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+from app.sharding import ShardedSession
+
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    # In WAL mode NORMAL can only lose the last commits on power loss, never corrupt the file
+    'synchronous': 'NORMAL',
+    # Reads go through a shared memory map instead of copies into each connection's cache
+    'mmap_size': 256 * 1024 * 1024,
+    # Per connection, in KiB when negative (the memory map does most of the caching)
+    'cache_size': -16000,
+    'busy_timeout': 5000,
+    'temp_store': 'MEMORY',
+}
+# Pooled connections (about one per worker thread); as many again may be opened under load
+DEFAULT_POOL_SIZE = 10
+# Seconds a writer waits for its turn before the request fails
+DEFAULT_WRITE_TIMEOUT = 30
+
+
+class WriteQueueTimeout(RuntimeError):
+    pass
+
+
+def is_sqlite(url):
+    return bool(url) and make_url(url).get_backend_name() == 'sqlite'
+
+
+def _in_memory(url):
+    url = make_url(url)
+    return url.database in (None, '', ':memory:') or url.query.get('mode') == 'memory'
+
+
+def sqlite_engine_options(url, pool_size=DEFAULT_POOL_SIZE):
+    # Flask-SQLAlchemy already gives in-memory databases one shared connection
+    if _in_memory(url):
+        return {}
+    return {
+        'poolclass': QueuePool,
+        'pool_size': pool_size,
+        'max_overflow': pool_size,
+        'connect_args': {'check_same_thread': False, 'timeout': SQLITE_PRAGMAS['busy_timeout'] / 1000},
+    }
+
+
+def configure_sqlite(app):
+    """Engine options for every SQLite database (call after configure_shards, before db.init_app)"""
+    pool_size = app.config['SQLITE_POOL_SIZE']
+    app.config['SQLITE_MODE'] = is_sqlite(app.config['SQLALCHEMY_DATABASE_URI'])
+    if app.config['SQLITE_MODE']:
+        options = app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})
+        for key, value in sqlite_engine_options(app.config['SQLALCHEMY_DATABASE_URI'], pool_size).items():
+            options.setdefault(key, value)
+    binds = app.config.get('SQLALCHEMY_BINDS', {})
+    for key, value in binds.items():
+        if isinstance(value, str) and is_sqlite(value):
+            binds[key] = {'url': value, **sqlite_engine_options(value, pool_size)}
+
+
+def _apply_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f'PRAGMA {name} = {value}')
+    cursor.close()
+
+
+class WriteQueue:
+    """First come, first served turns for the writers in this process"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiting = deque()
+        self.holder = None
+
+    def acquire(self, owner, timeout):
+        with self.lock:
+            if self.holder is None and not self.waiting:
+                self.holder = owner
+                return
+            turn = threading.Event()
+            self.waiting.append((owner, turn))
+        if turn.wait(timeout):
+            return
+        with self.lock:
+            # The turn may have been handed over just as the wait timed out
+            if self.holder is owner:
+                return
+            self.waiting.remove((owner, turn))
+        raise WriteQueueTimeout(f'Waited more than {timeout}s for the database write queue')
+
+    def release(self, owner):
+        with self.lock:
+            if self.holder is not owner:
+                return
+            if self.waiting:
+                self.holder, turn = self.waiting.popleft()
+                turn.set()
+            else:
+                self.holder = None
+
+
+write_queue = WriteQueue()
+
+
+def _take_turn(session):
+    if session.info.get('write_turn') or not has_app_context() or not current_app.config.get('SQLITE_MODE'):
+        return
+    write_queue.acquire(session, current_app.config['SQLITE_WRITE_TIMEOUT'])
+    session.info['write_turn'] = True
+
+
+def _queue_flush(session, flush_context, instances):
+    if session.new or session.dirty or session.deleted:
+        _take_turn(session)
+
+
+def _queue_statement(orm_execute_state):
+    statement = orm_execute_state.statement
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete \
+            or (orm_execute_state.is_select and getattr(statement, '_for_update_arg', None) is not None):
+        _take_turn(orm_execute_state.session)
+
+
+def _end_turn(session, transaction):
+    # Commit, rollback and close all end the outermost transaction
+    if transaction.parent is None and session.info.pop('write_turn', False):
+        write_queue.release(session)
+
+
+def init_sqlite(app, db):
+    """Tune SQLite connections and queue writers (call after db.init_app)"""
+    with app.app_context():
+        for engine in db.engines.values():
+            if engine.dialect.name == 'sqlite' and not event.contains(engine, 'connect', _apply_pragmas):
+                event.listen(engine, 'connect', _apply_pragmas)
+    # The listeners do nothing unless the app runs in SQLite mode
+    for name, listener in (('before_flush', _queue_flush), ('do_orm_execute', _queue_statement),
+                           ('after_transaction_end', _end_turn)):
+        if not event.contains(ShardedSession, name, listener):
+            event.listen(ShardedSession, name, listener)
@@ -19,3 +19,44 @@ document.addEventListener('DOMContentLoaded', function() {
         }, 3000); // 5 seconds display time
     });
 });
+
+// Tag autocomplete for comma-separated tag inputs marked with data-tag-autocomplete="<api url>".
+// Suggests completions for the tag being typed (the text after the last comma).
+document.addEventListener('DOMContentLoaded', function() {
+    document.querySelectorAll('input[data-tag-autocomplete]').forEach((input, index) => {
+        const list = document.createElement('datalist');
+        list.id = 'tag-suggestions-' + index;
+        input.setAttribute('list', list.id);
+        input.setAttribute('autocomplete', 'off');
+        input.after(list);
+
+        let timer = null;
+        let latest = 0;
+        input.addEventListener('input', () => {
+            clearTimeout(timer);
+            timer = setTimeout(() => {
+                const parts = input.value.split(',');
+                const current = parts.pop().trim();
+                if (!current) {
+                    list.replaceChildren();
+                    return;
+                }
+                const before = parts.map(part => part.trim()).filter(Boolean);
+                const request = ++latest;
+                fetch(input.dataset.tagAutocomplete + '?q=' + encodeURIComponent(current))
+                    .then(response => response.ok ? response.json() : { tags: [] })
+                    .then(data => {
+                        if (request !== latest) return;  // a newer keystroke already asked
+                        list.replaceChildren(...data.tags
+                            .filter(tag => !before.includes(tag.name))
+                            .map(tag => {
+                                const option = document.createElement('option');
+                                option.value = before.concat(tag.name).join(', ');
+                                return option;
+                            }));
+                    })
+                    .catch(() => {});
+            }, 150);
+        });
+    });
+});
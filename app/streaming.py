@@ -0,0 +1,33 @@
+from flask import Response, stream_template, stream_with_context, get_flashed_messages
+
+# Jinja yields lots of tiny pieces; group them so each write is a useful size.
+# Small enough that the page head goes out before the slow parts of the page are rendered.
+STREAM_FLUSH_SIZE = 2048
+
+
+def stream_page(template_name, flush_size=STREAM_FLUSH_SIZE, **context):
+    """
+    Render a template as a streamed response.
+    Expensive data should be passed as callables the template calls where it
+    needs them, so the queries run after the head has already been sent.
+    """
+    # Headers (and the session cookie) are sent before the body, so pop the
+    # flashed messages now - Flask caches them for the template to read later
+    get_flashed_messages(with_categories=True)
+
+    chunks = stream_template(template_name, **context)
+
+    def generate():
+        buffer = []
+        size = 0
+        for chunk in chunks:
+            buffer.append(chunk)
+            size += len(chunk)
+            if size >= flush_size:
+                yield ''.join(buffer)
+                buffer = []
+                size = 0
+        if buffer:
+            yield ''.join(buffer)
+
+    return Response(stream_with_context(generate()), mimetype='text/html')
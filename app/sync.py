@@ -0,0 +1,169 @@
+"""
+Delta sync for clients and backups.
+
+Every entry carries updated_at (content, tags or scores changed) and every
+deletion leaves an entry_tombstone row. GET /api/sync merges the two into one
+change stream ordered by (time, entry id) and returns it a page at a time.
+Each page ends with an opaque cursor, and the next request resumes from it.
+Traffic and database work therefore follow the number of changes, not the
+size of the journal.
+
+Clients apply a page's deletions before its entries. An id in `entries`
+always exists right now, so any tombstone for the same id is older.
+"""
+import base64
+from datetime import datetime, timedelta
+from sqlalchemy import select, delete, insert, func, and_, or_, literal, union_all, true
+from app import db
+from app.models import Entry, EntryTombstone, Tag, entry_tag
+from app.utils import EMOTION_LABELS
+from app.archive import archived_texts
+
+SYNC_PAGE_SIZE = 200
+MAX_SYNC_PAGE_SIZE = 1000
+# Changes newer than this are held back for the next request, so a transaction
+# that committed late with an earlier timestamp is never skipped
+SYNC_SETTLE_SECONDS = 5
+# Tombstones older than this are pruned; older cursors have to start again
+TOMBSTONE_RETENTION_DAYS = 90
+PRUNE_CHUNK_SIZE = 1000
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(changed_at, entry_id, issued_at):
+    """Position in the change stream, plus when it was handed out"""
+    raw = f'{changed_at.isoformat()}|{entry_id}|{issued_at.isoformat()}'.encode('ascii')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """((changed at, entry id), issued at)"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('ascii')
+        changed_at, entry_id, issued_at = raw.split('|')
+        return (datetime.fromisoformat(changed_at), int(entry_id)), datetime.fromisoformat(issued_at)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise InvalidCursor(f'Invalid sync cursor: {cursor!r}') from e
+
+
+def record_deletions(user_id, entry_ids):
+    """Leave tombstones for deleted entries (caller commits)"""
+    if not entry_ids:
+        return
+    # Without the id allocator an id can be reused, so only the latest deletion counts
+    db.session.execute(delete(EntryTombstone).where(EntryTombstone.entry_id.in_(entry_ids)))
+    now = datetime.utcnow()
+    db.session.execute(insert(EntryTombstone), [
+        {'entry_id': entry_id, 'user_id': user_id, 'deleted_at': now} for entry_id in entry_ids
+    ])
+
+
+def _after(column, id_column, position):
+    if position is None:
+        return true()
+    changed_at, entry_id = position
+    return or_(column > changed_at, and_(column == changed_at, id_column > entry_id))
+
+
+def change_stream(user_id, position, until, limit):
+    """The next `limit` (entry id, changed at, deleted) changes after `position`, up to `until`"""
+    # Each side uses its own (user_id, time, id) index and stops at `limit`; the union merges them
+    updated = select(Entry.id.label('entry_id'), Entry.updated_at.label('changed_at'),
+                     literal(False).label('deleted'))\
+        .where(Entry.user_id == user_id, Entry.updated_at <= until,
+               _after(Entry.updated_at, Entry.id, position))\
+        .order_by(Entry.updated_at, Entry.id).limit(limit).subquery()
+    deleted = select(EntryTombstone.entry_id, EntryTombstone.deleted_at.label('changed_at'),
+                     literal(True).label('deleted'))\
+        .where(EntryTombstone.user_id == user_id, EntryTombstone.deleted_at <= until,
+               _after(EntryTombstone.deleted_at, EntryTombstone.entry_id, position))\
+        .order_by(EntryTombstone.deleted_at, EntryTombstone.entry_id).limit(limit).subquery()
+    changes = union_all(select(updated), select(deleted)).subquery()
+    return db.session.execute(
+        select(changes).order_by(changes.c.changed_at, changes.c.entry_id).limit(limit)
+    ).all()
+
+
+def last_change(user_id):
+    """(newest updated_at, newest tombstone) of the user's journal - changes whenever it does"""
+    updated = db.session.execute(select(func.max(Entry.updated_at)).where(Entry.user_id == user_id)).scalar()
+    deleted = db.session.execute(
+        select(func.max(EntryTombstone.deleted_at)).where(EntryTombstone.user_id == user_id)
+    ).scalar()
+    return updated, deleted
+
+
+def _entry_payloads(entry_ids):
+    """Compact JSON for the given entries, with tags collected in one query"""
+    rows = db.session.execute(
+        select(Entry.id, Entry.content, Entry.archived, Entry.date_created, Entry.updated_at,
+               Entry.dominant_emotion, *[getattr(Entry, label) for label in EMOTION_LABELS])
+        .where(Entry.id.in_(entry_ids)).order_by(Entry.updated_at, Entry.id)
+    ).all()
+    tags = {}
+    for entry_id, name in db.session.execute(
+        select(entry_tag.c.entry_id, Tag.name).join(Tag, Tag.id == entry_tag.c.tag_id)
+        .where(entry_tag.c.entry_id.in_(entry_ids))
+    ):
+        tags.setdefault(entry_id, []).append(name)
+    cold = archived_texts([row.id for row in rows if row.archived])
+
+    return [{
+        'id': row.id,
+        'content': cold.get(row.id, row.content),
+        'date_created': row.date_created.isoformat(),
+        'updated_at': row.updated_at.isoformat(),
+        'tags': sorted(tags.get(row.id, [])),
+        'dominant_emotion': row.dominant_emotion,
+        # Scores in the order of the response's `labels`; null until analyzed
+        'scores': [getattr(row, label) for label in EMOTION_LABELS] if row.dominant_emotion else None,
+    } for row in rows]
+
+
+def sync_changes(user_id, cursor=None, limit=SYNC_PAGE_SIZE):
+    """One page of the user's changes since `cursor` (None for a full download)"""
+    limit = max(1, min(MAX_SYNC_PAGE_SIZE, limit))
+    now = datetime.utcnow()
+    position, issued_at = decode_cursor(cursor) if cursor else (None, None)
+
+    # A client that hasn't synced for longer than we keep tombstones may have
+    # missed deletions, so it has to download everything again
+    reset = position is None or issued_at < now - timedelta(days=TOMBSTONE_RETENTION_DAYS)
+    if reset:
+        position = None
+
+    until = now - timedelta(seconds=SYNC_SETTLE_SECONDS)
+    changes = change_stream(user_id, position, until, limit)
+    if changes:
+        position = (changes[-1].changed_at, changes[-1].entry_id)
+    elif position is None:
+        # Nothing at all yet: resume from the point we've looked up to
+        position = (until, 0)
+
+    return {
+        'reset': reset,
+        'labels': EMOTION_LABELS,
+        'entries': _entry_payloads([c.entry_id for c in changes if not c.deleted]),
+        'deleted': [c.entry_id for c in changes if c.deleted],
+        # Empty pages still hand out a fresh cursor, so an idle client never ages out
+        'cursor': encode_cursor(*position, now),
+        'has_more': len(changes) == limit,
+    }
+
+
+def prune_tombstones(older_than_days=TOMBSTONE_RETENTION_DAYS, chunk_size=PRUNE_CHUNK_SIZE):
+    """Delete old tombstones on the current shard in chunks. Returns how many went."""
+    before = datetime.utcnow() - timedelta(days=older_than_days)
+    pruned = 0
+    while True:
+        ids = db.session.execute(
+            select(EntryTombstone.entry_id).where(EntryTombstone.deleted_at < before).limit(chunk_size)
+        ).scalars().all()
+        if not ids:
+            return pruned
+        db.session.execute(delete(EntryTombstone).where(EntryTombstone.entry_id.in_(ids)))
+        db.session.commit()
+        pruned += len(ids)
@@ -0,0 +1,190 @@
+"""
+Tag autocomplete.
+
+Each process keeps every tag name in one sorted list, so the tags that start
+with a prefix are a contiguous slice found with bisect. No LIKE query runs per
+keystroke. Alongside each name is its popularity: the number of users who
+have used the tag. The list is rebuilt from the database every few minutes;
+tags created in this process are added as soon as they are inserted.
+
+Suggestions rank the user's own tags by how often they used them, then by
+popularity. Tags of other users are only suggested once enough people use
+them, so a private tag never leaks through autocomplete. A user's usage
+counts sit in a small LRU cache with a short TTL.
+"""
+import heapq
+import threading
+import time
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from sqlalchemy import select, func, event
+from app import db
+from app.models import Entry, Tag, entry_tag
+from app.sharding import each_shard
+
+AUTOCOMPLETE_LIMIT = 10
+MAX_AUTOCOMPLETE_LIMIT = 25
+# Other people's tags are suggested only when at least this many users have them
+MIN_SHARED_USERS = 3
+# Memory bounds: tag names kept in the index (most popular first) and users whose counts are cached
+MAX_INDEXED_TAGS = 100000
+MAX_CACHED_USERS = 1000
+TAG_INDEX_REFRESH_SECONDS = 300
+USER_TAGS_TTL_SECONDS = 60
+# Results for prefixes this short are cached between rebuilds (they match the most tags)
+CACHED_PREFIX_LENGTH = 2
+
+
+def normalize_tag(name):
+    return (name or '').strip().lower()
+
+
+class TagIndex:
+    """Sorted tag names with their popularity, rebuilt periodically and extended in place"""
+
+    def __init__(self):
+        self.names = []
+        self.popularity = {}
+        self.loaded_at = None
+        self.prefix_cache = {}
+        self.lock = threading.Lock()
+        self.reload_lock = threading.Lock()
+
+    def ensure_fresh(self):
+        if self.loaded_at is not None and time.monotonic() - self.loaded_at < TAG_INDEX_REFRESH_SECONDS:
+            return
+        # One thread rebuilds; the others keep using the current index meanwhile
+        if not self.reload_lock.acquire(blocking=self.loaded_at is None):
+            return
+        try:
+            self.reload()
+        finally:
+            self.reload_lock.release()
+
+    def reload(self):
+        popularity = {}
+        # entry_tag lives on the shards; a user is on one shard, so the counts add up
+        for shard in each_shard():
+            for name, users in db.session.execute(
+                select(Tag.name, func.count(func.distinct(Entry.user_id)))
+                .select_from(entry_tag)
+                .join(Entry, Entry.id == entry_tag.c.entry_id)
+                .join(Tag, Tag.id == entry_tag.c.tag_id)
+                .group_by(Tag.name)
+            ):
+                popularity[name] = popularity.get(name, 0) + users
+        names = db.session.execute(select(Tag.name)).scalars().all()
+        if len(names) > MAX_INDEXED_TAGS:
+            names = heapq.nlargest(MAX_INDEXED_TAGS, names, key=lambda name: popularity.get(name, 0))
+
+        with self.lock:
+            self.names = sorted(names)
+            self.popularity = {name: popularity.get(name, 0) for name in self.names}
+            self.prefix_cache = {}
+            self.loaded_at = time.monotonic()
+
+    def add(self, name):
+        """A tag was just created in this process"""
+        with self.lock:
+            if self.loaded_at is None or name in self.popularity or len(self.names) >= MAX_INDEXED_TAGS:
+                return
+            insort(self.names, name)
+            self.popularity[name] = 0
+            self.prefix_cache = {key: value for key, value in self.prefix_cache.items()
+                                 if not name.startswith(key)}
+
+    def shared(self, prefix, limit):
+        """The most popular tags starting with prefix that enough users share"""
+        with self.lock:
+            cacheable = len(prefix) <= CACHED_PREFIX_LENGTH
+            if cacheable and prefix in self.prefix_cache:
+                return self.prefix_cache[prefix][:limit]
+            matches = []
+            for position in range(bisect_left(self.names, prefix), len(self.names)):
+                name = self.names[position]
+                if not name.startswith(prefix):
+                    break
+                if self.popularity[name] >= MIN_SHARED_USERS:
+                    matches.append(name)
+            best = heapq.nsmallest(MAX_AUTOCOMPLETE_LIMIT, matches, key=lambda name: (-self.popularity[name], name))
+            if cacheable:
+                self.prefix_cache[prefix] = best
+            return best[:limit]
+
+    def popularity_of(self, name):
+        return self.popularity.get(name, 0)
+
+
+class UserTagCache:
+    """Recently used users' {tag name: entries using it}, expiring after a short TTL"""
+
+    def __init__(self, max_users=MAX_CACHED_USERS, ttl=USER_TAGS_TTL_SECONDS):
+        self.max_users = max_users
+        self.ttl = ttl
+        self.users = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, user_id):
+        with self.lock:
+            cached = self.users.get(user_id)
+            if cached is not None and time.monotonic() - cached[0] < self.ttl:
+                self.users.move_to_end(user_id)
+                return cached[1]
+        counts = dict(db.session.execute(
+            select(Tag.name, func.count())
+            .select_from(entry_tag)
+            .join(Entry, Entry.id == entry_tag.c.entry_id)
+            .join(Tag, Tag.id == entry_tag.c.tag_id)
+            .where(Entry.user_id == user_id)
+            .group_by(Tag.name)
+        ).all())
+        with self.lock:
+            self.users[user_id] = (time.monotonic(), counts)
+            self.users.move_to_end(user_id)
+            while len(self.users) > self.max_users:
+                self.users.popitem(last=False)
+        return counts
+
+    def forget(self, user_id):
+        with self.lock:
+            self.users.pop(user_id, None)
+
+
+tag_index = TagIndex()
+user_tags = UserTagCache()
+
+
+def forget_user_tags(user_id):
+    """Call after the user's tags change so their next lookup sees them"""
+    user_tags.forget(user_id)
+
+
+def suggest_tags(user_id, prefix, limit=AUTOCOMPLETE_LIMIT):
+    """Up to `limit` tags starting with prefix: the user's own first, then popular shared ones"""
+    prefix = normalize_tag(prefix)
+    limit = max(1, min(MAX_AUTOCOMPLETE_LIMIT, limit))
+    tag_index.ensure_fresh()
+
+    # A user has few enough tags that filtering them directly is cheap
+    own_counts = user_tags.get(user_id)
+    own = sorted((name for name in own_counts if name.startswith(prefix)),
+                 key=lambda name: (-own_counts[name], -tag_index.popularity_of(name), name))
+    suggestions = [{'name': name, 'uses': own_counts[name], 'mine': True} for name in own[:limit]]
+
+    if len(suggestions) < limit:
+        taken = {suggestion['name'] for suggestion in suggestions}
+        for name in tag_index.shared(prefix, limit + len(taken)):
+            if name not in taken:
+                suggestions.append({'name': name, 'uses': 0, 'mine': False})
+                if len(suggestions) == limit:
+                    break
+    return suggestions
+
+
+def _index_new_tag(mapper, connection, target):
+    tag_index.add(target.name)
+
+
+def init_tag_index():
+    if not event.contains(Tag, 'after_insert', _index_new_tag):
+        event.listen(Tag, 'after_insert', _index_new_tag)
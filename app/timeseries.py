@@ -0,0 +1,220 @@
+import numpy as np
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import func
+from app import db
+from app.models import Entry
+from app.utils import EMOTIONS, decode_scores
+
+# Supported ranges for the long-range chart (None means all time)
+RANGES = {
+    '7d': 7,
+    '90d': 90,
+    '1y': 365,
+    'all': None,
+}
+
+# Rolling average window (in buckets) for each bucket size
+ROLLING_WINDOWS = {
+    'day': 7,
+    'week': 4,
+    'month': 3,
+}
+
+DEFAULT_POINTS = 120
+MIN_POINTS = 10
+MAX_POINTS = 1000
+
+
+def choose_bucket(span_days):
+    """Pick a bucket size so the series stays a sensible length"""
+    if span_days <= 120:
+        return 'day'
+    if span_days <= 730:
+        return 'week'
+    return 'month'
+
+
+def load_daily_series(user_id, start=None):
+    """
+    Load per-day average emotion scores for a user.
+    Returns (days, counts, values) where days is an int array of days since
+    the epoch, counts is the number of entries per day and values is a
+    (n_days, n_emotions) float array of daily means.
+    """
+    day = func.date(Entry.date_created)
+    query = db.session.query(
+        day.label('date'),
+        func.count(Entry.id).label('count'),
+        *[func.avg(getattr(Entry, emotion)).label(emotion) for emotion in EMOTIONS]
+    ).filter(Entry.user_id == user_id, Entry.dominant_emotion.isnot(None))
+
+    if start is not None:
+        query = query.filter(Entry.date_created >= start)
+
+    rows = query.group_by(day).order_by(day.asc()).all()
+
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty(0), np.empty((0, len(EMOTIONS)))
+
+    # MySQL returns date objects and SQLite returns strings, so go through str()
+    days = np.array([str(row.date)[:10] for row in rows], dtype='datetime64[D]').astype(np.int64)
+    counts = np.array([row.count for row in rows], dtype=np.float64)
+    values = np.nan_to_num(decode_scores([row[2:] for row in rows], len(EMOTIONS), np.float64))
+    return days, counts, values
+
+
+def bucket_series(days, counts, values, bucket):
+    """
+    Re-aggregate daily means into day/week/month buckets.
+    Bucket means are weighted by the number of entries behind each day.
+    """
+    if bucket == 'day' or len(days) == 0:
+        return days, counts, values
+
+    if bucket == 'week':
+        # 1970-01-01 was a Thursday, so (days + 3) % 7 is the weekday with Monday == 0
+        keys = days - (days + 3) % 7
+    else:
+        keys = days.astype('datetime64[D]').astype('datetime64[M]').astype('datetime64[D]').astype(np.int64)
+
+    bucket_days, inverse = np.unique(keys, return_inverse=True)
+    bucket_counts = np.bincount(inverse, weights=counts)
+
+    weighted = np.zeros((len(bucket_days), values.shape[1]))
+    np.add.at(weighted, inverse, values * counts[:, None])
+    bucket_values = weighted / bucket_counts[:, None]
+
+    return bucket_days, bucket_counts, bucket_values
+
+
+def bucket_positions(days, bucket):
+    """Calendar index of each bucket start: consecutive days, weeks or months differ by 1"""
+    if bucket == 'month':
+        return days.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+    return days // 7 if bucket == 'week' else days
+
+
+def rolling_average(days, counts, values, window, bucket='day'):
+    """
+    Trailing, count-weighted rolling mean over the last `window` calendar buckets.
+    Buckets without entries are part of the window, so with gaps in the journal
+    a 7-day average still covers 7 days and not the last 7 days that have entries.
+    """
+    if len(counts) == 0:
+        return values
+
+    # Spread the buckets over a dense calendar, with empty buckets counting zero entries
+    positions = bucket_positions(days, bucket)
+    positions = positions - positions[0]
+    dense_counts = np.zeros(positions[-1] + 1)
+    dense_counts[positions] = counts
+    dense_weighted = np.zeros((positions[-1] + 1, values.shape[1]))
+    dense_weighted[positions] = values * counts[:, None]
+
+    weighted_sum = np.cumsum(dense_weighted, axis=0)
+    count_sum = np.cumsum(dense_counts)
+
+    # Subtract the cumulative total from `window` buckets ago
+    weighted_sum[window:] = weighted_sum[window:] - weighted_sum[:-window]
+    count_sum[window:] = count_sum[window:] - count_sum[:-window]
+
+    # Every bucket that has entries has a non-zero count in its own window
+    return weighted_sum[positions] / count_sum[positions][:, None]
+
+
+def lttb_indices(x, y, target):
+    """
+    Largest-Triangle-Three-Buckets downsampling.
+    x is a 1-D array and y is (n, k); with several series the triangle areas
+    are summed so every emotion shares the same selected points. Returns the
+    indices of the points to keep, always including the first and last.
+    """
+    n = len(x)
+    if target >= n or target < 3:
+        return np.arange(n)
+
+    x = x.astype(np.float64)
+    selected = np.empty(target, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+
+    # Split the interior points into target - 2 buckets
+    edges = np.linspace(1, n - 1, target - 1).astype(np.int64)
+
+    previous = 0
+    for i in range(target - 2):
+        start, end = edges[i], edges[i + 1]
+
+        # Average point of the next bucket (or the last point)
+        if i + 2 < len(edges):
+            next_start, next_end = edges[i + 1], edges[i + 2]
+            next_x = x[next_start:next_end].mean()
+            next_y = y[next_start:next_end].mean(axis=0)
+        else:
+            next_x = x[-1]
+            next_y = y[-1]
+
+        # Triangle area for every candidate in this bucket, summed over series
+        candidate_x = x[start:end]
+        candidate_y = y[start:end]
+        areas = np.abs(
+            (x[previous] - next_x) * (candidate_y - y[previous])
+            - (x[previous] - candidate_x)[:, None] * (next_y - y[previous])
+        ).sum(axis=1)
+
+        previous = start + int(np.argmax(areas))
+        selected[i + 1] = previous
+
+    return selected
+
+
+def default_range(user_id):
+    """The shortest range that includes the user's latest scored entry, or None without any"""
+    latest = db.session.query(func.max(Entry.date_created))\
+        .filter(Entry.user_id == user_id, Entry.dominant_emotion.isnot(None)).scalar()
+    if latest is None:
+        return None
+    age = (datetime.now(timezone.utc).date() - latest.date()).days
+    for range_key, range_days in RANGES.items():
+        if range_days is None or age <= range_days:
+            return range_key
+
+
+def build_timeseries(user_id, range_key='90d', points=DEFAULT_POINTS):
+    """Build the chart payload for a user's long-range emotion chart"""
+    if range_key not in RANGES:
+        range_key = '90d'
+    points = max(MIN_POINTS, min(MAX_POINTS, points))
+
+    range_days = RANGES[range_key]
+    start = None
+    if range_days is not None:
+        today = datetime.now(timezone.utc).date()
+        start = datetime.combine(today - timedelta(days=range_days), datetime.min.time())
+
+    days, counts, values = load_daily_series(user_id, start)
+
+    # All-time spans depend on the user's history
+    span_days = range_days if range_days is not None else (int(days[-1] - days[0]) + 1 if len(days) else 0)
+    bucket = choose_bucket(span_days)
+    window = ROLLING_WINDOWS[bucket]
+
+    days, counts, values = bucket_series(days, counts, values, bucket)
+    rolling = rolling_average(days, counts, values, window, bucket)
+
+    keep = lttb_indices(days, values, points)
+
+    dates = days[keep].astype('datetime64[D]').astype(str).tolist()
+    values = np.round(values[keep] * 100, 1)
+    rolling = np.round(rolling[keep] * 100, 1)
+
+    return {
+        'range': range_key,
+        'bucket': bucket,
+        'rolling_window': window,
+        'total_buckets': int(len(days)),
+        'dates': dates,
+        'counts': counts[keep].astype(int).tolist(),
+        'series': {emotion: values[:, i].tolist() for i, emotion in enumerate(EMOTIONS)},
+        'rolling': {emotion: rolling[:, i].tolist() for i, emotion in enumerate(EMOTIONS)},
+    }
@@ -1,5 +1,17 @@
 import requests
 import os
+import hashlib
+import re
+import threading
+import time
+import unicodedata
+import zlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+import numpy as np
+from flask import current_app
+from app.coalesce import coalesce, CoalesceTimeout
 # from flask import current_app, request
 # from flask_limiter import Limiter
 # from flask_limiter.util import get_remote_address
@@ -16,13 +28,210 @@ import os
 
 # @hf_limiter.limit("5 per minute")  # Strict limit on Hugging Face calls
 
+# The emotions we chart, in display order
+EMOTIONS = ['joy', 'sadness', 'anger', 'fear', 'surprise']
+# Every label the model returns - all of them are stored on the entry
+EMOTION_LABELS = EMOTIONS + ['disgust', 'neutral']
+
+# Hugging Face model used for emotion analysis (override with SENTIMENT_MODEL)
+DEFAULT_SENTIMENT_MODEL = 'j-hartmann/emotion-english-distilroberta-base'
+# Where the model is served. Point SENTIMENT_API_URL at `flask inference-server`
+# (e.g. http://127.0.0.1:5001/models) to work offline.
+DEFAULT_SENTIMENT_API_URL = 'https://api-inference.huggingface.co/models'
+# Seconds to wait for the API before giving up on an analysis
+DEFAULT_SENTIMENT_API_TIMEOUT = 30
+# Callers sharing another thread's API request wait this much longer than the request may take
+COALESCE_GRACE_SECONDS = 5
+# Bump this when the way we prepare text or store scores changes, so old scores count as stale
+ANALYSIS_VERSION = '2'  # 2: long entries are scored in sentence chunks
+
+# The model reads at most 512 tokens, so longer entries are split into chunks of
+# whole sentences up to this many characters (about 250 tokens of English)
+MAX_CHUNK_CHARS = 1000
+# Chunk analyses run concurrently, but never more than this many at once across the app
+ANALYSIS_WORKERS = 4
+
+# A scored piece of an entry: character offsets into the text and its emotion scores
+ChunkScore = namedtuple('ChunkScore', ['start', 'end', 'scores'])
+
+# Sentence ends (., ! or ? followed by whitespace) and blank lines
+SENTENCE_BREAK = re.compile(r'(?<=[.!?])\s+|\n\s*\n')
+
+# Hashed bag-of-words size for similar-entry search (see app/similarity.py)
+TEXT_FEATURE_DIM = 128
+WORD = re.compile(r"[a-z0-9']{2,}")
+# Words too common to say anything about what an entry is about
+STOPWORDS = frozenset('''
+    a an and are as at be been but by can could did do does for from had has have he her him his
+    how i i'm im if in into is it it's its just me my myself no not of on or our out she so some
+    than that the their them then there they this to too up us very was we were what when which
+    who will with would you your
+'''.split())
+
+_analysis_pool = None
+_analysis_pool_lock = threading.Lock()
+
+def sentiment_model():
+    return os.getenv('SENTIMENT_MODEL', DEFAULT_SENTIMENT_MODEL)
+
+def sentiment_api_base_url():
+    return os.getenv('SENTIMENT_API_URL', DEFAULT_SENTIMENT_API_URL).rstrip('/')
+
+def sentiment_api_url():
+    return f"{sentiment_api_base_url()}/{sentiment_model()}"
+
+def analysis_version():
+    """
+    Identifier stored with every score: which model and pipeline version produced it.
+    Scores from anywhere but the hosted API (e.g. `flask inference-server`) carry the
+    server's host, so `backfill-scores --stale-model` redoes them against the real model.
+    """
+    version = f"{sentiment_model()}:{ANALYSIS_VERSION}"
+    base_url = sentiment_api_base_url()
+    if base_url != DEFAULT_SENTIMENT_API_URL:
+        version += f"@{urlsplit(base_url).netloc}"
+    return version
+
+def content_fingerprint(text):
+    """
+    Hash of the normalized entry text. Whitespace-only and unicode-form edits
+    give the same fingerprint, so they don't trigger a new analysis.
+    """
+    normalized = unicodedata.normalize('NFC', text or '')
+    normalized = re.sub(r'\s+', ' ', normalized).strip()
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+def dominant_emotion(emotion_scores):
+    """The label with the highest score"""
+    return max(EMOTION_LABELS, key=lambda label: emotion_scores.get(label, 0.0))
+
+def score_fields(emotion_scores, text):
+    """Entry column values for an analysis result"""
+    fields = {label: emotion_scores.get(label, 0.0) for label in EMOTION_LABELS}
+    fields['dominant_emotion'] = dominant_emotion(emotion_scores)
+    fields['content_hash'] = content_fingerprint(text)
+    fields['model_version'] = analysis_version()
+    return fields
+
+def decode_scores(rows, width=len(EMOTION_LABELS), dtype=np.float32):
+    """
+    Turn a batch of selected score columns into an (n_rows, width) array in one go.
+    Missing scores (NULL) become NaN.
+    """
+    if not rows:
+        return np.empty((0, width), dtype=dtype)
+    return np.array([tuple(row) for row in rows], dtype=dtype).reshape(len(rows), width)
+
+def text_features(text):
+    """
+    Hashed term frequencies (1 + log count) of the entry's words, as float16.
+    crc32 is stable across processes, unlike hash(), so stored vectors stay comparable.
+    """
+    counts = np.zeros(TEXT_FEATURE_DIM, dtype=np.float32)
+    for word in WORD.findall(unicodedata.normalize('NFC', text or '').lower()):
+        if word not in STOPWORDS:
+            counts[zlib.crc32(word.encode('utf-8')) % TEXT_FEATURE_DIM] += 1
+    present = counts > 0
+    counts[present] = 1 + np.log(counts[present])
+    return counts.astype(np.float16)
+
+def split_into_chunks(text, max_chars=MAX_CHUNK_CHARS):
+    """
+    Split text into (start, end) offsets of chunks made of whole sentences,
+    each at most max_chars long. Sentences longer than that are cut at spaces.
+    """
+    sentences = []
+    position = 0
+    for match in SENTENCE_BREAK.finditer(text):
+        sentences.append((position, match.start()))
+        position = match.end()
+    sentences.append((position, len(text)))
+
+    pieces = []
+    for start, end in sentences:
+        while end - start > max_chars:
+            cut = text.rfind(' ', start + 1, start + max_chars)
+            if cut == -1:
+                cut = start + max_chars
+            pieces.append((start, cut))
+            start = cut
+        if text[start:end].strip():
+            pieces.append((start, end))
+
+    # Pack consecutive sentences together while they fit
+    chunks = []
+    for start, end in pieces:
+        if chunks and end - chunks[-1][0] <= max_chars:
+            chunks[-1] = (chunks[-1][0], end)
+        else:
+            chunks.append((start, end))
+    return chunks
+
+def combine_chunk_scores(chunks):
+    """Length-weighted mean of the chunk scores for every label"""
+    weights = np.array([end - start for start, end, _ in chunks], dtype=np.float64)
+    labels = sorted({label for chunk in chunks for label in chunk.scores})
+    values = np.array([[chunk.scores.get(label, 0.0) for label in labels] for chunk in chunks])
+    combined = weights @ values / weights.sum()
+    return {label: float(score) for label, score in zip(labels, combined)}
+
+def _get_analysis_pool():
+    global _analysis_pool
+    with _analysis_pool_lock:
+        if _analysis_pool is None:
+            _analysis_pool = ThreadPoolExecutor(max_workers=ANALYSIS_WORKERS,
+                                                thread_name_prefix='analysis')
+        return _analysis_pool
+
+def analyze_entry(text, analyze=None):
+    """
+    Score an entry, splitting long text into sentence chunks that are analyzed
+    concurrently. Returns (emotion_scores, chunks) where chunks is a list of
+    ChunkScore, or (None, []) if any part of the analysis failed.
+    `analyze` replaces analyze_sentiment for each call (e.g. to rate limit it).
+    """
+    analyze = analyze or analyze_sentiment
+    chunks = split_into_chunks(text)
+    if len(chunks) <= 1:
+        emotion_scores = analyze(text)
+        if not emotion_scores:
+            return None, []
+        return emotion_scores, [ChunkScore(0, len(text), emotion_scores)]
+
+    # Worker threads need the app context for config and logging
+    app = current_app._get_current_object()
+
+    def analyze_chunk(span):
+        with app.app_context():
+            return analyze(text[span[0]:span[1]])
+
+    results = list(_get_analysis_pool().map(analyze_chunk, chunks))
+    if not all(results):
+        # A partial score would misrepresent the entry - leave it for a retry
+        return None, []
+
+    scored = [ChunkScore(start, end, scores) for (start, end), scores in zip(chunks, results)]
+    return combine_chunk_scores(scored), scored
+
 def analyze_sentiment(text):
     """
     Send text to Hugging Face sentiment analysis API and return emotion scores.
     We'll use the 'j-hartmann/emotion-english-distilroberta-base' model which returns
     multiple emotions with scores.
+    Use analyze_entry for entry text - this sends the text as a single input.
+    Concurrent calls for the same text share one API request.
     """
-    api_url = "https://api-inference.huggingface.co/models/j-hartmann/emotion-english-distilroberta-base"
+    timeout = float(os.getenv('SENTIMENT_API_TIMEOUT', DEFAULT_SENTIMENT_API_TIMEOUT))
+    api_url = sentiment_api_url()
+    try:
+        # The scores depend only on the text and the model, not on who asks
+        return coalesce('analyze_sentiment', None, lambda: _request_sentiment(api_url, text, timeout),
+                        api_url, text, timeout=timeout + COALESCE_GRACE_SECONDS)
+    except CoalesceTimeout as e:
+        current_app.logger.error(f"Hugging Face API error: {e}")
+        return None
+
+def _request_sentiment(api_url, text, timeout):
     headers = {
         "Authorization": f"Bearer {os.getenv('HUGGING_FACE_API_KEY')}"
     }
@@ -31,7 +240,7 @@ def analyze_sentiment(text):
     }
 
     try:
-        response = requests.post(api_url, headers=headers, json=payload)
+        response = requests.post(api_url, headers=headers, json=payload, timeout=timeout)
         response.raise_for_status()  # Raise an exception for bad status codes
         
         results = response.json()
@@ -50,4 +259,25 @@ def analyze_sentiment(text):
         return None
     except Exception as e:
         current_app.logger.error(f"Error processing sentiment analysis: {e}")
-        return None
\ No newline at end of file
+        return None
+
+
+class RateLimiter:
+    """
+    Simple thread-safe limiter that spaces calls out to at most `rate` per second.
+    Shared by worker threads so concurrent API calls stay under the provider's limits.
+    """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate and rate > 0 else 0.0
+        self.next_call = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            wait_for = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if wait_for > 0:
+            time.sleep(wait_for)
@@ -13,11 +13,10 @@ with app.app_context():
         print("All tables created successfully!")
         
         # Verify creation
-        result = db.session.execute(db.text('SHOW TABLES'))
-        tables = result.fetchall()
+        tables = db.inspect(db.engine).get_table_names()  # works on MySQL and SQLite
         print(f"Tables found: {len(tables)}")
         for table in tables:
-            print(f" - {table[0]}")
+            print(f" - {table}")
             
     except Exception as e:
         print(f"Error occurred: {e}")
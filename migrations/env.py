@@ -15,7 +15,15 @@ fileConfig(config.config_file_name)
 logger = logging.getLogger('alembic.env')
 
 
+# `flask shards upgrade` runs the migrations once per shard database with -x shard=<name>;
+# each shard keeps its own alembic_version table. Migrations check migrating_shard().
+shard = context.get_x_argument(as_dictionary=True).get('shard')
+config.attributes['shard'] = shard
+
+
 def get_engine():
+    if shard is not None:
+        return current_app.extensions['migrate'].db.engines[current_app.config['SHARDS'][shard]]
     try:
         # this works with Flask-SQLAlchemy<3 and Alchemical
         return current_app.extensions['migrate'].db.get_engine()
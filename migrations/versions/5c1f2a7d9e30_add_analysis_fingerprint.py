@@ -0,0 +1,29 @@
+"""Add content hash and model version to emotion scores
+
+Revision ID: 5c1f2a7d9e30
+Revises: 382eaf159479
+Create Date: 2026-10-19 11:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c1f2a7d9e30'
+down_revision = '382eaf159479'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Existing scores keep NULL for both columns; edits fall back to comparing the old text
+    with op.batch_alter_table('emotion_score', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('content_hash', sa.String(length=64), nullable=True))
+        batch_op.add_column(sa.Column('model_version', sa.String(length=100), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('emotion_score', schema=None) as batch_op:
+        batch_op.drop_column('model_version')
+        batch_op.drop_column('content_hash')
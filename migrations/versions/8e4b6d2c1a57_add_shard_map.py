@@ -0,0 +1,43 @@
+"""Add user shard map and entry id allocator
+
+Revision ID: 8e4b6d2c1a57
+Revises: 5c1f2a7d9e30
+Create Date: 2026-10-19 12:05:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from app.sharding import migrating_shard
+
+
+# revision identifiers, used by Alembic.
+revision = '8e4b6d2c1a57'
+down_revision = '5c1f2a7d9e30'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Both tables live in the global database. Shard databases get their
+    # journal tables from `flask shards init` and skip this revision.
+    if migrating_shard():
+        return
+    op.create_table('user_shard',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('shard', sa.String(length=50), nullable=False),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('user_id')
+    )
+    op.create_table('id_block',
+    sa.Column('name', sa.String(length=50), nullable=False),
+    sa.Column('next_value', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+
+
+def downgrade():
+    if migrating_shard():
+        return
+    op.drop_table('id_block')
+    op.drop_table('user_shard')
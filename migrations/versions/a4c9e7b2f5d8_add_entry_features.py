@@ -0,0 +1,31 @@
+"""Add hashed text features for similar-entry search
+
+Revision ID: a4c9e7b2f5d8
+Revises: e8a1f4c7d2b6
+Create Date: 2026-10-19 19:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4c9e7b2f5d8'
+down_revision = 'e8a1f4c7d2b6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Existing entries get their features from `flask text-features`
+    # (until then they are computed on the fly when a user's matrix loads)
+    op.create_table('entry_features',
+    sa.Column('entry_id', sa.Integer(), nullable=False),
+    sa.Column('text_vector', sa.LargeBinary(), nullable=False),
+    sa.ForeignKeyConstraint(['entry_id'], ['entry.id'], ),
+    sa.PrimaryKeyConstraint('entry_id')
+    )
+
+
+def downgrade():
+    op.drop_table('entry_features')
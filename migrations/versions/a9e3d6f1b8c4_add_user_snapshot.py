@@ -0,0 +1,40 @@
+"""Add per-user insight snapshots
+
+Revision ID: a9e3d6f1b8c4
+Revises: f2b7c9d4e5a3
+Create Date: 2026-10-19 16:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from app.sharding import migrating_shard
+
+
+# revision identifiers, used by Alembic.
+revision = 'a9e3d6f1b8c4'
+down_revision = 'f2b7c9d4e5a3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Global table only; shards skip it (see `flask shards upgrade`)
+    if migrating_shard():
+        return
+    op.create_table('user_snapshot',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('computed_through', sa.DateTime(), nullable=False),
+    sa.Column('computed_at', sa.DateTime(), nullable=False),
+    sa.Column('entries', sa.Integer(), nullable=False),
+    sa.Column('scored', sa.Integer(), nullable=False),
+    sa.Column('sums', sa.JSON(), nullable=False),
+    sa.Column('weeks', sa.JSON(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('user_id')
+    )
+
+
+def downgrade():
+    if migrating_shard():
+        return
+    op.drop_table('user_snapshot')
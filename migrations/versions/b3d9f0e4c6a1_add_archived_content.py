@@ -0,0 +1,47 @@
+"""Add cold storage for archived entry text
+
+Revision ID: b3d9f0e4c6a1
+Revises: 8e4b6d2c1a57
+Create Date: 2026-10-19 13:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import zlib
+
+
+# revision identifiers, used by Alembic.
+revision = 'b3d9f0e4c6a1'
+down_revision = '8e4b6d2c1a57'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('entry', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('archived', sa.Boolean(), server_default=sa.false(), nullable=False))
+
+    op.create_table('archived_content',
+    sa.Column('entry_id', sa.Integer(), nullable=False),
+    sa.Column('data', sa.LargeBinary(), nullable=False),
+    sa.Column('original_size', sa.Integer(), nullable=False),
+    sa.Column('archived_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['entry_id'], ['entry.id'], ),
+    sa.PrimaryKeyConstraint('entry_id')
+    )
+
+
+def downgrade():
+    # Put archived text back into the entry table before dropping cold storage
+    connection = op.get_bind()
+    archived = sa.table('archived_content',
+                        sa.column('entry_id', sa.Integer()), sa.column('data', sa.LargeBinary()))
+    entry = sa.table('entry', sa.column('id', sa.Integer()), sa.column('content', sa.Text()))
+    for entry_id, data in connection.execute(sa.select(archived.c.entry_id, archived.c.data)).all():
+        connection.execute(
+            entry.update().where(entry.c.id == entry_id).values(content=zlib.decompress(data).decode('utf-8'))
+        )
+
+    op.drop_table('archived_content')
+    with op.batch_alter_table('entry', schema=None) as batch_op:
+        batch_op.drop_column('archived')
@@ -0,0 +1,37 @@
+"""Add daily community mood sketches
+
+Revision ID: c5d8e2f7a0b9
+Revises: a9e3d6f1b8c4
+Create Date: 2026-10-19 17:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from app.sharding import migrating_shard
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5d8e2f7a0b9'
+down_revision = 'a9e3d6f1b8c4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Global table only; shards skip it (see `flask shards upgrade`)
+    if migrating_shard():
+        return
+    # Filled in by `flask mood-index rebuild`, then kept up to date as entries are analyzed
+    op.create_table('mood_sketch',
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('entries', sa.Integer(), nullable=False),
+    sa.Column('sums', sa.LargeBinary(), nullable=False),
+    sa.Column('histogram', sa.LargeBinary(), nullable=False),
+    sa.PrimaryKeyConstraint('day')
+    )
+
+
+def downgrade():
+    if migrating_shard():
+        return
+    op.drop_table('mood_sketch')
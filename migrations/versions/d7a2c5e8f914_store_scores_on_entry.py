@@ -0,0 +1,122 @@
+"""Store all emotion scores and the dominant label on the entry row
+
+Revision ID: d7a2c5e8f914
+Revises: b3d9f0e4c6a1
+Create Date: 2026-10-19 14:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd7a2c5e8f914'
+down_revision = 'b3d9f0e4c6a1'
+branch_labels = None
+depends_on = None
+
+# The five emotions emotion_score kept, and every label the entry now stores
+OLD_EMOTIONS = ['joy', 'sadness', 'anger', 'fear', 'surprise']
+EMOTION_LABELS = OLD_EMOTIONS + ['disgust', 'neutral']
+CHUNK_SIZE = 1000
+
+entry = sa.table('entry',
+    sa.column('id', sa.Integer()),
+    *[sa.column(label, sa.Float()) for label in EMOTION_LABELS],
+    sa.column('dominant_emotion', sa.String()),
+    sa.column('content_hash', sa.String()),
+    sa.column('model_version', sa.String()),
+)
+emotion_score = sa.table('emotion_score',
+    sa.column('id', sa.Integer()),
+    sa.column('entry_id', sa.Integer()),
+    *[sa.column(emotion, sa.Float()) for emotion in OLD_EMOTIONS],
+    sa.column('content_hash', sa.String()),
+    sa.column('model_version', sa.String()),
+)
+
+
+def upgrade():
+    with op.batch_alter_table('entry', schema=None) as batch_op:
+        for label in EMOTION_LABELS:
+            batch_op.add_column(sa.Column(label, sa.Float(), nullable=True))
+        batch_op.add_column(sa.Column('dominant_emotion', sa.String(length=20), nullable=True))
+        batch_op.add_column(sa.Column('content_hash', sa.String(length=64), nullable=True))
+        batch_op.add_column(sa.Column('model_version', sa.String(length=100), nullable=True))
+
+    # Copy the scores over in chunks. All-zero rows were placeholders for failed
+    # analyses, so those entries are left unscored for `flask backfill-scores`.
+    # Disgust and neutral were never stored, so they stay NULL for old entries.
+    connection = op.get_bind()
+    after_id = 0
+    while True:
+        rows = connection.execute(
+            sa.select(emotion_score).where(emotion_score.c.id > after_id)
+            .order_by(emotion_score.c.id).limit(CHUNK_SIZE)
+        ).mappings().all()
+        if not rows:
+            break
+        after_id = rows[-1]['id']
+
+        updates = []
+        for row in rows:
+            scores = {emotion: row[emotion] or 0.0 for emotion in OLD_EMOTIONS}
+            if not any(scores.values()):
+                continue
+            updates.append(dict(
+                scores,
+                b_entry_id=row['entry_id'],
+                dominant_emotion=max(OLD_EMOTIONS, key=scores.get),
+                content_hash=row['content_hash'],
+                model_version=row['model_version'],
+            ))
+        if updates:
+            connection.execute(
+                entry.update().where(entry.c.id == sa.bindparam('b_entry_id')).values(
+                    **{name: sa.bindparam(name) for name in
+                       OLD_EMOTIONS + ['dominant_emotion', 'content_hash', 'model_version']}
+                ),
+                updates,
+            )
+
+    op.drop_table('emotion_score')
+
+
+def downgrade():
+    op.create_table('emotion_score',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('joy', sa.Float(), nullable=True),
+    sa.Column('sadness', sa.Float(), nullable=True),
+    sa.Column('anger', sa.Float(), nullable=True),
+    sa.Column('fear', sa.Float(), nullable=True),
+    sa.Column('surprise', sa.Float(), nullable=True),
+    sa.Column('content_hash', sa.String(length=64), nullable=True),
+    sa.Column('model_version', sa.String(length=100), nullable=True),
+    sa.Column('entry_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['entry_id'], ['entry.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('entry_id')
+    )
+
+    connection = op.get_bind()
+    after_id = 0
+    while True:
+        rows = connection.execute(
+            sa.select(entry).where(entry.c.id > after_id, entry.c.dominant_emotion.isnot(None))
+            .order_by(entry.c.id).limit(CHUNK_SIZE)
+        ).mappings().all()
+        if not rows:
+            break
+        after_id = rows[-1]['id']
+        connection.execute(emotion_score.insert(), [
+            dict({emotion: row[emotion] for emotion in OLD_EMOTIONS},
+                 entry_id=row['id'], content_hash=row['content_hash'], model_version=row['model_version'])
+            for row in rows
+        ])
+
+    with op.batch_alter_table('entry', schema=None) as batch_op:
+        batch_op.drop_column('model_version')
+        batch_op.drop_column('content_hash')
+        batch_op.drop_column('dominant_emotion')
+        for label in reversed(EMOTION_LABELS):
+            batch_op.drop_column(label)
@@ -0,0 +1,45 @@
+"""Add per-chunk emotion scores for long entries
+
+Revision ID: e4f1a8b3c2d6
+Revises: d7a2c5e8f914
+Create Date: 2026-10-19 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4f1a8b3c2d6'
+down_revision = 'd7a2c5e8f914'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('entry_chunk',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('entry_id', sa.Integer(), nullable=False),
+    sa.Column('position', sa.Integer(), nullable=False),
+    sa.Column('start', sa.Integer(), nullable=False),
+    sa.Column('end', sa.Integer(), nullable=False),
+    sa.Column('joy', sa.Float(), nullable=True),
+    sa.Column('sadness', sa.Float(), nullable=True),
+    sa.Column('anger', sa.Float(), nullable=True),
+    sa.Column('fear', sa.Float(), nullable=True),
+    sa.Column('surprise', sa.Float(), nullable=True),
+    sa.Column('disgust', sa.Float(), nullable=True),
+    sa.Column('neutral', sa.Float(), nullable=True),
+    sa.Column('dominant_emotion', sa.String(length=20), nullable=True),
+    sa.ForeignKeyConstraint(['entry_id'], ['entry.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('entry_chunk', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_entry_chunk_entry_id'), ['entry_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('entry_chunk', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_entry_chunk_entry_id'))
+
+    op.drop_table('entry_chunk')
@@ -0,0 +1,55 @@
+"""Track entry changes and deletions for delta sync
+
+Revision ID: e8a1f4c7d2b6
+Revises: c5d8e2f7a0b9
+Create Date: 2026-10-19 18:05:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from app.sharding import migrating_shard
+
+
+# revision identifiers, used by Alembic.
+revision = 'e8a1f4c7d2b6'
+down_revision = 'c5d8e2f7a0b9'
+branch_labels = None
+depends_on = None
+
+entry = sa.table('entry',
+    sa.column('date_created', sa.DateTime()),
+    sa.column('updated_at', sa.DateTime()),
+)
+
+
+def upgrade():
+    with op.batch_alter_table('entry', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('updated_at', sa.DateTime(), nullable=True))
+
+    # Existing entries count as changed when they were written
+    op.execute(entry.update().values(updated_at=entry.c.date_created))
+
+    with op.batch_alter_table('entry', schema=None) as batch_op:
+        batch_op.alter_column('updated_at', existing_type=sa.DateTime(), nullable=False)
+        batch_op.create_index('ix_entry_user_updated', ['user_id', 'updated_at', 'id'], unique=False)
+
+    op.create_table('entry_tombstone',
+    sa.Column('entry_id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('deleted_at', sa.DateTime(), nullable=False),
+    # Shards have no user table to point at
+    *([] if migrating_shard() else [sa.ForeignKeyConstraint(['user_id'], ['user.id'], )]),
+    sa.PrimaryKeyConstraint('entry_id')
+    )
+    with op.batch_alter_table('entry_tombstone', schema=None) as batch_op:
+        batch_op.create_index('ix_entry_tombstone_user_deleted', ['user_id', 'deleted_at', 'entry_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('entry_tombstone', schema=None) as batch_op:
+        batch_op.drop_index('ix_entry_tombstone_user_deleted')
+    op.drop_table('entry_tombstone')
+
+    with op.batch_alter_table('entry', schema=None) as batch_op:
+        batch_op.drop_index('ix_entry_user_updated')
+        batch_op.drop_column('updated_at')
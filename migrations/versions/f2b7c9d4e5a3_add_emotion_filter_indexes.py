@@ -0,0 +1,32 @@
+"""Add indexes for emotion filters on entries
+
+Revision ID: f2b7c9d4e5a3
+Revises: e4f1a8b3c2d6
+Create Date: 2026-10-19 15:40:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2b7c9d4e5a3'
+down_revision = 'e4f1a8b3c2d6'
+branch_labels = None
+depends_on = None
+
+EMOTION_LABELS = ['joy', 'sadness', 'anger', 'fear', 'surprise', 'disgust', 'neutral']
+
+
+def upgrade():
+    with op.batch_alter_table('entry', schema=None) as batch_op:
+        batch_op.create_index('ix_entry_user_dominant_date', ['user_id', 'dominant_emotion', 'date_created'], unique=False)
+        for label in EMOTION_LABELS:
+            batch_op.create_index(f'ix_entry_user_{label}', ['user_id', label], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('entry', schema=None) as batch_op:
+        for label in reversed(EMOTION_LABELS):
+            batch_op.drop_index(f'ix_entry_user_{label}')
+        batch_op.drop_index('ix_entry_user_dominant_date')
@@ -0,0 +1,68 @@
+import os
+from datetime import datetime, timedelta
+import numpy as np
+import pytest
+from sqlalchemy import delete, select
+
+os.environ.setdefault('SECRET_KEY', 'test')
+os.environ['DATABASE_URL'] = 'sqlite://'
+
+from app import create_app, db
+from app.models import User, Entry, MoodSketch
+from app.community import Sketch
+from app.utils import EMOTION_LABELS
+
+
+@pytest.fixture
+def app():
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        user = User(username='writer')
+        user.password = 'secret'
+        db.session.add(user)
+        db.session.commit()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+def scored_entry(score=0.5, **fields):
+    entry = Entry(content='A day.', user_id=1, **fields)
+    for label in EMOTION_LABELS:
+        setattr(entry, label, score)
+    entry.dominant_emotion = 'joy'
+    return entry
+
+
+def stored_sketch(day):
+    row = db.session.execute(select(MoodSketch).where(MoodSketch.day == day)).scalar_one()
+    return Sketch.from_row(row)
+
+
+def test_deleting_an_entry_from_before_the_index_keeps_the_day_valid(app):
+    day = datetime.utcnow() - timedelta(days=3)
+    old = scored_entry(0.5, date_created=day)
+    db.session.add(old)
+    db.session.commit()
+    # As after the migration, before `flask mood-index rebuild`: the old entry was never counted
+    db.session.execute(delete(MoodSketch))
+    db.session.commit()
+    db.session.add(scored_entry(0.9, date_created=day))
+    db.session.commit()
+
+    db.session.delete(old)
+    db.session.commit()
+
+    sketch = stored_sketch(day.date())
+    assert sketch.entries >= 0
+    assert (sketch.counts >= 0).all()
+    assert (sketch.sums >= 0).all()
+    # The entry written after the index existed is still there, in the 0.9 bin
+    assert np.allclose(sketch.percentiles([50]), 0.905, atol=0.01)
+
+
+def test_scored_entry_without_a_date_counts_today(app):
+    db.session.add(scored_entry())
+    db.session.commit()
+    assert stored_sketch(datetime.utcnow().date()).entries == 1